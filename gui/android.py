@@ -22,7 +22,7 @@
 from __future__ import absolute_import
 import android
 
-from electrum_xmc import SimpleConfig, Wallet, WalletStorage, format_satoshis
+from electrum_xmc import SimpleConfig, Wallet, open_storage, format_satoshis
 from electrum_xmc.bitcoin import is_address, COIN
 from electrum_xmc import util
 from decimal import Decimal
@@ -910,7 +910,7 @@ class ElectrumGui:
         
         contacts = util.StoreDict(config, 'contacts')
 
-        storage = WalletStorage(config.get_wallet_path())
+        storage = open_storage(config.get_wallet_path(), config)
         if not storage.file_exists:
             action = self.restore_or_create()
             if not action:
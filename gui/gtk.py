@@ -27,7 +27,7 @@ from decimal import Decimal
 from electrum_xmc.util import print_error, InvalidPassword
 from electrum_xmc.bitcoin import is_valid, COIN
 from electrum_xmc.wallet import NotEnoughFunds
-from electrum_xmc import WalletStorage, Wallet
+from electrum_xmc import Wallet, open_storage
 
 Gdk.threads_init()
 APP_NAME = "Electrum"
@@ -1291,7 +1291,7 @@ class ElectrumGui():
 
     def main(self, url=None):
 
-        storage = WalletStorage(self.config.get_wallet_path())
+        storage = open_storage(self.config.get_wallet_path(), self.config)
         if not storage.file_exists:
             action = self.restore_or_create()
             if not action:
@@ -25,7 +25,7 @@ may be called from your php script.
 import socket, os
 from jsonrpclib.SimpleJSONRPCServer import SimpleJSONRPCServer, SimpleJSONRPCRequestHandler
 
-from electrum_xmc.wallet import WalletStorage, Wallet
+from electrum_xmc.wallet import Wallet, open_storage
 from electrum_xmc.commands import known_commands, Commands
 
 
@@ -48,7 +48,7 @@ class ElectrumGui:
     def __init__(self, config, network):
         self.network = network
         self.config = config
-        storage = WalletStorage(self.config.get_wallet_path())
+        storage = open_storage(self.config.get_wallet_path(), self.config)
         if not storage.file_exists:
             raise BaseException("Wallet not found")
         self.wallet = Wallet(storage)
@@ -37,7 +37,7 @@ import PyQt4.QtCore as QtCore
 from electrum_xmc.i18n import _, set_language
 from electrum_xmc.util import print_error, print_msg
 from electrum_xmc.plugins import run_hook, always_hook
-from electrum_xmc import WalletStorage, Wallet
+from electrum_xmc import Wallet, open_storage
 from electrum_xmc.bitcoin import MIN_RELAY_TX_FEE
 
 try:
@@ -174,7 +174,7 @@ class ElectrumGui:
             if os.path.exists(last_wallet):
                 self.config.cmdline_options['default_wallet_path'] = last_wallet
         try:
-            storage = WalletStorage(self.config.get_wallet_path())
+            storage = open_storage(self.config.get_wallet_path(), self.config)
         except BaseException as e:
             QMessageBox.warning(None, _('Warning'), str(e), _('OK'))
             self.config.set_key('gui_last_wallet', None)
@@ -41,7 +41,7 @@ from electrum_xmc.util import format_satoshis, format_satoshis_plain, format_tim
 from electrum_xmc import Transaction
 from electrum_xmc import mnemonic
 from electrum_xmc import util, bitcoin, commands, Wallet
-from electrum_xmc import SimpleConfig, Wallet, WalletStorage
+from electrum_xmc import SimpleConfig, Wallet, open_storage
 from electrum_xmc import Imported_Wallet
 from electrum_xmc import paymentrequest
 from electrum_xmc.contacts import Contacts
@@ -284,7 +284,7 @@ class ElectrumWindow(QMainWindow):
 
     def load_wallet_file(self, filename):
         try:
-            storage = WalletStorage(filename)
+            storage = open_storage(filename, self.config)
         except Exception as e:
             self.show_message(str(e))
             return
@@ -353,7 +353,7 @@ class ElectrumWindow(QMainWindow):
         if not filename:
             return
         full_path = os.path.join(wallet_folder, filename)
-        storage = WalletStorage(full_path)
+        storage = open_storage(full_path, self.config)
         if storage.file_exists:
             QMessageBox.critical(None, "Error", _("File exists"))
             return
@@ -1,7 +1,7 @@
 from decimal import Decimal
 _ = lambda x:x
 #from i18n import _
-from electrum_xmc.wallet import WalletStorage, Wallet
+from electrum_xmc.wallet import Wallet, open_storage
 from electrum_xmc.util import format_satoshis, set_verbosity, StoreDict
 from electrum_xmc.bitcoin import is_valid, COIN
 from electrum_xmc.network import filter_protocol
@@ -15,7 +15,7 @@ class ElectrumGui:
     def __init__(self, config, network):
         self.network = network
         self.config = config
-        storage = WalletStorage(config.get_wallet_path())
+        storage = open_storage(config.get_wallet_path(), config)
         if not storage.file_exists:
             print "Wallet not found. try 'electrum create'"
             exit()
@@ -5,7 +5,7 @@ from electrum_xmc.util import format_satoshis, set_verbosity
 from electrum_xmc.util import StoreDict
 from electrum_xmc.bitcoin import is_valid, COIN
 
-from electrum_xmc import Wallet, WalletStorage
+from electrum_xmc import Wallet, open_storage
 
 import tty, sys
 
@@ -16,7 +16,7 @@ class ElectrumGui:
 
         self.config = config
         self.network = network
-        storage = WalletStorage(config.get_wallet_path())
+        storage = open_storage(config.get_wallet_path(), config)
         if not storage.file_exists:
             print "Wallet not found. try 'electrum create'"
             exit()
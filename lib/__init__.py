@@ -1,6 +1,6 @@
 from version import ELECTRUM_VERSION
 from util import format_satoshis, print_msg, print_json, print_error, set_verbosity
-from wallet import WalletSynchronizer, WalletStorage
+from wallet import WalletSynchronizer, WalletStorage, SqliteWalletStorage, open_storage
 from wallet import Wallet, Imported_Wallet
 from network import Network, DEFAULT_SERVERS, DEFAULT_PORTS, pick_random_server
 from interface import Interface
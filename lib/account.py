@@ -76,23 +76,34 @@ class Account(object):
         return None
 
     def synchronize_sequence(self, wallet, for_change):
-        limit = wallet.gap_limit_for_change if for_change else wallet.gap_limit
-        while True:
-            addresses = self.get_addresses(for_change)
-            if len(addresses) < limit:
-                address = self.create_new_address(for_change)
-                wallet.add_address(address)
-                continue
-            if map( lambda a: wallet.address_is_old(a), addresses[-limit:] ) == limit*[False]:
-                break
-            else:
-                address = self.create_new_address(for_change)
-                wallet.add_address(address)
+        '''Create addresses until the last ones are a whole window of
+        addresses not in use'''
+        limit = wallet.get_lookahead(for_change)
+        addr_list = self.change_addresses if for_change else self.receiving_addresses
+        n = len(addr_list)
+        unused = 0
+        while unused < min(limit, n) and not wallet.is_address_in_use(addr_list[n - 1 - unused]):
+            unused += 1
+        for i in range(limit - unused):
+            address = self.create_new_address(for_change)
+            wallet.add_address(address)
 
     def synchronize(self, wallet):
         self.synchronize_sequence(wallet, False)
         self.synchronize_sequence(wallet, True)
 
+    def window_changed(self, wallet, addresses):
+        '''Whether synchronize_sequence looks at one of addresses'''
+        for for_change in [False, True]:
+            limit = wallet.get_lookahead(for_change)
+            addr_list = self.change_addresses if for_change else self.receiving_addresses
+            if len(addr_list) < limit:
+                return True
+            for address in addr_list[-limit:]:
+                if address in addresses:
+                    return True
+        return False
+
 
 class PendingAccount(Account):
     def __init__(self, v):
@@ -103,6 +114,9 @@ class PendingAccount(Account):
     def synchronize(self, wallet):
         return
 
+    def window_changed(self, wallet, addresses):
+        return False
+
     def get_addresses(self, is_change):
         return [] if is_change else [self.pending_address]
 
@@ -131,6 +145,9 @@ class ImportedAccount(Account):
     def synchronize(self, wallet):
         return
 
+    def window_changed(self, wallet, addresses):
+        return False
+
     def get_addresses(self, for_change):
         return [] if for_change else sorted(self.keypairs.keys())
 
@@ -18,10 +18,371 @@
 
 
 import os
+import sys
+import time
+import array
+import bisect
+import json
+import mmap
+import struct
+import threading
+import multiprocessing
+import Queue
+
 import util
 from bitcoin import *
 
 
+# hash index record of a header we have not hashed yet
+NULL_HASH = '\x00' * 32
+
+# header file record of a header we have not downloaded yet
+NULL_HEADER = '\x00' * 80
+
+# seconds after which a queued chunk that was not hashed is dropped
+CHUNK_HASH_TIMEOUT = 120
+
+
+# version, prev_block_hash, merkle_root, timestamp, bits, nonce
+HEADER_FORMAT = struct.Struct('<I32s32sIII')
+
+
+class Header(object):
+    """A block header decoded with a single struct.unpack.
+
+    Hashes are kept as raw bytes in their internal byte order.  get() and
+    item access return the fields like the header dicts sent by servers,
+    with hex encoded hashes, so a Header can be used in place of one.
+    """
+
+    __slots__ = ('version', 'raw_prev_hash', 'raw_merkle_root',
+                 'timestamp', 'bits', 'nonce', 'block_height')
+
+    def __init__(self, version, raw_prev_hash, raw_merkle_root, timestamp,
+                 bits, nonce, block_height=None):
+        self.version = version
+        self.raw_prev_hash = raw_prev_hash
+        self.raw_merkle_root = raw_merkle_root
+        self.timestamp = timestamp
+        self.bits = bits
+        self.nonce = nonce
+        self.block_height = block_height
+
+    @classmethod
+    def deserialize(klass, data, offset=0, block_height=None):
+        return klass(*HEADER_FORMAT.unpack_from(data, offset), block_height=block_height)
+
+    @classmethod
+    def from_dict(klass, d):
+        if isinstance(d, Header):
+            return d
+        return klass(d.get('version'),
+                     hash_decode(d.get('prev_block_hash')),
+                     hash_decode(d.get('merkle_root')),
+                     int(d.get('timestamp')),
+                     int(d.get('bits')),
+                     int(d.get('nonce')),
+                     d.get('block_height'))
+
+    def serialize(self):
+        return HEADER_FORMAT.pack(self.version, self.raw_prev_hash,
+                                  self.raw_merkle_root, self.timestamp,
+                                  self.bits, self.nonce)
+
+    def hash(self):
+        return PoWHash(self.serialize())
+
+    def get(self, key, default=None):
+        if key == 'prev_block_hash':
+            return hash_encode(self.raw_prev_hash)
+        if key == 'merkle_root':
+            return hash_encode(self.raw_merkle_root)
+        if key in ('version', 'timestamp', 'bits', 'nonce', 'block_height'):
+            value = getattr(self, key)
+            if value is not None:
+                return value
+        return default
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def as_dict(self):
+        d = {
+            'version': self.version,
+            'prev_block_hash': hash_encode(self.raw_prev_hash),
+            'merkle_root': hash_encode(self.raw_merkle_root),
+            'timestamp': self.timestamp,
+            'bits': self.bits,
+            'nonce': self.nonce,
+        }
+        if self.block_height is not None:
+            d['block_height'] = self.block_height
+        return d
+
+
+def read_checkpoints():
+    '''Return the checkpoints shipped with Electrum, a list of
+    [height, hash, bits] of the last header of each chunk.'''
+    path = os.path.join(os.path.dirname(__file__), 'checkpoints.json')
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except Exception as e:
+        util.print_error("[blockchain] cannot read checkpoints:", e)
+        return []
+
+
+def bits_to_target(bits):
+    '''Target of the compact representation bits'''
+    if bits & 0x800000:
+        # negative
+        return 0
+    exponent, mantissa = bits >> 24, bits & 0x7fffff
+    if exponent <= 3:
+        return mantissa >> (8 * (3 - exponent))
+    return mantissa << (8 * (exponent - 3))
+
+
+def check_proof_of_work(data, hashes):
+    '''True if the hash of each header in data is not above the target
+    of its bits.  Hashes are compared to targets as big-endian strings,
+    and a target is only computed once for each bits value.'''
+    targets = {}
+    for i in range(len(hashes) / 32):
+        bits = data[i*80+72:i*80+76]
+        target = targets.get(bits)
+        if target is None:
+            target = min(bits_to_target(struct.unpack('<I', bits)[0]), 2**256 - 1)
+            target = targets[bits] = ('%064x' % target).decode('hex')
+        if hashes[i*32:(i+1)*32][::-1] > target:
+            return False
+    return True
+
+
+def hash_chunk(args):
+    """Hash a chunk of serialized headers, checking that each header
+    links to the one before it.  This runs in the verification processes,
+    so it only takes and returns strings.  Returns the index, the raw
+    headers and their concatenated raw hashes, or None instead of the
+    headers if the chunk is not a chain or lacks proof of work.  It
+    never raises, as the pool would then drop the result."""
+    index, hexdata = args
+    try:
+        return hash_raw_chunk((index, hexdata.decode('hex')))
+    except Exception:
+        return index, None, None
+
+
+def hash_raw_chunk(args):
+    """hash_chunk() for a chunk that is not hex encoded"""
+    index, data = args
+    num = len(data) / 80
+    hashes = []
+    for i in range(num):
+        raw_header = data[i*80:(i+1)*80]
+        if i > 0 and raw_header[4:36] != hashes[-1]:
+            return index, None, None
+        hashes.append(PoWHash(raw_header))
+    hashes = ''.join(hashes)
+    if not check_proof_of_work(data, hashes):
+        return index, None, None
+    return index, data[:num*80], hashes
+
+
+class HeaderFile(object):
+    """File of fixed-size records indexed by height.
+
+    Reads are served from a read-only mmap of the file, which is only
+    remapped when a read goes past the end of the current mapping, so
+    looking up a record is a slice of the mapping.  Writes go through a
+    separate file object.
+    """
+
+    def __init__(self, path, record_size=80, readonly=False):
+        self.path = path
+        self.record_size = record_size
+        self.readonly = readonly
+        self.lock = threading.RLock()
+        self.map = None
+        self.map_size = 0
+        self.writer = None
+
+    def size(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def count(self):
+        return self.size() / self.record_size
+
+    def remap(self):
+        with self.lock:
+            size = self.size()
+            if self.map is not None and size == self.map_size:
+                return
+            self.close_map()
+            if size == 0:
+                return
+            with open(self.path, 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            self.map_size = size
+
+    def read(self, index, count=1):
+        '''Return count records starting at index as a single string, or
+        None if they are not all in the file.'''
+        if index < 0:
+            return None
+        start = index * self.record_size
+        end = start + count * self.record_size
+        with self.lock:
+            # another process may have truncated the file, and reading
+            # past its end through the mapping would crash
+            if end > self.map_size or self.readonly:
+                self.remap()
+                if end > self.map_size:
+                    return None
+            return self.map[start:end]
+
+    def write(self, index, data):
+        assert not self.readonly
+        assert len(data) % self.record_size == 0
+        with self.lock:
+            if self.writer is None:
+                if not os.path.exists(self.path):
+                    open(self.path, 'wb').close()
+                self.writer = open(self.path, 'rb+')
+            self.writer.seek(index * self.record_size)
+            self.writer.write(data)
+            self.writer.flush()
+
+    def sync(self):
+        with self.lock:
+            if self.writer is not None:
+                os.fsync(self.writer.fileno())
+
+    def truncate(self, count):
+        assert not self.readonly
+        with self.lock:
+            self.close_map()
+            with open(self.path, 'rb+') as f:
+                f.truncate(count * self.record_size)
+
+    def close_map(self):
+        if self.map is not None:
+            self.map.close()
+        self.map = None
+        self.map_size = 0
+
+    def close(self):
+        with self.lock:
+            self.close_map()
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
+
+
+class Fork(object):
+    """Headers of a branch of the chain that leaves the main headers file
+    at fork_height.  They are stored in a file of their own, indexed from
+    fork_height.  Forks are short, so their hashes are only cached in
+    memory.
+    """
+
+    def __init__(self, path, fork_height, readonly=False):
+        self.path = path
+        self.fork_height = fork_height
+        self.headers = HeaderFile(path, 80, readonly)
+        self.raw_hashes = {}
+
+    def name(self):
+        return os.path.basename(self.path)
+
+    def height(self):
+        return self.fork_height + self.headers.count() - 1
+
+    def read(self, height, count=1):
+        if height < self.fork_height:
+            return None
+        return self.headers.read(height - self.fork_height, count)
+
+    def write(self, height, data):
+        self.headers.write(height - self.fork_height, data)
+        for i in range(len(data) / 80):
+            self.raw_hashes.pop(height + i, None)
+
+    def get_raw_hash(self, height):
+        raw_hash = self.raw_hashes.get(height)
+        if raw_hash is None:
+            header = self.read(height)
+            if header is None:
+                return None
+            raw_hash = self.raw_hashes[height] = PoWHash(header)
+        return raw_hash
+
+    def get_height(self, raw_hash):
+        for height in range(self.fork_height, self.height() + 1):
+            if self.get_raw_hash(height) == raw_hash:
+                return height
+
+    def close(self):
+        self.headers.close()
+
+
+class HeaderReader(object):
+    """Read-only access to the headers saved by the Blockchain of the
+    daemon, for the processes that talk to it.  The branch to follow is
+    read again from the forks directory whenever the daemon changes it.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.headers = HeaderFile(os.path.join(config.path, 'blockchain_headers'), 80, readonly=True)
+        self.fork = None
+        self.fork_stat = None
+        self.lock = threading.Lock()
+
+    def active_fork(self):
+        path = os.path.join(self.config.path, 'forks', 'active')
+        try:
+            st = os.stat(path)
+            fork_stat = st.st_ino, st.st_mtime, st.st_size
+        except OSError:
+            fork_stat = None
+        if fork_stat != self.fork_stat:
+            if self.fork is not None:
+                self.fork.close()
+            self.fork = None
+            try:
+                with open(path, 'r') as f:
+                    name = f.read().strip()
+                fork_height = int(name.split('_')[1])
+                self.fork = Fork(os.path.join(self.config.path, 'forks', name), fork_height, readonly=True)
+            except (IOError, ValueError, IndexError):
+                pass
+            self.fork_stat = fork_stat
+        return self.fork
+
+    def read_header(self, block_height):
+        with self.lock:
+            fork = self.active_fork()
+            if fork is not None and block_height >= fork.fork_height:
+                h = fork.read(block_height)
+            else:
+                h = self.headers.read(block_height)
+        if h is not None and h != NULL_HEADER:
+            return Header.deserialize(h, block_height=block_height)
+
+    def close(self):
+        with self.lock:
+            self.headers.close()
+            if self.fork is not None:
+                self.fork.close()
+
+
 class Blockchain():
     '''Manages blockchain headers and their verification'''
     def __init__(self, config, network):
@@ -30,7 +391,31 @@ class Blockchain():
         # TODO headers bootstrap
         self.headers_url = ''#https://headers.electrum.org/blockchain_headers'
         self.local_height = 0
+        self.headers = HeaderFile(self.path(), 80)
+        # hash of each header, at the same height as in the header file
+        self.hashes = HeaderFile(self.hashes_path(), 32)
+        # reverse of the hash index, built when first needed
+        self.heights_by_hash = None
+        # timestamp of each header, and their running maximum by height
+        self.times = HeaderFile(self.times_path(), 4)
+        self.max_times = None
+        # competing branches, by file name, and the one we follow
+        self.forks = {}
+        self.active_fork = None
+        self.load_forks()
+        self.set_checkpoints(read_checkpoints())
         self.set_local_height()
+        # chunk verification: index -> height reached with the chunk
+        self.queued_chunks = {}
+        # index -> time the chunk was queued
+        self.queue_times = {}
+        # (index, data, hashes) tuples from the verification processes
+        self.hashed_chunks = Queue.Queue()
+        # index -> (data, hashes) of hashed chunks waiting to connect
+        self.hashed = {}
+        # index -> bits of the headers of the chunk
+        self.retarget_bits = {}
+        self.pool = None
 
     def print_error(self, *msg):
         util.print_error("[blockchain]", *msg)
@@ -40,100 +425,358 @@ class Blockchain():
 
     def init(self):
         self.init_headers_file()
+        self.update_time_index()
         self.set_local_height()
         self.print_error("%d blocks" % self.local_height)
+        self.start_pool()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+        self.headers.close()
+        self.hashes.close()
+        self.times.close()
+        for fork in self.forks.values():
+            fork.close()
+
+    def set_checkpoints(self, checkpoints):
+        '''Chunks up to the last checkpoint are not downloaded until a
+        header in them is needed, and are then verified against the
+        checkpoint instead of the chain before them.'''
+        self.checkpoints = checkpoints
+        # height -> raw hash
+        self.checkpoint_hashes = {}
+        for index, (height, block_hash, bits) in enumerate(checkpoints):
+            assert height == index*2016 + 2015
+            self.checkpoint_hashes[height] = hash_decode(block_hash)
+
+    def checkpoint_height(self):
+        return self.checkpoints[-1][0] if self.checkpoints else -1
+
+    def get_checkpoints(self):
+        '''Checkpoints of the complete chunks of our chain'''
+        checkpoints = []
+        for index in range((self.local_height + 1) / 2016):
+            height = index*2016 + 2015
+            header = self.read_header(height)
+            if header is None:
+                break
+            checkpoints.append([height, self.get_hash(height), header.bits])
+        return checkpoints
 
     def verify_chain(self, chain):
         first_header = chain[0]
-        prev_header = self.read_header(first_header.get('block_height') -1)
+        prev_hash = self.get_raw_hash(first_header.block_height - 1)
 
         for header in chain:
-            height = header.get('block_height')
-            prev_hash = self.hash_header(prev_header)
-            if prev_hash != header.get('prev_block_hash'):
+            height = header.block_height
+            if prev_hash != header.raw_prev_hash:
                 self.print_error("prev hash mismatch: %s vs %s"
-                                 % (prev_hash, header.get('prev_block_hash')))
+                                 % (hash_encode(prev_hash), header.get('prev_block_hash')))
+                return False
+            data = header.serialize()
+            prev_hash = PoWHash(data)
+            if not check_proof_of_work(data, prev_hash):
+                self.print_error("insufficient proof of work at height", height)
+                return False
+            if not self.check_bits(height, data):
+                self.print_error("bits mismatch at height", height)
                 return False
 
-            # TODO PoW difficulty calculation #
-
-#            bits, target = self.get_target(height/2016, chain)
-#            if bits != header.get('bits'):
-#                self.print_error("bits mismatch: %s vs %s"
-#                                 % (bits, header.get('bits')))
-#                return False
-#            _hash = self.hash_header(header)
-#            if int('0x'+_hash, 16) > target:
-#                self.print_error("insufficient proof of work: %s vs target %s"
-#                                 % (int('0x'+_hash, 16), target))
-#                return False
+        return True
 
-            prev_header = header
+    def get_bits(self, index):
+        '''Bits of the headers of chunk index, or None if we do not have
+        the chunk before it'''
+        if index == 0:
+            return None
+        bits = self.retarget_bits.get(index)
+        if bits is None:
+            if self.read_header((index-1)*2016) is None or self.read_header(index*2016 - 1) is None:
+                return None
+            bits = self.retarget_bits[index] = self.get_target(index)[0]
+        return bits
 
+    def check_bits(self, height, data):
+        '''Check that headers from height carry the bits of their retarget
+        window.  A window shares one value, so the bits fields of all the
+        headers of a window are compared to it at once.  This follows the
+        retarget rule of get_target, and is only done with verify_retarget
+        set.'''
+        if not self.config.get('verify_retarget', False):
+            return True
+        num = len(data) / 80
+        i = 0
+        while i < num:
+            index = (height + i) / 2016
+            n = min(num - i, (index + 1)*2016 - height - i)
+            bits = self.get_bits(index)
+            if bits is not None:
+                fields = ''.join(data[j*80+72:j*80+76] for j in range(i, i + n))
+                if fields != struct.pack('<I', bits) * n:
+                    return False
+            i += n
         return True
 
 
 
     def verify_chunk(self, index, hexdata):
-        data = hexdata.decode('hex')
-        height = index*2016
-        num = len(data)/80
+        index, data, hashes = hash_chunk((index, hexdata))
+        if data is None:
+            raise BaseException("chunk %d is not a valid chain" % index)
+        self.connect_hashed_chunk(index, data, hashes)
 
-        if index == 0:
-            previous_hash = ("0"*64)
-        else:
-            prev_header = self.read_header(index*2016-1)
-            if prev_header is None: raise
-            previous_hash = self.hash_header(prev_header)
+    def connect_hashed_chunk(self, index, data, hashes):
+        self.check_hashed_chunk(index, data, hashes, self.get_raw_hash(index*2016 - 1))
+        # the server's chain is longer than ours, so follow it even if
+        # the chunk starts a fork shorter than our chain
+        self.save_branch(index*2016, data, hashes, activate=True)
+        self.print_error("validated chunk %d to height %d" % (index, index*2016 + len(data)/80 - 1))
 
-        #bits, target = self.get_target(index)
+    def check_hashed_chunk(self, index, data, hashes, previous_hash):
+        if previous_hash is None:
+            raise BaseException("missing header %d" % (index*2016 - 1))
+        if previous_hash != data[4:36]:
+            raise BaseException("chunk %d does not connect" % index)
+        checkpoint = self.checkpoint_hashes.get(index*2016 + 2015)
+        if checkpoint is not None and (len(data) != 2016*80 or hashes[-32:] != checkpoint):
+            raise BaseException("chunk %d does not match checkpoint" % index)
+        if not self.check_bits(index*2016, data):
+            raise BaseException("chunk %d has wrong bits" % index)
 
-        for i in range(num):
-            height = index*2016 + i
-            raw_header = data[i*80:(i+1)*80]
-            header = self.header_from_string(raw_header)
-            _hash = self.hash_header(header)
-            assert previous_hash == header.get('prev_block_hash')
-            #assert bits == header.get('bits')
-            #assert int('0x'+_hash,16) < target
+    def import_headers(self, path, block_chunks=50):
+        '''Add the headers of a copy of a headers file to our chain.
+        The file is read block_chunks chunks at a time.  The chunks of a
+        block are hashed in the verification processes, and the block is
+        only written once all of them connect.  Chunks we already have
+        are skipped.  Returns the number of headers written.'''
+        count = 0
+        index = 0
+        with open(path, 'rb') as f:
+            while True:
+                block = f.read(block_chunks * 2016 * 80)
+                if len(block) < 80:
+                    break
+                chunks = []
+                for i in range(0, len(block), 2016 * 80):
+                    data = block[i:i + 2016*80]
+                    num = len(data) / 80
+                    if self.read_raw(index*2016, num) != data[:num*80]:
+                        chunks.append((index, data))
+                    index += 1
+                if self.pool is not None:
+                    hashed = self.pool.map(hash_raw_chunk, chunks)
+                else:
+                    hashed = map(hash_raw_chunk, chunks)
+                previous_index, previous_hash = None, None
+                for i, data, hashes in hashed:
+                    if data is None:
+                        raise BaseException("chunk %d is not a valid chain" % i)
+                    if previous_index is None or i != previous_index + 1:
+                        previous_hash = self.get_raw_hash(i*2016 - 1)
+                    self.check_hashed_chunk(i, data, hashes, previous_hash)
+                    previous_index, previous_hash = i, hashes[-32:]
+                for i, data, hashes in hashed:
+                    self.save_branch(i*2016, data, hashes, activate=True)
+                    count += len(data) / 80
+                self.headers.sync()
+                self.hashes.sync()
+                if hashed:
+                    self.print_error("imported headers to height %d" % (previous_index*2016 + len(data)/80 - 1))
+        return count
+
+    def export_headers(self, path):
+        '''Write the headers of our chain to path, from the genesis
+        block up to the first one we have not downloaded.  Returns the
+        number of headers written.'''
+        count = 0
+        temp_path = "%s.tmp.%s" % (path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            for index in range((self.local_height + 2016) / 2016):
+                num = min(2016, self.local_height + 1 - index*2016)
+                data = self.read_raw(index*2016, num)
+                if data is None or data[:80] == NULL_HEADER:
+                    break
+                f.write(data)
+                count += num
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            os.rename(temp_path, path)
+        except:
+            os.remove(path)
+            os.rename(temp_path, path)
+        return count
 
-            previous_header = header
-            previous_hash = _hash
+    def start_pool(self):
+        # Frozen Windows builds cannot spawn the worker processes reliably
+        if getattr(sys, 'frozen', False) or sys.platform == 'win32':
+            default = 1
+        else:
+            default = multiprocessing.cpu_count()
+        n = self.config.get('verify_processes', default)
+        if n > 1:
+            try:
+                self.pool = multiprocessing.Pool(n)
+            except Exception as e:
+                # e.g. no semaphore support on this platform
+                self.print_error("cannot start verification processes:", e)
+                self.pool = None
 
-        self.save_chunk(index, data)
-        self.print_error("validated chunk %d to height %d" % (index, height))
+    def queue_chunk(self, index, hexdata):
+        '''Hash a chunk in the verification processes.  It is saved by
+        connect_chunks() once every chunk before it is connected.'''
+        self.queued_chunks[index] = index*2016 + len(hexdata)/160 - 1
+        self.queue_times[index] = time.time()
+        if self.pool is not None:
+            self.pool.apply_async(hash_chunk, ((index, hexdata),), callback=self.hashed_chunks.put)
+        else:
+            self.hashed_chunks.put(hash_chunk((index, hexdata)))
 
+    def pending_height(self):
+        '''Height we will be at once the queued chunks are connected'''
+        return max([self.local_height] + self.queued_chunks.values())
 
+    def connect_chunks(self):
+        '''Connect the chunks that have been hashed, in order of index.
+        Chunks that do not connect are dropped with everything queued
+        after them, unless they were checked against a checkpoint.
+        Returns a list of (index, success) pairs.'''
+        while True:
+            try:
+                index, data, hashes = self.hashed_chunks.get_nowait()
+            except Queue.Empty:
+                break
+            if index in self.queued_chunks:
+                self.hashed[index] = data, hashes
+        # a chunk whose worker died never comes back; it is downloaded again
+        now = time.time()
+        for index, queue_time in self.queue_times.items():
+            if now - queue_time > CHUNK_HASH_TIMEOUT and index not in self.hashed:
+                self.print_error("chunk %d was not hashed in time" % index)
+                self.queued_chunks.pop(index, None)
+                self.queue_times.pop(index)
+        out = []
+        while self.hashed:
+            index = min(self.hashed)
+            if index*2016 > self.local_height + 1:
+                # wait for the chunks before it
+                break
+            data, hashes = self.hashed.pop(index)
+            self.queued_chunks.pop(index)
+            self.queue_times.pop(index, None)
+            try:
+                if data is None:
+                    raise BaseException("chunk %d is not a valid chain" % index)
+                self.connect_hashed_chunk(index, data, hashes)
+                out.append((index, True))
+            except BaseException as e:
+                self.print_error('verify_chunk failed:', e)
+                out.append((index, False))
+                if index < len(self.checkpoints):
+                    continue
+                for i in self.queued_chunks.keys():
+                    if i > index:
+                        self.queued_chunks.pop(i)
+                        self.queue_times.pop(i, None)
+                        self.hashed.pop(i, None)
+        return out
 
     def header_to_string(self, res):
-        s = int_to_hex(res.get('version'),4) \
-            + rev_hex(res.get('prev_block_hash')) \
-            + rev_hex(res.get('merkle_root')) \
-            + int_to_hex(int(res.get('timestamp')),4) \
-            + int_to_hex(int(res.get('bits')),4) \
-            + int_to_hex(int(res.get('nonce')),4)
-        return s
-
+        return Header.from_dict(res).serialize().encode('hex')
 
     def header_from_string(self, s):
-        hex_to_int = lambda s: int('0x' + s[::-1].encode('hex'), 16)
-        h = {}
-        h['version'] = hex_to_int(s[0:4])
-        h['prev_block_hash'] = hash_encode(s[4:36])
-        h['merkle_root'] = hash_encode(s[36:68])
-        h['timestamp'] = hex_to_int(s[68:72])
-        h['bits'] = hex_to_int(s[72:76])
-        h['nonce'] = hex_to_int(s[76:80])
-        return h
+        return Header.deserialize(s).as_dict()
 
     def hash_header(self, header):
-        return rev_hex(PoWHash(self.header_to_string(header).decode('hex')).encode('hex'))
+        return hash_encode(Header.from_dict(header).hash())
+
+    def get_raw_hash(self, height):
+        '''Return the raw hash of the header at height, or None if we do
+        not have that header.  Hashes are read from the hash index, and
+        only computed for headers that are missing from it.  Headers we
+        have not downloaded are known by hash at checkpoints.'''
+        if height < 0:
+            return NULL_HASH
+        fork = self.active_fork
+        if fork is not None and height >= fork.fork_height:
+            return fork.get_raw_hash(height)
+        raw_hash = self.hashes.read(height)
+        if raw_hash is not None and raw_hash != NULL_HASH:
+            return raw_hash
+        header = self.read_raw(height)
+        if header is None or header == NULL_HEADER:
+            return self.checkpoint_hashes.get(height)
+        raw_hash = PoWHash(header)
+        self.save_hashes(height, raw_hash)
+        return raw_hash
+
+    def get_hash(self, height):
+        raw_hash = self.get_raw_hash(height)
+        if raw_hash is not None:
+            return hash_encode(raw_hash)
+
+    def get_height(self, block_hash):
+        '''Return the height of the header with hash block_hash in our
+        chain, or None.  The reverse index is built on first use.'''
+        if self.heights_by_hash is None:
+            self.heights_by_hash = {}
+            data = self.hashes.read(0, self.hashes.count()) or ''
+            for height in range(len(data) / 32):
+                raw_hash = data[height*32:(height+1)*32]
+                if raw_hash != NULL_HASH:
+                    self.heights_by_hash[raw_hash] = height
+        raw_hash = hash_decode(block_hash)
+        height = self.heights_by_hash.get(raw_hash)
+        fork = self.active_fork
+        if fork is not None:
+            if height is not None and height >= fork.fork_height:
+                height = None
+            if height is None:
+                height = fork.get_height(raw_hash)
+        return height
 
     def path(self):
         return os.path.join(self.config.path, 'blockchain_headers')
 
+    def hashes_path(self):
+        return os.path.join(self.config.path, 'blockchain_hashes')
+
+    def times_path(self):
+        return os.path.join(self.config.path, 'blockchain_times')
+
+    def forks_path(self):
+        return os.path.join(self.config.path, 'forks')
+
+    def load_forks(self):
+        path = self.forks_path()
+        if not os.path.exists(path):
+            return
+        for name in os.listdir(path):
+            if name.startswith('fork_'):
+                fork_height = int(name.split('_')[1])
+                self.forks[name] = Fork(os.path.join(path, name), fork_height)
+        try:
+            with open(os.path.join(path, 'active'), 'r') as f:
+                self.active_fork = self.forks.get(f.read().strip())
+        except IOError:
+            pass
+
     def init_headers_file(self):
+        for path in [self.hashes_path(), self.times_path()]:
+            if not os.path.exists(path):
+                open(path, 'wb+').close()
         filename = self.path()
+        if self.checkpoints:
+            # Start from the last checkpoint.  The headers before it
+            # are left as a hole in the file, and filled in by chunk
+            # when needed.
+            size = (self.checkpoint_height() + 1) * 80
+            if self.headers.size() < size:
+                with open(filename, 'ab') as f:
+                    f.truncate(size)
+            return
         if os.path.exists(filename):
             return
         try:
@@ -146,42 +789,228 @@ class Blockchain():
             self.print_error( "download failed. creating file", filename )
             open(filename,'wb+').close()
 
-    def save_chunk(self, index, chunk):
-        filename = self.path()
-        f = open(filename,'rb+')
-        f.seek(index*2016*80)
-        h = f.write(chunk)
-        f.close()
-        self.set_local_height()
+    def save_chunk(self, index, chunk, hashes):
+        self.write_active(index*2016, chunk, hashes)
 
     def save_header(self, header):
-        data = self.header_to_string(header).decode('hex')
-        assert len(data) == 80
-        height = header.get('block_height')
-        filename = self.path()
-        f = open(filename,'rb+')
-        f.seek(height*80)
-        h = f.write(data)
-        f.close()
+        header = Header.from_dict(header)
+        data = header.serialize()
+        self.write_active(header.block_height, data, PoWHash(data))
+
+    def write_active(self, height, data, hashes):
+        '''Write headers at height on the branch we follow'''
+        fork = self.active_fork
+        if fork is not None and height + len(data) / 80 > fork.fork_height:
+            n = max(0, fork.fork_height - height)
+            fork.write(height + n, data[n*80:])
+            data, hashes = data[:n*80], hashes[:n*32]
+        else:
+            self.times_updated(height)
+        if data:
+            self.write_main(height, data, hashes)
         self.set_local_height()
 
+    def write_main(self, height, data, hashes):
+        self.headers.write(height, data)
+        self.save_hashes(height, hashes)
+        self.times.write(height, ''.join(data[i+68:i+72] for i in range(0, len(data), 80)))
+        self.times_updated(height)
+
+    def save_branch(self, height, data, hashes, activate=False):
+        '''Save verified headers that connect to our chain at height - 1.
+        Headers that differ from ours are not written over them: they
+        start a fork, and the longest branch becomes the one we follow,
+        or the new one if activate is set.  Switching branches only
+        changes which file headers are read from.'''
+        num = len(data) / 80
+        for i in range(num):
+            old = self.read_raw(height + i)
+            if old is not None and old != NULL_HEADER and old != data[i*80:(i+1)*80]:
+                break
+        else:
+            self.write_active(height, data, hashes)
+            return
+        fork_height = height + i
+        fork = self.active_fork
+        if fork is not None and fork_height > fork.fork_height:
+            # a branch of the active fork is stored as a fork of the
+            # main file, from where the active fork leaves it
+            start = fork.fork_height
+            data = fork.read(start, fork_height - start) + data[i*80:]
+        else:
+            start = fork_height
+            data = data[i*80:]
+        # skip the headers that the main file has
+        while data and self.headers.read(start) == data[:80]:
+            start += 1
+            data = data[80:]
+        if data and start == self.headers.count():
+            # an extension of the main file
+            self.write_main(start, data, ''.join(PoWHash(data[i:i+80]) for i in range(0, len(data), 80)))
+            branch = None
+        elif data:
+            branch = self.new_fork(start, data)
+        else:
+            branch = None
+        branch_height = branch.height() if branch else self.headers.count() - 1
+        if activate or branch_height > self.local_height:
+            self.set_active_fork(branch)
+        self.prune_forks()
+
+    def new_fork(self, fork_height, data):
+        name = 'fork_%d_%s' % (fork_height, PoWHash(data[:80]).encode('hex')[:16])
+        fork = self.forks.pop(name, None)
+        if fork is not None:
+            fork.close()
+            os.remove(fork.path)
+        if not os.path.exists(self.forks_path()):
+            os.mkdir(self.forks_path())
+        fork = Fork(os.path.join(self.forks_path(), name), fork_height)
+        fork.write(fork_height, data)
+        self.forks[name] = fork
+        self.print_error("new fork at height %d to height %d" % (fork_height, fork.height()))
+        return fork
+
+    def set_active_fork(self, fork, reorg=True):
+        '''Follow fork, or the main chain if fork is None.  Unless reorg
+        is False, because the headers we follow stay the same, the network
+        is told the height from which they changed.'''
+        if fork is self.active_fork:
+            return
+        old_fork = self.active_fork
+        self.active_fork = fork
+        self.max_times = None
+        path = os.path.join(self.forks_path(), 'active')
+        if fork is not None:
+            temp_path = path + '.tmp'
+            with open(temp_path, 'w') as f:
+                f.write(fork.name())
+            try:
+                os.rename(temp_path, path)
+            except:
+                os.remove(path)
+                os.rename(temp_path, path)
+        elif os.path.exists(path):
+            os.remove(path)
+        self.retarget_bits = {}
+        self.set_local_height()
+        self.print_error("following", fork.name() if fork else "main chain", "at height", self.local_height)
+        heights = [f.fork_height for f in [old_fork, fork] if f is not None]
+        if reorg and self.network is not None:
+            self.network.on_reorg(min(heights))
+
+    def prune_forks(self):
+        '''Delete the forks that fell behind, and move the active fork
+        into the main file once it is deep enough that we will not
+        switch back.'''
+        fork = self.active_fork
+        if fork is not None and fork.fork_height < self.local_height - 2 * 2016:
+            self.print_error("merging", fork.name(), "into the main chain")
+            data = fork.read(fork.fork_height, fork.height() - fork.fork_height + 1)
+            hashes = ''.join(fork.get_raw_hash(h) for h in range(fork.fork_height, fork.height() + 1))
+            self.write_main(fork.fork_height, data, hashes)
+            self.headers.truncate(fork.height() + 1)
+            self.hashes.truncate(fork.height() + 1)
+            self.times.truncate(fork.height() + 1)
+            self.heights_by_hash = None
+            self.set_active_fork(None, False)
+            self.forks.pop(fork.name())
+            fork.close()
+            os.remove(fork.path)
+        for name, fork in self.forks.items():
+            if fork is not self.active_fork and fork.height() < self.local_height - 2016:
+                self.print_error("removing", name)
+                self.forks.pop(name)
+                fork.close()
+                os.remove(fork.path)
+
+    def save_hashes(self, height, hashes):
+        if self.heights_by_hash is not None:
+            old = self.hashes.read(height, len(hashes) / 32) or ''
+            for i in range(len(old) / 32):
+                self.heights_by_hash.pop(old[i*32:(i+1)*32], None)
+            for i in range(len(hashes) / 32):
+                self.heights_by_hash[hashes[i*32:(i+1)*32]] = height + i
+        self.hashes.write(height, hashes)
+
     def set_local_height(self):
-        name = self.path()
-        if os.path.exists(name):
-            h = os.path.getsize(name)/80 - 1
+        if self.active_fork is not None:
+            self.local_height = self.active_fork.height()
+        elif os.path.exists(self.path()):
+            h = self.headers.count() - 1
             if self.local_height != h:
                 self.local_height = h
 
+    def read_raw(self, height, count=1):
+        '''Serialized headers of the branch we follow'''
+        fork = self.active_fork
+        if fork is None or height + count <= fork.fork_height:
+            return self.headers.read(height, count)
+        if height >= fork.fork_height:
+            return fork.read(height, count)
+        n = fork.fork_height - height
+        a = self.headers.read(height, n)
+        b = fork.read(fork.fork_height, count - n)
+        if a is not None and b is not None:
+            return a + b
+
+    def update_time_index(self):
+        '''Add the timestamps of headers that were saved before the
+        time index existed'''
+        count = self.headers.count()
+        for height in range(self.times.count(), count, 20160):
+            data = self.headers.read(height, min(20160, count - height))
+            self.times.write(height, ''.join(data[i+68:i+72] for i in range(0, len(data), 80)))
+
+    def times_updated(self, height):
+        if self.max_times is not None and height < len(self.max_times):
+            del self.max_times[height:]
+
+    def read_times(self, height, count):
+        '''Timestamps of count headers of our chain from height, packed
+        as 4 byte integers, zero where we do not have the header'''
+        fork = self.active_fork
+        n = count if fork is None else max(0, min(count, fork.fork_height - height))
+        m = max(0, min(n, self.times.count() - height))
+        out = (self.times.read(height, m) if m else '') + '\0' * 4 * (n - m)
+        for h in range(height + n, height + count):
+            header = fork.read(h)
+            out += header[68:72] if header else '\0' * 4
+        return out
+
+    def get_max_times(self):
+        '''Running maximum of the timestamps of our chain, by height.
+        It is extended from the time index as the chain grows.'''
+        if self.max_times is None:
+            self.max_times = array.array('I')
+        max_times = self.max_times
+        n = len(max_times)
+        if n < self.local_height + 1:
+            count = self.local_height + 1 - n
+            last = max_times[-1] if n else 0
+            for t in struct.unpack('<%dI' % count, self.read_times(n, count)):
+                if t > last:
+                    last = t
+                max_times.append(last)
+        return max_times
+
+    def time_at_height(self, height):
+        '''Timestamp of the header at height, or None'''
+        if 0 <= height <= self.local_height:
+            t = struct.unpack('<I', self.read_times(height, 1))[0]
+            if t:
+                return t
+
+    def height_at_time(self, timestamp):
+        '''Height of the last block of our chain that was mined by
+        timestamp: neither that block nor any block before it has a
+        later timestamp.  -1 if timestamp is before the genesis block.'''
+        return bisect.bisect_right(self.get_max_times(), timestamp) - 1
+
     def read_header(self, block_height):
-        name = self.path()
-        if os.path.exists(name):
-            f = open(name,'rb')
-            f.seek(block_height*80)
-            h = f.read(80)
-            f.close()
-            if len(h) == 80:
-                h = self.header_from_string(h)
-                return h
+        h = self.read_raw(block_height)
+        if h is not None and h != NULL_HEADER:
+            return Header.deserialize(h, block_height=block_height)
 
     def get_target(self, index, chain=None):
         if chain is None:
@@ -230,21 +1059,22 @@ class Blockchain():
 
     def connect_header(self, chain, header):
         '''Builds a header chain until it connects.  Returns True if it has
-        successfully connected, False if verification failed, otherwise the
-        height of the next header needed.'''
+        successfully connected, False if verification failed, None if the
+        header is on another branch than ours, otherwise the height of the
+        next header needed.'''
+        header = Header.from_dict(header)
         chain.append(header)  # Ordered by decreasing height
-        previous_height = header['block_height'] - 1
-        previous_header = self.read_header(previous_height)
+        previous_height = header.block_height - 1
+        prev_hash = self.get_raw_hash(previous_height)
 
         # Missing header, request it
-        if not previous_header:
+        if prev_hash is None:
             return previous_height
 
         # Does it connect to my chain?
-        prev_hash = self.hash_header(previous_header)
-        if prev_hash != header.get('prev_block_hash'):
+        if prev_hash != header.raw_prev_hash:
             self.print_error("reorg")
-            return previous_height
+            return None
 
         # The chain is complete.  Reverse to order by increasing height
         chain.reverse()
@@ -256,6 +1086,20 @@ class Blockchain():
 
         return False
 
+    def connect_fork(self, height, data):
+        '''Add serialized headers of another branch, from height, where
+        it leaves our chain.'''
+        if height <= self.checkpoint_height():
+            raise BaseException("fork below checkpoint at height %d" % height)
+        height, data, hashes = hash_raw_chunk((height, data))
+        if not data:
+            raise BaseException("fork at height %d is not a valid chain" % height)
+        if data[4:36] != self.get_raw_hash(height - 1):
+            raise BaseException("fork at height %d does not connect" % height)
+        if not self.check_bits(height, data):
+            raise BaseException("fork at height %d has wrong bits" % height)
+        self.save_branch(height, data, hashes)
+
     def connect_chunk(self, idx, chunk):
         try:
             self.verify_chunk(idx, chunk)
@@ -710,7 +710,7 @@ def add_network_options(parser):
 from util import profiler
 
 @profiler
-def get_parser(run_gui, run_daemon, run_cmdline):
+def get_parser(run_gui, run_daemon, run_cmdline, run_headers):
     # parent parser, because set_default_subparser removes global options
     parent_parser = argparse.ArgumentParser('parent', add_help=False)
     group = parent_parser.add_argument_group('global options')
@@ -736,6 +736,12 @@ def get_parser(run_gui, run_daemon, run_cmdline):
     parser_daemon.add_argument("subcommand", choices=['start', 'status', 'stop'])
     parser_daemon.set_defaults(func=run_daemon)
     add_network_options(parser_daemon)
+    # headers
+    parser_headers = subparsers.add_parser('headers', parents=[parent_parser], description="Import block headers from a copy of a blockchain_headers file, or export them to one. The daemon must not be running.", help="Import or export block headers")
+    parser_headers.add_argument("subcommand", choices=['import', 'export'])
+    parser_headers.add_argument("filename", help="headers file")
+    parser_headers.add_argument("-j", "--processes", dest="verify_processes", type=int, default=None, help="number of processes verifying headers")
+    parser_headers.set_defaults(func=run_headers)
     # commands
     for cmdname in sorted(known_commands.keys()):
         cmd = known_commands[cmdname]
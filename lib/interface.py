@@ -235,22 +235,29 @@ class TcpInterface(threading.Thread):
         self.request_queue.put((copy.deepcopy(request), response_queue))
 
     def send_requests(self):
-        '''Sends all queued requests'''
-        while self.is_connected() and not self.request_queue.empty():
+        '''Sends all queued requests, in a single write'''
+        if not self.is_connected():
+            return
+        requests = []
+        while not self.request_queue.empty():
             request, response_queue = self.request_queue.get()
             method = request.get('method')
             params = request.get('params')
             r = {'id': self.message_id, 'method': method, 'params': params}
-            try:
-                self.pipe.send(r)
-            except socket.error, e:
-                self.print_error("socket error:", e)
-                self.stop()
-                return
-            if self.debug:
-                self.print_error("-->", r)
+            requests.append(r)
             self.unanswered_requests[self.message_id] = method, params, request.get('id'), response_queue
             self.message_id += 1
+        if not requests:
+            return
+        try:
+            self.pipe.send_all(requests)
+        except socket.error, e:
+            self.print_error("socket error:", e)
+            self.stop()
+            return
+        if self.debug:
+            for r in requests:
+                self.print_error("-->", r)
 
     def is_connected(self):
         '''True if status is connected'''
@@ -24,6 +24,25 @@ DEFAULT_SERVERS = {
 NODES_RETRY_INTERVAL = 60
 SERVER_RETRY_INTERVAL = 10
 
+# chunk downloads: requests in flight per server, number of chunks ahead
+# of our height we download, and seconds before a request times out
+CHUNK_REQUESTS_PER_SERVER = 4
+CHUNK_WINDOW = 32
+CHUNK_TIMEOUT = 20
+
+# requests whose answers the wallet checks, and that can be sent to any
+# server when 'spread_requests' is set
+SPREAD_METHODS = ['blockchain.address.get_history', 'blockchain.transaction.get']
+
+
+def history_status(history):
+    '''Status of a history sent by blockchain.address.get_history, as
+    announced by address subscriptions'''
+    if not history:
+        return None
+    status = ''.join(item['tx_hash'] + ':%d:' % item['height'] for item in history)
+    return sha256(status).encode('hex')
+
 
 def parse_servers(result):
     """ parse servers list into dict format"""
@@ -131,6 +150,14 @@ class Network(util.DaemonThread):
         self.response_queue = pipe.get_queue
         # A deque of interface header requests, processed left-to-right
         self.bc_requests = deque()
+        # Chunk requests in flight: index -> (interface, request time)
+        self.chunk_requests = {}
+        # Interface that sent each chunk being verified: index -> interface
+        self.chunk_sources = {}
+        # Chunks below the last checkpoint that were asked for
+        self.fill_chunks = set()
+        # Index to download chunks from after one did not connect
+        self.chunk_rewind = None
         # Server for addresses and transactions
         self.default_server = self.config.get('server')
         # Sanitize default server
@@ -160,6 +187,9 @@ class Network(util.DaemonThread):
         self.addr_responses = {}
         # unanswered requests
         self.unanswered_requests = {}
+        # id -> interface, of the requests not sent to the main interface
+        self.spread_requests = {}
+        self.spread_count = 0
         # retry times
         self.server_retry_time = time.time()
         self.nodes_retry_time = time.time()
@@ -246,6 +276,11 @@ class Network(util.DaemonThread):
         value = self.get_status_value(key)
         self.response_queue.put({'method':'network.status', 'params':[key, value]})
 
+    def on_reorg(self, height):
+        '''Called by the blockchain when the branch we follow changed
+        from height'''
+        self.response_queue.put({'method':'network.status', 'params':['reorg', height]})
+
     def get_parameters(self):
         host, port, protocol = deserialize_server(self.default_server)
         return host, port, protocol, self.proxy, self.auto_connect
@@ -392,6 +427,12 @@ class Network(util.DaemonThread):
         else:
             self.interfaces.pop(i.server, None)
             self.heights.pop(i.server, None)
+            # send its requests to the main server
+            for _id, interface in self.spread_requests.items():
+                if interface == i:
+                    self.spread_requests.pop(_id)
+                    if self.interface and i != self.interface:
+                        self.interface.send_request(self.unanswered_requests[_id])
             if i == self.interface:
                 self.interface = None
                 self.addr_responses = {}
@@ -404,9 +445,18 @@ class Network(util.DaemonThread):
         # the id comes from the daemon or the network proxy
         _id = response.get('id')
         if _id is not None:
-            if i != self.interface:
+            if i != self.interface and self.spread_requests.get(_id) != i:
+                return
+            if self.spread_requests.pop(_id, None) is not None and not self.check_spread_response(response):
+                # ask the main server instead
+                i.print_error("bad answer to spread request", _id)
+                request = self.unanswered_requests.get(_id)
+                if request is not None and self.interface:
+                    self.interface.send_request(request)
+                return
+            if self.unanswered_requests.pop(_id, None) is None:
+                # answered by the server it was sent to first
                 return
-            self.unanswered_requests.pop(_id)
 
         method = response.get('method')
         result = response.get('result')
@@ -480,7 +530,40 @@ class Network(util.DaemonThread):
             return False
 
         self.unanswered_requests[_id] = request
-        self.interface.send_request(request)
+        interface = self.interface
+        if method in SPREAD_METHODS and self.config.get('spread_requests'):
+            interface = self.spread_interface()
+            if interface != self.interface:
+                self.spread_requests[_id] = interface
+        interface.send_request(request)
+        return True
+
+    def spread_interface(self):
+        '''The connected servers at the height of the main server, in turn'''
+        height = self.heights.get(self.interface.server)
+        servers = sorted(s for s, i in self.interfaces.items()
+                         if i.is_connected() and self.heights.get(s) == height)
+        if not servers:
+            return self.interface
+        self.spread_count += 1
+        return self.interfaces[servers[self.spread_count % len(servers)]]
+
+    def check_spread_response(self, response):
+        '''Whether the answer of another server than the main one can be
+        used: it is not an error, a history matches the status the
+        main server announced, and a transaction has the hash asked for'''
+        if response.get('error'):
+            return False
+        method = response.get('method')
+        param = response.get('params')[0]
+        result = response.get('result')
+        try:
+            if method == 'blockchain.address.get_history':
+                return history_status(result) == self.addr_responses.get(param)
+            if method == 'blockchain.transaction.get':
+                return hash_encode(Hash(result.decode('hex'))) == param
+        except Exception:
+            return False
         return True
 
     def check_interfaces(self):
@@ -504,25 +587,99 @@ class Network(util.DaemonThread):
                 else:
                     self.switch_to_interface(self.default_server)
 
-    def request_chunk(self, interface, data, idx):
+    def request_chunk(self, interface, idx):
         interface.print_error("requesting chunk %d" % idx)
         interface.send_request({'method':'blockchain.block.get_chunk', 'params':[idx]})
-        data['chunk_idx'] = idx
-        data['req_time'] = time.time()
+        self.chunk_requests[idx] = interface, time.time()
+
+    def wanted_chunks(self):
+        '''Indexes of the chunks to download, in order of priority, with
+        the height a server must have to send each of them'''
+        out = [(idx, idx*2016 + 2015) for idx in sorted(self.fill_chunks)]
+        best_height = max([0] + self.heights.values())
+        local_height = self.blockchain.height()
+        # Close to the tip we follow headers one by one instead
+        if best_height > local_height + 50 or self.chunk_rewind is not None:
+            start = (local_height + 1) / 2016
+            if self.chunk_rewind is not None:
+                start = min(start, self.chunk_rewind)
+            for idx in range(start, min(start + CHUNK_WINDOW, best_height / 2016 + 1)):
+                out.append((idx, min(idx*2016 + 2015, best_height)))
+        return out
+
+    def request_chunks(self):
+        '''Keep several chunk requests in flight, spread over the servers
+        that have the chunks.  Requests that time out are sent to another
+        server.'''
+        now = time.time()
+        for idx, (interface, req_time) in self.chunk_requests.items():
+            if not interface.is_connected():
+                self.chunk_requests.pop(idx)
+            elif now - req_time > CHUNK_TIMEOUT:
+                interface.print_error("chunk request timed out")
+                interface.stop()
+                self.chunk_requests.pop(idx)
+        load = dict((i, 0) for i in self.interfaces.values() if i.is_connected())
+        for interface, req_time in self.chunk_requests.values():
+            if interface in load:
+                load[interface] += 1
+        for idx, height in self.wanted_chunks():
+            if idx in self.chunk_requests or idx in self.blockchain.queued_chunks:
+                continue
+            servers = [i for i in load if load[i] < CHUNK_REQUESTS_PER_SERVER
+                       and self.heights.get(i.server, 0) >= height]
+            if not servers:
+                continue
+            interface = min(servers, key=lambda i: load[i])
+            self.request_chunk(interface, idx)
+            load[interface] += 1
 
     def on_get_chunk(self, interface, response):
         '''Handle receiving a chunk of block headers'''
+        idx = response['params'][0]
         if self.bc_requests:
             req_if, data = self.bc_requests[0]
-            req_idx = data.get('chunk_idx')
-            # Ignore unsolicited chunks
-            if req_if == interface and req_idx == response['params'][0]:
-                idx = self.blockchain.connect_chunk(req_idx, response['result'])
-                # If not finished, get the next chunk
-                if idx < 0 or self.get_local_height() >= data['if_height']:
-                    self.bc_requests.popleft()
-                else:
-                    self.request_chunk(interface, data, idx)
+            if req_if == interface and data.get('chunk_idx') == idx:
+                self.on_fork_chunk(interface, data, response.get('result'))
+                return
+        # Ignore unsolicited chunks
+        if self.chunk_requests.get(idx, (None,))[0] != interface:
+            return
+        self.chunk_requests.pop(idx)
+        result = response.get('result')
+        if not result or not isinstance(result, basestring):
+            interface.print_error("no chunk %d" % idx)
+            return
+        self.fill_chunks.discard(idx)
+        # Verification happens in the background; chunks are saved in
+        # order of index by connect_chunks()
+        self.chunk_sources[idx] = interface
+        self.blockchain.queue_chunk(idx, result)
+
+    def connect_chunks(self):
+        '''Save the chunks whose verification has finished'''
+        results = self.blockchain.connect_chunks()
+        for idx, success in results:
+            interface = self.chunk_sources.pop(idx, None)
+            if not success and interface is not None:
+                interface.print_error("chunk %d did not connect, dismissing interface" % idx)
+                interface.stop()
+            # Chunks up to the last checkpoint are checked against it,
+            # not against the chain before them
+            if idx <= len(self.blockchain.checkpoints):
+                continue
+            if success:
+                if idx == self.chunk_rewind:
+                    self.chunk_rewind = None
+            else:
+                # Our chain may have been reorganized; step back a chunk
+                self.chunk_rewind = idx - 1
+        # chunks dropped after one that did not connect
+        for idx in self.chunk_sources.keys():
+            if idx not in self.blockchain.queued_chunks:
+                self.chunk_sources.pop(idx)
+        if results:
+            self.notify('updated')
 
     def request_header(self, interface, data, height):
         interface.print_error("requesting header %d" % height)
@@ -539,9 +696,17 @@ class Network(util.DaemonThread):
             req_height = data.get('header_height', -1)
             # Ignore unsolicited headers
             if req_if == interface and req_height == response['params'][0]:
+                if 'fork_search' in data:
+                    self.on_fork_header(interface, data, response['result'])
+                    return
                 next_height = self.blockchain.connect_header(data['chain'], response['result'])
                 # If not finished, get the next header
-                if next_height in [True, False]:
+                if next_height is None:
+                    # The server is on another branch
+                    lowest = data['chain'][-1].block_height
+                    data['fork_search'] = [None, lowest - 1, 1]
+                    self.request_fork_header(interface, data)
+                elif next_height in [True, False]:
                     self.bc_requests.popleft()
                     if next_height:
                         self.notify('updated')
@@ -551,13 +716,73 @@ class Network(util.DaemonThread):
                 else:
                     self.request_header(interface, data, next_height)
 
+    def request_fork_header(self, interface, data):
+        '''Find the height where the server's chain leaves ours, with
+        as few requests as possible: step back exponentially from where
+        they differ until they agree, then bisect.'''
+        good, bad, step = data['fork_search']
+        if good is None:
+            height = bad - step
+            data['fork_search'][2] *= 2
+            if height <= self.blockchain.checkpoint_height():
+                good = data['fork_search'][0] = self.blockchain.checkpoint_height()
+        if good is not None:
+            if bad == good + 1:
+                # Download the server's branch from there
+                data['fork_height'] = bad
+                data['fork_data'] = ''
+                self.request_fork_chunk(interface, data, bad / 2016)
+                return
+            height = (good + bad) / 2
+        self.request_header(interface, data, height)
+
+    def on_fork_header(self, interface, data, header):
+        height = header.get('block_height')
+        if self.blockchain.get_hash(height) == self.blockchain.hash_header(header):
+            data['fork_search'][0] = height
+        else:
+            data['fork_search'][1] = height
+        self.request_fork_header(interface, data)
+
+    def request_fork_chunk(self, interface, data, idx):
+        interface.print_error("requesting chunk %d" % idx)
+        interface.send_request({'method':'blockchain.block.get_chunk', 'params':[idx]})
+        data['chunk_idx'] = idx
+        data['req_time'] = time.time()
+
+    def on_fork_chunk(self, interface, data, result):
+        '''Collect the headers of the server's branch, from the height
+        where it leaves our chain to its tip, and add them as a fork'''
+        idx = data.pop('chunk_idx')
+        try:
+            chunk = result.decode('hex')
+        except (AttributeError, TypeError):
+            chunk = ''
+        start = max(0, data['fork_height'] - idx*2016)
+        data['fork_data'] += chunk[start*80:]
+        if chunk and len(chunk) == 2016*80 and (idx + 1) * 2016 <= data['if_height']:
+            self.request_fork_chunk(interface, data, idx + 1)
+            return
+        self.bc_requests.popleft()
+        try:
+            self.blockchain.connect_fork(data['fork_height'], data['fork_data'])
+            self.notify('updated')
+        except BaseException as e:
+            interface.print_error("bad fork: %s, dismissing interface" % e)
+            interface.stop()
+
     def bc_request_headers(self, interface, data):
         '''Send a request for the next header, or a chunk of them, if necessary'''
-        local_height, if_height = self.get_local_height(), data['if_height']
+        local_height, if_height = self.blockchain.pending_height(), data['if_height']
         if if_height <= local_height:
             return False
         elif if_height > local_height + 50:
-            self.request_chunk(interface, data, (local_height + 1) / 2016)
+            # Chunks are downloaded by request_chunks()
+            return False
+        elif self.blockchain.queued_chunks or self.chunk_requests:
+            # Headers are connected to the chain on disk, so wait
+            # until the chunks being downloaded have been saved
+            pass
         else:
             self.request_header(interface, data, if_height)
         return True
@@ -591,6 +816,8 @@ class Network(util.DaemonThread):
             self.check_interfaces()
             self.handle_requests()
             self.handle_bc_requests()
+            self.request_chunks()
+            self.connect_chunks()
             try:
                 i, response = self.queue.get(timeout=0.1)
             except Queue.Empty:
@@ -603,6 +830,7 @@ class Network(util.DaemonThread):
                 self.process_response(i, response)
 
         self.stop_network()
+        self.blockchain.close()
         self.print_error("stopped")
 
     def on_header(self, i, r):
@@ -625,7 +853,23 @@ class Network(util.DaemonThread):
 
 
     def get_header(self, tx_height):
-        return self.blockchain.read_header(tx_height)
+        header = self.blockchain.read_header(tx_height)
+        if header is not None:
+            return header.as_dict()
+        if tx_height <= self.blockchain.checkpoint_height():
+            # Below the last checkpoint we only have the chunks that
+            # were needed so far.  Fetch this one; the caller retries.
+            self.request_fill_chunk(tx_height / 2016)
+
+    def request_fill_chunk(self, idx):
+        if idx not in self.blockchain.queued_chunks:
+            self.fill_chunks.add(idx)
 
     def get_local_height(self):
         return self.blockchain.height()
+
+    def height_at_time(self, timestamp):
+        return self.blockchain.height_at_time(timestamp)
+
+    def time_at_height(self, height):
+        return self.blockchain.time_at_height(height)
@@ -24,6 +24,7 @@ from network import Network
 from util import print_error
 from simple_config import SimpleConfig
 from network import serialize_proxy, serialize_server
+from blockchain import Header, HeaderReader
 
 
 
@@ -42,6 +43,8 @@ class NetworkProxy(util.DaemonThread):
         self.lock = threading.Lock()
         self.pending_transactions_for_notifications = []
         self.callbacks = {}
+        # headers are read from the files of the network
+        self.headers = HeaderReader(self.config)
 
         if socket:
             self.pipe = util.SocketPipe(socket)
@@ -61,6 +64,8 @@ class NetworkProxy(util.DaemonThread):
         self.blockchain_height = 0
         self.server_height = 0
         self.interfaces = []
+        # height from which the headers changed in the last reorg
+        self.reorg_height = None
         self.jobs = []
         # value returned by estimatefee
         self.fee = None
@@ -80,6 +85,7 @@ class NetworkProxy(util.DaemonThread):
         self.trigger_callback('stop')
         if self.network:
             self.network.stop()
+        self.headers.close()
         self.print_error("stopped")
 
     def process(self, response):
@@ -100,6 +106,8 @@ class NetworkProxy(util.DaemonThread):
                 self.servers = value
             elif key == 'interfaces':
                 self.interfaces = value
+            elif key == 'reorg':
+                self.reorg_height = value
             self.trigger_callback(key)
             return
 
@@ -186,11 +194,23 @@ class NetworkProxy(util.DaemonThread):
         return self.interfaces
 
     def get_header(self, height):
-        return self.synchronous_get([('network.get_header', [height])])[0]
+        header = self.headers.read_header(height)
+        if header is not None:
+            return header
+        # the network downloads the headers we do not have yet
+        header = self.synchronous_get([('network.get_header', [height])])[0]
+        if header is not None:
+            return Header.from_dict(header)
 
     def get_local_height(self):
         return self.blockchain_height
 
+    def height_at_time(self, timestamp):
+        return self.synchronous_get([('network.height_at_time', [timestamp])])[0]
+
+    def time_at_height(self, height):
+        return self.synchronous_get([('network.time_at_height', [height])])[0]
+
     def get_server_height(self):
         return self.server_height
 
@@ -17,12 +17,72 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 
+import heapq
+import json
+import os
+import sys
+import time
 from threading import Lock
 
 from bitcoin import Hash, hash_encode
 from transaction import Transaction
 from util import print_error, print_msg
 
+# requests of the synchronizer that may be waiting for an answer
+SYNC_REQUESTS = 100
+# no request is sent while the network has that many unanswered
+MAX_UNANSWERED = 500
+
+# queued requests are sent by priority
+PRIORITY_SUBSCRIPTION = 0
+PRIORITY_HISTORY = 1
+PRIORITY_TRANSACTION = 2
+QUEUE_NAMES = ['subscriptions', 'histories', 'transactions']
+
+# downloaded transactions are given to the wallet in batches of that
+# many, or once they have waited TX_BATCH_DELAY seconds
+TX_BATCH_SIZE = 50
+TX_BATCH_DELAY = 0.5
+
+
+class TxJournal(object):
+    '''Transactions downloaded since the wallet file last saved its
+    transactions, one JSON list [tx_hash, tx_height, raw] per line.
+    After a restart they are given to the wallet again instead of being
+    downloaded again.'''
+
+    def __init__(self, path):
+        self.path = path
+
+    def read(self):
+        txs = []
+        if self.path is None:
+            return txs
+        try:
+            with open(self.path, 'r') as f:
+                for line in f:
+                    try:
+                        tx_hash, tx_height, raw = json.loads(line)
+                    except ValueError:
+                        # a line that was being written
+                        continue
+                    txs.append((tx_hash, tx_height, raw))
+        except IOError:
+            pass
+        return txs
+
+    def append(self, txs):
+        if self.path is None or not txs:
+            return
+        with open(self.path, 'a') as f:
+            f.write(''.join(json.dumps(list(tx)) + '\n' for tx in txs))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def clear(self):
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
 
 class WalletSynchronizer():
     '''The synchronizer keeps the wallet up-to-date with its set of
@@ -32,6 +92,10 @@ class WalletSynchronizer():
     we don't have the full history of, and requests binary transaction
     data of any transactions the wallet doesn't have.
 
+    Requests are queued and sent by priority, with no more than
+    max_requests waiting for an answer: subscriptions first, then
+    histories, then transactions, the most recent first.
+
     External interface: __init__() and add() member functions.
     '''
 
@@ -44,6 +108,21 @@ class WalletSynchronizer():
         self.requested_histories = {}
         self.requested_addrs = set()
         self.lock = Lock()
+        # heap of (priority, order, count, method, params, callback)
+        self.queue = []
+        self.queue_count = 0
+        self.queued = [0] * len(QUEUE_NAMES)
+        # ids of the requests sent and not answered
+        self.sent = set()
+        self.max_requests = network.config.get('sync_requests', SYNC_REQUESTS)
+        # whether an address is old depends on the height
+        self.local_height = None
+        # (tx_hash, tx_height, raw) of downloaded transactions, not yet
+        # given to the wallet
+        self.received_txs = []
+        self.received_time = None
+        path = wallet.storage.path
+        self.journal = TxJournal(path + '.txs' if path else None)
         self.initialize()
 
     def print_error(self, *msg):
@@ -52,7 +131,42 @@ class WalletSynchronizer():
     def print_msg(self, *msg):
         print_msg("[Synchronizer]", *msg)
 
+    def queue_request(self, priority, order, method, params, callback):
+        heapq.heappush(self.queue, (priority, order, self.queue_count, method, params, callback))
+        self.queue_count += 1
+        self.queued[priority] += 1
+
+    def send_requests(self):
+        '''Send queued requests while the server is not too busy'''
+        n = min(self.max_requests - len(self.sent),
+                MAX_UNANSWERED - len(self.network.unanswered_requests),
+                len(self.queue))
+        # consecutive requests with the same callback are sent together
+        batch = []
+        for i in range(n):
+            priority, order, count, method, params, callback = heapq.heappop(self.queue)
+            self.queued[priority] -= 1
+            if batch and batch[-1][1] != callback:
+                self.send_batch(batch)
+                batch = []
+            batch.append(((method, params), callback))
+        if batch:
+            self.send_batch(batch)
+
+    def send_batch(self, batch):
+        ids = self.network.send([msg for msg, callback in batch], batch[0][1])
+        self.sent.update(ids)
+
+    def get_queue_depths(self):
+        '''Number of queued requests by kind, and of sent requests not
+        answered yet'''
+        depths = dict(zip(QUEUE_NAMES, self.queued))
+        depths['sent'] = len(self.sent)
+        return depths
+
     def parse_response(self, response):
+        # notifications have no id
+        self.sent.discard(response.get('id'))
         if response.get('error'):
             self.print_error("response error:", response)
             return None, None
@@ -60,7 +174,7 @@ class WalletSynchronizer():
 
     def is_up_to_date(self):
         return (not self.requested_tx and not self.requested_histories
-                and not self.requested_addrs)
+                and not self.requested_addrs and not self.queue)
 
     def add(self, address):
         '''This can be called from the proxy or GUI threads.'''
@@ -68,11 +182,10 @@ class WalletSynchronizer():
             self.new_addresses.add(address)
 
     def subscribe_to_addresses(self, addresses):
-        if addresses:
-            self.requested_addrs |= addresses
-            msgs = map(lambda addr: ('blockchain.address.subscribe', [addr]),
-                       addresses)
-            self.network.send(msgs, self.addr_subscription_response)
+        for addr in addresses:
+            self.requested_addrs.add(addr)
+            self.queue_request(PRIORITY_SUBSCRIPTION, 0, 'blockchain.address.subscribe',
+                               [addr], self.addr_subscription_response)
 
     def addr_subscription_response(self, response):
         params, result = self.parse_response(response)
@@ -81,12 +194,14 @@ class WalletSynchronizer():
         addr = params[0]
         if addr in self.requested_addrs:  # Notifications won't be in
             self.requested_addrs.remove(addr)
-        history = self.wallet.get_address_history(addr)
-        if self.wallet.get_status(history) != result:
+        if result is not None:
+            self.wallet.address_reported(addr)
+        if self.wallet.get_address_status(addr) != result:
             if self.requested_histories.get(addr) is None:
-                self.network.send([('blockchain.address.get_history', [addr])],
-                                  self.addr_history_response)
+                self.queue_request(PRIORITY_HISTORY, 0, 'blockchain.address.get_history',
+                                   [addr], self.addr_history_response)
                 self.requested_histories[addr] = result
+        self.send_requests()
 
     def addr_history_response(self, response):
         params, result = self.parse_response(response)
@@ -113,24 +228,53 @@ class WalletSynchronizer():
 
         # Request transactions we don't have
         self.request_missing_txs(hist)
+        self.send_requests()
 
     def tx_response(self, response):
         params, result = self.parse_response(response)
         if not params:
             return
+        self.send_requests()
         tx_hash, tx_height = params
-        assert tx_hash == hash_encode(Hash(result.decode('hex')))
-        tx = Transaction(result)
-        try:
-            tx.deserialize()
-        except Exception:
-            self.print_msg("cannot deserialize transaction, skipping", tx_hash)
-            return
+        if not self.received_txs:
+            self.received_time = time.time()
+        self.received_txs.append((tx_hash, tx_height, result))
+        if len(self.received_txs) >= TX_BATCH_SIZE:
+            self.receive_txs()
 
-        self.wallet.receive_tx_callback(tx_hash, tx, tx_height)
-        self.requested_tx.remove((tx_hash, tx_height))
-        self.print_error("received tx:", tx_hash, len(tx.raw))
-        if not self.requested_tx:
+    def receive_txs(self, journal=True):
+        '''Check the hashes of the downloaded transactions, and give them
+        to the wallet.  Those that are not valid are requested again.'''
+        txs = []
+        bad = []
+        for tx_hash, tx_height, raw in self.received_txs:
+            try:
+                valid = tx_hash == hash_encode(Hash(raw.decode('hex')))
+            except Exception:
+                valid = False
+            if not valid:
+                self.print_error("received tx does not match its hash", tx_hash)
+                bad.append((tx_hash, tx_height))
+                continue
+            tx = Transaction(raw)
+            try:
+                tx.deserialize()
+            except Exception:
+                self.print_msg("cannot deserialize transaction, requesting it again", tx_hash)
+                bad.append((tx_hash, tx_height))
+                continue
+            txs.append((tx_hash, tx, tx_height))
+        for item in bad:
+            self.requested_tx.discard(item)
+        self.request_missing_txs(bad)
+        if journal:
+            self.journal.append([(tx_hash, tx_height, tx.raw) for tx_hash, tx, tx_height in txs])
+        self.received_txs = []
+        self.wallet.receive_txs_callback(txs)
+        for tx_hash, tx, tx_height in txs:
+            self.requested_tx.discard((tx_hash, tx_height))
+        self.print_error("received %d transactions" % len(txs))
+        if txs and not self.requested_tx:
             self.network.trigger_callback('updated')
             # Updated gets called too many times from other places as
             # well; if we used that signal we get the notification
@@ -141,19 +285,29 @@ class WalletSynchronizer():
         # "hist" is a list of [tx_hash, tx_height] lists
         missing = set()
         for tx_hash, tx_height in hist:
-            if self.wallet.transactions.get(tx_hash) is None:
+            if tx_hash not in self.wallet.transactions:
                 missing.add((tx_hash, tx_height))
         missing -= self.requested_tx
-        if missing:
-            requests = [('blockchain.transaction.get', tx) for tx in missing]
-            self.network.send(requests, self.tx_response)
-            self.requested_tx |= missing
+        for tx_hash, tx_height in missing:
+            # unconfirmed transactions first
+            order = -tx_height if tx_height > 0 else -sys.maxint
+            self.queue_request(PRIORITY_TRANSACTION, order, 'blockchain.transaction.get',
+                               [tx_hash, tx_height], self.tx_response)
+        self.requested_tx |= missing
 
     def initialize(self):
         '''Check the initial state of the wallet.  Subscribe to all its
         addresses, and request any transactions in its address history
         we don't have.
         '''
+        # transactions downloaded before a restart
+        for tx_hash, tx_height, raw in self.journal.read():
+            if tx_hash not in self.wallet.transactions and tx_hash in self.wallet.tx_addr_hist:
+                self.received_txs.append((tx_hash, tx_height, raw))
+        if self.received_txs:
+            self.print_error("%d transactions in journal" % len(self.received_txs))
+            self.receive_txs(journal=False)
+
         for history in self.wallet.history.values():
             # Old electrum servers returned ['*'] when all history for
             # the address was pruned.  This no longer happens but may
@@ -168,7 +322,16 @@ class WalletSynchronizer():
 
     def main_loop(self):
         '''Called from the network proxy thread main loop.'''
-        # 1. Create new addresses
+        # 0. Give downloaded transactions to the wallet
+        if self.received_txs and (len(self.received_txs) == len(self.requested_tx)
+                                  or time.time() - self.received_time > TX_BATCH_DELAY):
+            self.receive_txs()
+
+        # 1. Create new addresses, if histories or the height changed
+        local_height = self.network.get_local_height()
+        if local_height != self.local_height:
+            self.local_height = local_height
+            self.wallet.history_changed()
         self.wallet.synchronize()
 
         # 2. Subscribe to new addresses
@@ -176,6 +339,7 @@ class WalletSynchronizer():
             addresses = self.new_addresses
             self.new_addresses = set()
         self.subscribe_to_addresses(addresses)
+        self.send_requests()
 
         # 3. Detect if situation has changed
         up_to_date = self.is_up_to_date()
@@ -183,4 +347,6 @@ class WalletSynchronizer():
             self.wallet.set_up_to_date(up_to_date)
             if up_to_date:
                 self.wallet.save_transactions()
+                self.wallet.storage.sync()
+                self.journal.clear()
             self.network.trigger_callback('updated')
@@ -0,0 +1,687 @@
+import shutil
+import tempfile
+import sys
+import unittest
+import os
+
+from StringIO import StringIO
+from lib.bitcoin import PoWHash, hash_encode, hash_decode, int_to_hex, rev_hex
+from lib.blockchain import Blockchain, Header, hash_chunk, HeaderFile, HeaderReader, bits_to_target, check_proof_of_work
+from lib.simple_config import SimpleConfig
+
+
+# about one hash in two meets the target
+EASY_BITS = 0x207fffff
+
+
+def make_chain(count, prev_hash='0'*64, timestamp=1400000000, bits=EASY_BITS):
+    '''Serialized headers of a valid chain of count blocks following
+    prev_hash, mined at bits.'''
+    data = ''
+    for i in range(count):
+        header = Header(2, hash_decode(prev_hash), ('%064x' % i).decode('hex'),
+                        timestamp + 60 * i, bits, 0)
+        while not check_proof_of_work(header.serialize(), header.hash()):
+            header.nonce += 1
+        raw = header.serialize()
+        prev_hash = hash_encode(PoWHash(raw))
+        data += raw
+    return data
+
+
+class BlockchainTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(BlockchainTestCase, self).setUp()
+        self.electrum_dir = tempfile.mkdtemp()
+
+        self._saved_stdout = sys.stdout
+        self._stdout_buffer = StringIO()
+        sys.stdout = self._stdout_buffer
+
+        self.config = SimpleConfig({'electrum_path': self.electrum_dir})
+
+    def tearDown(self):
+        super(BlockchainTestCase, self).tearDown()
+        shutil.rmtree(self.electrum_dir)
+        # Restore the "real" stdout
+        sys.stdout = self._saved_stdout
+
+
+class TestHeaderFile(BlockchainTestCase):
+
+    def setUp(self):
+        super(TestHeaderFile, self).setUp()
+        self.path = os.path.join(self.electrum_dir, 'records')
+        open(self.path, 'wb').close()
+        self.store = HeaderFile(self.path, 4)
+
+    def tearDown(self):
+        self.store.close()
+        super(TestHeaderFile, self).tearDown()
+
+    def test_empty_file(self):
+        self.assertEqual(0, self.store.count())
+        self.assertIsNone(self.store.read(0))
+
+    def test_read_after_append(self):
+        self.store.write(0, 'aaaabbbb')
+        self.assertEqual('bbbb', self.store.read(1))
+        self.assertIsNone(self.store.read(2))
+        self.store.write(2, 'cccc')
+        self.assertEqual(3, self.store.count())
+        self.assertEqual('cccc', self.store.read(2))
+        self.assertEqual('bbbbcccc', self.store.read(1, 2))
+
+    def test_overwrite_is_visible(self):
+        self.store.write(0, 'aaaabbbb')
+        self.assertEqual('aaaa', self.store.read(0))
+        self.store.write(0, 'dddd')
+        self.assertEqual('dddd', self.store.read(0))
+
+    def test_negative_index(self):
+        self.store.write(0, 'aaaa')
+        self.assertIsNone(self.store.read(-1))
+
+    def test_readonly_view_of_other_writer(self):
+        reader = HeaderFile(self.path, 4, readonly=True)
+        self.assertIsNone(reader.read(0))
+        self.store.write(0, 'aaaa')
+        self.assertEqual('aaaa', reader.read(0))
+        reader.close()
+
+
+class TestBlockchainHeaders(BlockchainTestCase):
+
+    header = {
+        'version': 2,
+        'prev_block_hash': '11' * 32,
+        'merkle_root': '22' * 32,
+        'timestamp': 1400000000,
+        'bits': 0x1d00ffff,
+        'nonce': 42,
+    }
+
+    def setUp(self):
+        super(TestBlockchainHeaders, self).setUp()
+        self.blockchain = Blockchain(self.config, None)
+        self.blockchain.init_headers_file()
+
+    def tearDown(self):
+        self.blockchain.close()
+        super(TestBlockchainHeaders, self).tearDown()
+
+    def test_save_and_read_header(self):
+        header = dict(self.header, block_height=0)
+        self.blockchain.save_header(header)
+        self.assertEqual(0, self.blockchain.height())
+        self.assertEqual(header, self.blockchain.read_header(0).as_dict())
+        self.assertIsNone(self.blockchain.read_header(1))
+
+    def test_save_chunk(self):
+        raw = self.blockchain.header_to_string(self.header).decode('hex')
+        self.blockchain.save_chunk(0, raw * 10, PoWHash(raw) * 10)
+        self.assertEqual(9, self.blockchain.height())
+        self.assertEqual(self.header, self.blockchain.header_from_string(self.blockchain.headers.read(9)))
+        self.assertEqual(9, self.blockchain.read_header(9).block_height)
+
+
+class TestHeader(unittest.TestCase):
+
+    header = TestBlockchainHeaders.header
+
+    def test_serialize_roundtrip(self):
+        raw = Header.from_dict(self.header).serialize()
+        self.assertEqual(80, len(raw))
+        self.assertEqual(raw, Header.deserialize(raw).serialize())
+        self.assertEqual(raw, Header.deserialize('\0' * 80 + raw, 80).serialize())
+
+    def test_dict_interface(self):
+        header = Header.from_dict(dict(self.header, block_height=7))
+        for key, value in self.header.items():
+            self.assertEqual(value, header.get(key))
+            self.assertEqual(value, header[key])
+        self.assertEqual(7, header['block_height'])
+        self.assertEqual(dict(self.header, block_height=7), header.as_dict())
+        self.assertEqual('11' * 32, header.raw_prev_hash.encode('hex'))
+
+    def test_missing_height(self):
+        header = Header.from_dict(self.header)
+        self.assertIsNone(header.get('block_height'))
+        self.assertRaises(KeyError, lambda: header['block_height'])
+        self.assertEqual(self.header, header.as_dict())
+
+    def test_hash_matches_hex_encoding(self):
+        header = Header.from_dict(self.header)
+        raw = ''.join([
+            int_to_hex(self.header['version'], 4),
+            rev_hex(self.header['prev_block_hash']),
+            rev_hex(self.header['merkle_root']),
+            int_to_hex(self.header['timestamp'], 4),
+            int_to_hex(self.header['bits'], 4),
+            int_to_hex(self.header['nonce'], 4)]).decode('hex')
+        self.assertEqual(raw, header.serialize())
+        self.assertEqual(PoWHash(raw), header.hash())
+
+
+class TestHashIndex(BlockchainTestCase):
+
+    def setUp(self):
+        super(TestHashIndex, self).setUp()
+        self.blockchain = Blockchain(self.config, None)
+        self.blockchain.init_headers_file()
+
+    def tearDown(self):
+        self.blockchain.close()
+        super(TestHashIndex, self).tearDown()
+
+    def test_verify_chunk_fills_hash_index(self):
+        data = make_chain(100)
+        self.blockchain.verify_chunk(0, data.encode('hex'))
+        self.assertEqual(100, self.blockchain.hashes.count())
+        for height in [0, 50, 99]:
+            header = self.blockchain.read_header(height)
+            self.assertEqual(self.blockchain.hash_header(header),
+                             self.blockchain.get_hash(height))
+        self.assertIsNone(self.blockchain.get_hash(100))
+
+    def test_hash_computed_when_missing_from_index(self):
+        data = make_chain(10)
+        self.blockchain.headers.write(0, data)
+        header = self.blockchain.read_header(7)
+        self.assertEqual(self.blockchain.hash_header(header),
+                         self.blockchain.get_hash(7))
+        self.assertEqual(8, self.blockchain.hashes.count())
+
+    def test_get_height(self):
+        data = make_chain(20)
+        self.blockchain.verify_chunk(0, data.encode('hex'))
+        block_hash = self.blockchain.get_hash(12)
+        self.assertEqual(12, self.blockchain.get_height(block_hash))
+        self.assertIsNone(self.blockchain.get_height('ff'*32))
+
+    def test_get_height_follows_rewrites(self):
+        data = make_chain(20)
+        self.blockchain.verify_chunk(0, data.encode('hex'))
+        old_hash = self.blockchain.get_hash(19)
+        self.assertEqual(19, self.blockchain.get_height(old_hash))
+        header = self.blockchain.read_header(19)
+        header.nonce += 1
+        self.blockchain.save_header(header)
+        self.assertIsNone(self.blockchain.get_height(old_hash))
+        self.assertEqual(19, self.blockchain.get_height(self.blockchain.hash_header(header)))
+
+    def test_chunk_must_connect(self):
+        data = make_chain(10, prev_hash='11'*32)
+        self.assertRaises(BaseException, self.blockchain.verify_chunk, 0, data.encode('hex'))
+        self.assertEqual(0, self.blockchain.headers.count())
+
+
+class TestChunkVerification(BlockchainTestCase):
+
+    def setUp(self):
+        super(TestChunkVerification, self).setUp()
+        self.blockchain = Blockchain(self.config, None)
+        self.blockchain.init_headers_file()
+        self.data = make_chain(2016 * 2 + 100)
+        self.chunks = [self.data[i*2016*80:(i+1)*2016*80].encode('hex') for i in range(3)]
+
+    def tearDown(self):
+        self.blockchain.close()
+        super(TestChunkVerification, self).tearDown()
+
+    def connect_all(self, count):
+        results = []
+        while len(results) < count:
+            results += self.blockchain.connect_chunks()
+        return results
+
+    def check_queued_chunks_connect_in_order(self):
+        for index in [2, 0, 1]:
+            self.blockchain.queue_chunk(index, self.chunks[index])
+        self.assertEqual(2016 * 2 + 99, self.blockchain.pending_height())
+        self.assertEqual([(0, True), (1, True), (2, True)], self.connect_all(3))
+        self.assertEqual(2016 * 2 + 99, self.blockchain.height())
+        self.assertEqual(self.data, self.blockchain.headers.read(0, 2016 * 2 + 100))
+        self.assertEqual({}, self.blockchain.queued_chunks)
+
+    def test_queued_chunks_connect_in_order(self):
+        self.check_queued_chunks_connect_in_order()
+
+    def test_queued_chunks_connect_with_pool(self):
+        self.config.set_key('verify_processes', 2)
+        self.blockchain.start_pool()
+        self.assertIsNotNone(self.blockchain.pool)
+        self.check_queued_chunks_connect_in_order()
+
+    def test_bad_chunk_drops_later_chunks(self):
+        bad = make_chain(2016, prev_hash='11'*32).encode('hex')
+        self.blockchain.queue_chunk(0, self.chunks[0])
+        self.blockchain.queue_chunk(1, bad)
+        self.blockchain.queue_chunk(2, self.chunks[2])
+        self.assertEqual([(0, True), (1, False)], self.connect_all(2))
+        self.assertEqual(2015, self.blockchain.height())
+        self.assertEqual({}, self.blockchain.queued_chunks)
+
+    def test_chunk_that_is_not_a_chain(self):
+        data = self.data[:2016*80]
+        data = data[:80*10] + data[80*11:] + data[80*10:80*11]
+        self.blockchain.queue_chunk(0, data.encode('hex'))
+        self.assertEqual([(0, False)], self.connect_all(1))
+        self.assertEqual(0, self.blockchain.headers.count())
+
+    def test_chunk_that_is_not_a_string(self):
+        self.assertEqual((0, None, None), hash_chunk((0, 123)))
+        self.assertEqual((0, None, None), hash_chunk((0, 'zz')))
+
+    def test_chunk_that_is_not_hashed_expires(self):
+        self.blockchain.queue_chunk(0, self.chunks[0])
+        # the result is lost
+        self.blockchain.hashed_chunks.get()
+        self.assertEqual([], self.blockchain.connect_chunks())
+        self.assertEqual({0: 2015}, self.blockchain.queued_chunks)
+        self.blockchain.queue_times[0] -= 1000
+        self.assertEqual([], self.blockchain.connect_chunks())
+        self.assertEqual({}, self.blockchain.queued_chunks)
+
+
+class TestCheckpoints(BlockchainTestCase):
+
+    def setUp(self):
+        super(TestCheckpoints, self).setUp()
+        self.data = make_chain(2016 * 3 + 10)
+        self.chunks = [self.data[i*2016*80:(i+1)*2016*80].encode('hex') for i in range(4)]
+        self.checkpoints = []
+        for height in [2015, 4031]:
+            raw = self.data[height*80:(height+1)*80]
+            self.checkpoints.append([height, hash_encode(PoWHash(raw)), EASY_BITS])
+        self.blockchain = Blockchain(self.config, None)
+        self.blockchain.set_checkpoints(self.checkpoints)
+        self.blockchain.init_headers_file()
+        self.blockchain.set_local_height()
+
+    def tearDown(self):
+        self.blockchain.close()
+        super(TestCheckpoints, self).tearDown()
+
+    def test_starts_at_last_checkpoint(self):
+        self.assertEqual(4031, self.blockchain.height())
+        self.assertEqual(4031, self.blockchain.checkpoint_height())
+        self.assertIsNone(self.blockchain.read_header(0))
+        self.assertIsNone(self.blockchain.read_header(4031))
+        self.assertIsNone(self.blockchain.get_hash(100))
+        self.assertEqual(self.checkpoints[0][1], self.blockchain.get_hash(2015))
+        self.assertEqual(self.checkpoints[1][1], self.blockchain.get_hash(4031))
+
+    def test_sync_from_checkpoint(self):
+        self.blockchain.verify_chunk(2, self.chunks[2])
+        self.assertEqual(6047, self.blockchain.height())
+        self.assertEqual(self.data[6047*80:6048*80], self.blockchain.headers.read(6047))
+        self.assertIsNone(self.blockchain.read_header(2016))
+
+    def test_fill_chunk_below_checkpoint(self):
+        self.blockchain.verify_chunk(1, self.chunks[1])
+        self.assertEqual(self.data[2016*80:2017*80], self.blockchain.read_header(2016).serialize())
+        self.assertIsNone(self.blockchain.read_header(2015))
+        self.blockchain.verify_chunk(0, self.chunks[0])
+        self.assertEqual(self.data[:2016*2*80], self.blockchain.headers.read(0, 4032))
+        self.assertEqual(4031, self.blockchain.height())
+
+    def test_chunk_must_match_checkpoint(self):
+        other = make_chain(2016, timestamp=1500000000).encode('hex')
+        self.assertRaises(BaseException, self.blockchain.verify_chunk, 0, other)
+        # a partial chunk cannot be checked against the checkpoint
+        self.assertRaises(BaseException, self.blockchain.verify_chunk, 0, self.chunks[0][:160*100])
+        self.assertIsNone(self.blockchain.read_header(0))
+
+    def test_bad_fill_chunk_keeps_later_chunks(self):
+        other = make_chain(2016, timestamp=1500000000).encode('hex')
+        self.blockchain.queue_chunk(0, other)
+        self.blockchain.queue_chunk(2, self.chunks[2])
+        results = []
+        while len(results) < 2:
+            results += self.blockchain.connect_chunks()
+        self.assertEqual([(0, False), (2, True)], results)
+        self.assertEqual(6047, self.blockchain.height())
+
+    def test_get_checkpoints(self):
+        self.blockchain.verify_chunk(0, self.chunks[0])
+        self.blockchain.verify_chunk(1, self.chunks[1])
+        self.blockchain.verify_chunk(2, self.chunks[2])
+        self.assertEqual(self.checkpoints + [[6047, self.blockchain.get_hash(6047), EASY_BITS]],
+                         self.blockchain.get_checkpoints())
+
+
+class TestImportExport(BlockchainTestCase):
+
+    def setUp(self):
+        super(TestImportExport, self).setUp()
+        self.data = make_chain(2016 * 3 + 10)
+        self.dump = os.path.join(self.electrum_dir, 'dump')
+        with open(self.dump, 'wb') as f:
+            f.write(self.data)
+        self.blockchain = Blockchain(self.config, None)
+        self.blockchain.init_headers_file()
+
+    def tearDown(self):
+        self.blockchain.close()
+        super(TestImportExport, self).tearDown()
+
+    def test_import(self):
+        self.assertEqual(2016 * 3 + 10, self.blockchain.import_headers(self.dump, block_chunks=2))
+        self.assertEqual(2016 * 3 + 9, self.blockchain.height())
+        self.assertEqual(self.data, self.blockchain.headers.read(0, 2016 * 3 + 10))
+        self.assertEqual(hash_encode(PoWHash(self.data[-80:])), self.blockchain.get_hash(2016 * 3 + 9))
+        # nothing left to write
+        self.assertEqual(0, self.blockchain.import_headers(self.dump))
+
+    def test_import_with_pool(self):
+        self.config.set_key('verify_processes', 2)
+        self.blockchain.start_pool()
+        self.assertEqual(2016 * 3 + 10, self.blockchain.import_headers(self.dump))
+        self.assertEqual(self.data, self.blockchain.headers.read(0, 2016 * 3 + 10))
+
+    def test_import_keeps_verified_blocks(self):
+        data = self.data[:2016*2*80] + make_chain(2016, prev_hash='11'*32)
+        with open(self.dump, 'wb') as f:
+            f.write(data)
+        self.assertRaises(BaseException, self.blockchain.import_headers, self.dump, block_chunks=2)
+        self.assertEqual(2016 * 2 - 1, self.blockchain.height())
+
+    def test_import_after_local_headers(self):
+        self.blockchain.verify_chunk(0, self.data[:2016*80].encode('hex'))
+        self.assertEqual(2016 * 2 + 10, self.blockchain.import_headers(self.dump))
+        self.assertEqual(2016 * 3 + 9, self.blockchain.height())
+
+    def test_export(self):
+        self.blockchain.import_headers(self.dump)
+        path = os.path.join(self.electrum_dir, 'export')
+        self.assertEqual(2016 * 3 + 10, self.blockchain.export_headers(path))
+        with open(path, 'rb') as f:
+            self.assertEqual(self.data, f.read())
+
+    def test_export_stops_at_missing_headers(self):
+        self.blockchain.close()
+        checkpoints = [[2015, hash_encode(PoWHash(self.data[2015*80:2016*80])), EASY_BITS]]
+        self.blockchain.set_checkpoints(checkpoints)
+        self.blockchain.init_headers_file()
+        self.blockchain.set_local_height()
+        path = os.path.join(self.electrum_dir, 'export')
+        self.assertEqual(0, self.blockchain.export_headers(path))
+        self.assertEqual(2016 * 3 + 10, self.blockchain.import_headers(self.dump))
+        self.assertEqual(2016 * 3 + 10, self.blockchain.export_headers(path))
+
+
+class ReorgRecorder(object):
+
+    def __init__(self):
+        self.reorgs = []
+
+    def on_reorg(self, height):
+        self.reorgs.append(height)
+
+
+class TestForks(BlockchainTestCase):
+
+    def setUp(self):
+        super(TestForks, self).setUp()
+        self.blockchain = Blockchain(self.config, None)
+        self.blockchain.init_headers_file()
+        self.main = make_chain(300)
+        self.blockchain.verify_chunk(0, self.main.encode('hex'))
+
+    def tearDown(self):
+        self.blockchain.close()
+        super(TestForks, self).tearDown()
+
+    def branch(self, height, count):
+        prev_hash = hash_encode(PoWHash(self.main[(height-1)*80:height*80]))
+        return make_chain(count, prev_hash=prev_hash, timestamp=1500000000)
+
+    def read_main_file(self):
+        with open(self.blockchain.path(), 'rb') as f:
+            return f.read()
+
+    def test_shorter_fork_is_kept_aside(self):
+        fork = self.branch(290, 5)
+        self.blockchain.connect_fork(290, fork)
+        self.assertEqual(299, self.blockchain.height())
+        self.assertIsNone(self.blockchain.active_fork)
+        self.assertEqual(1, len(self.blockchain.forks))
+        self.assertEqual(self.main[290*80:291*80], self.blockchain.read_raw(290))
+
+    def test_longer_fork_becomes_active(self):
+        fork = self.branch(290, 20)
+        self.blockchain.connect_fork(290, fork)
+        self.assertEqual(309, self.blockchain.height())
+        self.assertEqual(fork, self.blockchain.read_raw(290, 20))
+        self.assertEqual(self.main[280*80:290*80] + fork[:10*80], self.blockchain.read_raw(280, 20))
+        self.assertEqual(hash_encode(PoWHash(fork[-80:])), self.blockchain.get_hash(309))
+        self.assertEqual(309, self.blockchain.get_height(self.blockchain.get_hash(309)))
+        old_hash = hash_encode(PoWHash(self.main[295*80:296*80]))
+        self.assertIsNone(self.blockchain.get_height(old_hash))
+        self.assertEqual(100, self.blockchain.get_height(self.blockchain.get_hash(100)))
+        # the main file was not rewritten
+        self.assertEqual(self.main, self.read_main_file())
+
+    def test_active_fork_is_persistent(self):
+        fork = self.branch(290, 20)
+        self.blockchain.connect_fork(290, fork)
+        self.blockchain.close()
+        self.blockchain = Blockchain(self.config, None)
+        self.assertEqual(309, self.blockchain.height())
+        self.assertEqual(fork[-80:], self.blockchain.read_raw(309))
+
+    def test_headers_extend_active_fork(self):
+        fork = self.branch(290, 20)
+        self.blockchain.connect_fork(290, fork)
+        more = make_chain(5, prev_hash=hash_encode(PoWHash(fork[-80:])), timestamp=1600000000)
+        for i in range(5):
+            header = Header.deserialize(more, i*80, block_height=310 + i)
+            self.assertTrue(self.blockchain.connect_header([], header))
+        self.assertEqual(314, self.blockchain.height())
+        self.assertEqual(self.main, self.read_main_file())
+
+    def test_switch_back_to_main_chain(self):
+        fork = self.branch(290, 20)
+        self.blockchain.connect_fork(290, fork)
+        longer = make_chain(30, prev_hash=hash_encode(PoWHash(self.main[-80:])), timestamp=1600000000)
+        self.blockchain.connect_fork(290, self.main[290*80:] + longer)
+        self.assertIsNone(self.blockchain.active_fork)
+        self.assertEqual(329, self.blockchain.height())
+        self.assertEqual(self.main + longer, self.read_main_file())
+
+    def test_fork_of_active_fork(self):
+        fork = self.branch(290, 20)
+        self.blockchain.connect_fork(290, fork)
+        prev_hash = hash_encode(PoWHash(fork[4*80:5*80]))
+        other = make_chain(30, prev_hash=prev_hash, timestamp=1600000000)
+        self.blockchain.connect_fork(295, other)
+        self.assertEqual(324, self.blockchain.height())
+        self.assertEqual(290, self.blockchain.active_fork.fork_height)
+        self.assertEqual(fork[:5*80] + other, self.blockchain.read_raw(290, 35))
+
+    def test_reorgs_are_reported(self):
+        network = ReorgRecorder()
+        self.blockchain.network = network
+        self.blockchain.connect_fork(290, self.branch(290, 5))
+        self.assertEqual([], network.reorgs)
+        self.blockchain.connect_fork(280, self.branch(280, 30))
+        self.assertEqual([280], network.reorgs)
+        longer = make_chain(40, prev_hash=hash_encode(PoWHash(self.main[-80:])), timestamp=1600000000)
+        self.blockchain.connect_fork(280, self.main[280*80:] + longer)
+        self.assertEqual([280, 280], network.reorgs)
+
+    def test_merged_fork_is_not_reported_again(self):
+        network = ReorgRecorder()
+        self.blockchain.network = network
+        self.blockchain.connect_fork(290, self.branch(290, 2016 * 2 + 100))
+        self.assertIsNone(self.blockchain.active_fork)
+        self.assertEqual([290], network.reorgs)
+
+    def test_fork_must_connect(self):
+        fork = make_chain(20, prev_hash='11'*32)
+        self.assertRaises(BaseException, self.blockchain.connect_fork, 290, fork)
+        self.assertEqual({}, self.blockchain.forks)
+
+    def test_deep_fork_is_merged(self):
+        fork = self.branch(290, 2016 * 2 + 100)
+        self.blockchain.connect_fork(290, fork)
+        self.assertIsNone(self.blockchain.active_fork)
+        self.assertEqual({}, self.blockchain.forks)
+        self.assertEqual(289 + 2016 * 2 + 100, self.blockchain.height())
+        self.assertEqual(self.main[:290*80] + fork, self.read_main_file())
+        self.assertEqual(hash_encode(PoWHash(fork[-80:])), self.blockchain.get_hash(self.blockchain.height()))
+
+
+class TestProofOfWork(BlockchainTestCase):
+
+    def setUp(self):
+        super(TestProofOfWork, self).setUp()
+        self.blockchain = Blockchain(self.config, None)
+        self.blockchain.init_headers_file()
+
+    def tearDown(self):
+        self.blockchain.close()
+        super(TestProofOfWork, self).tearDown()
+
+    def unmined_chain(self, count, prev_hash='0'*64):
+        data = ''
+        for i in range(count):
+            header = Header(2, hash_decode(prev_hash), '\0' * 32, 1400000000, 0x1d00ffff, i)
+            prev_hash = hash_encode(header.hash())
+            data += header.serialize()
+        return data
+
+    def test_bits_to_target(self):
+        self.assertEqual(0xffff << 208, bits_to_target(0x1d00ffff))
+        self.assertEqual(0x7fffff << 232, bits_to_target(EASY_BITS))
+        self.assertEqual(0x12, bits_to_target(0x01123456))
+        self.assertEqual(0, bits_to_target(0x04923456))
+
+    def test_chunk_without_proof_of_work(self):
+        data = self.unmined_chain(10)
+        self.assertRaises(BaseException, self.blockchain.verify_chunk, 0, data.encode('hex'))
+        self.assertEqual(0, self.blockchain.headers.count())
+
+    def test_header_without_proof_of_work(self):
+        data = make_chain(10)
+        self.blockchain.verify_chunk(0, data.encode('hex'))
+        prev_hash = hash_encode(PoWHash(data[-80:]))
+        header = Header.deserialize(self.unmined_chain(1, prev_hash), block_height=10)
+        self.assertFalse(self.blockchain.connect_header([], header))
+        self.assertEqual(9, self.blockchain.height())
+
+    def test_retarget(self):
+        data = make_chain(2016 * 2)
+        self.blockchain.verify_chunk(0, data[:2016*80].encode('hex'))
+        self.assertEqual(0x1d00ffff, self.blockchain.get_bits(1))
+        self.config.set_key('verify_retarget', True)
+        self.assertRaises(BaseException, self.blockchain.verify_chunk, 1, data[2016*80:].encode('hex'))
+        self.config.set_key('verify_retarget', False)
+        self.blockchain.verify_chunk(1, data[2016*80:].encode('hex'))
+        self.assertEqual(2016 * 2 - 1, self.blockchain.height())
+
+
+class TestTimeIndex(BlockchainTestCase):
+
+    def setUp(self):
+        super(TestTimeIndex, self).setUp()
+        self.blockchain = Blockchain(self.config, None)
+        self.blockchain.init_headers_file()
+        self.main = make_chain(300)
+        self.blockchain.verify_chunk(0, self.main.encode('hex'))
+
+    def tearDown(self):
+        self.blockchain.close()
+        super(TestTimeIndex, self).tearDown()
+
+    def test_lookups(self):
+        self.assertEqual(1400000000, self.blockchain.time_at_height(0))
+        self.assertEqual(1400000000 + 60 * 299, self.blockchain.time_at_height(299))
+        self.assertIsNone(self.blockchain.time_at_height(300))
+        self.assertEqual(-1, self.blockchain.height_at_time(1399999999))
+        self.assertEqual(0, self.blockchain.height_at_time(1400000000))
+        self.assertEqual(0, self.blockchain.height_at_time(1400000059))
+        self.assertEqual(100, self.blockchain.height_at_time(1400000000 + 60 * 100))
+        self.assertEqual(299, self.blockchain.height_at_time(1500000000))
+
+    def test_index_follows_new_headers(self):
+        self.assertEqual(299, self.blockchain.height_at_time(1500000000))
+        prev_hash = hash_encode(PoWHash(self.main[-80:]))
+        more = make_chain(10, prev_hash=prev_hash, timestamp=1400000000 + 60 * 300)
+        self.blockchain.verify_chunk(0, (self.main + more).encode('hex'))
+        self.assertEqual(309, self.blockchain.height_at_time(1500000000))
+        self.assertEqual(1400000000 + 60 * 305, self.blockchain.time_at_height(305))
+
+    def test_timestamps_out_of_order(self):
+        prev_hash = hash_encode(PoWHash(self.main[-80:]))
+        # blocks 300 to 304 claim to be older than block 299
+        more = make_chain(5, prev_hash=prev_hash, timestamp=1400000000 + 60 * 290)
+        prev_hash = hash_encode(PoWHash(more[-80:]))
+        more += make_chain(5, prev_hash=prev_hash, timestamp=1400000000 + 60 * 310)
+        self.blockchain.verify_chunk(0, (self.main + more).encode('hex'))
+        self.assertEqual(1400000000 + 60 * 290, self.blockchain.time_at_height(300))
+        self.assertEqual(298, self.blockchain.height_at_time(1400000000 + 60 * 298))
+        # nothing up to 304 is later than block 299
+        self.assertEqual(304, self.blockchain.height_at_time(1400000000 + 60 * 299))
+        self.assertEqual(305, self.blockchain.height_at_time(1400000000 + 60 * 310))
+
+    def test_active_fork(self):
+        prev_hash = hash_encode(PoWHash(self.main[289*80:290*80]))
+        fork = make_chain(20, prev_hash=prev_hash, timestamp=1500000000)
+        self.assertEqual(299, self.blockchain.height_at_time(1500000000))
+        self.blockchain.connect_fork(290, fork)
+        self.assertEqual(1500000000, self.blockchain.time_at_height(290))
+        self.assertEqual(1400000000 + 60 * 289, self.blockchain.time_at_height(289))
+        self.assertEqual(289, self.blockchain.height_at_time(1499999999))
+        self.assertEqual(300, self.blockchain.height_at_time(1500000000 + 60 * 10))
+        self.assertEqual(309, self.blockchain.height_at_time(1600000000))
+
+    def test_index_is_built_for_old_files(self):
+        self.blockchain.close()
+        os.remove(self.blockchain.times_path())
+        self.blockchain = Blockchain(self.config, None)
+        self.blockchain.init()
+        self.assertEqual(300, self.blockchain.times.count())
+        self.assertEqual(1400000000 + 60 * 150, self.blockchain.time_at_height(150))
+        self.assertEqual(150, self.blockchain.height_at_time(1400000000 + 60 * 150))
+
+
+class TestHeaderReader(BlockchainTestCase):
+
+    def setUp(self):
+        super(TestHeaderReader, self).setUp()
+        self.blockchain = Blockchain(self.config, None)
+        self.blockchain.init_headers_file()
+        self.main = make_chain(300)
+        self.blockchain.verify_chunk(0, self.main.encode('hex'))
+        self.reader = HeaderReader(self.config)
+
+    def tearDown(self):
+        self.reader.close()
+        self.blockchain.close()
+        super(TestHeaderReader, self).tearDown()
+
+    def test_read_header(self):
+        self.assertEqual(self.main[100*80:101*80], self.reader.read_header(100).serialize())
+        self.assertEqual(100, self.reader.read_header(100).block_height)
+        self.assertIsNone(self.reader.read_header(300))
+
+    def test_follows_the_writer(self):
+        self.assertIsNone(self.reader.read_header(300))
+        prev_hash = hash_encode(PoWHash(self.main[-80:]))
+        more = make_chain(10, prev_hash=prev_hash, timestamp=1400000000 + 60 * 300)
+        self.blockchain.verify_chunk(0, (self.main + more).encode('hex'))
+        self.assertEqual(more[-80:], self.reader.read_header(309).serialize())
+
+    def test_follows_the_active_fork(self):
+        prev_hash = hash_encode(PoWHash(self.main[289*80:290*80]))
+        fork = make_chain(20, prev_hash=prev_hash, timestamp=1500000000)
+        self.assertEqual(self.main[290*80:291*80], self.reader.read_header(290).serialize())
+        self.blockchain.connect_fork(290, fork)
+        self.assertEqual(fork[:80], self.reader.read_header(290).serialize())
+        self.assertEqual(fork[-80:], self.reader.read_header(309).serialize())
+        self.assertEqual(self.main[289*80:290*80], self.reader.read_header(289).serialize())
+        self.blockchain.set_active_fork(None)
+        self.assertEqual(self.main[290*80:291*80], self.reader.read_header(290).serialize())
@@ -0,0 +1,282 @@
+import shutil
+import tempfile
+import sys
+import time
+import unittest
+import Queue
+
+from collections import deque
+from StringIO import StringIO
+from lib.bitcoin import Hash, PoWHash, hash_encode
+from lib.blockchain import Blockchain, Header
+from lib.network import Network, CHUNK_REQUESTS_PER_SERVER, history_status
+from lib.simple_config import SimpleConfig
+from lib.tests.test_blockchain import make_chain
+
+
+class FakeInterface(object):
+
+    def __init__(self, server):
+        self.server = server
+        self.connected = True
+        self.requests = []
+        self.sent = []
+
+    def is_connected(self):
+        return self.connected
+
+    def stop(self):
+        self.connected = False
+
+    def send_request(self, request):
+        self.requests.append(request['params'][0])
+        self.sent.append(request)
+
+    def print_error(self, *msg):
+        pass
+
+
+class TestChunkDownload(unittest.TestCase):
+
+    def setUp(self):
+        super(TestChunkDownload, self).setUp()
+        self.electrum_dir = tempfile.mkdtemp()
+
+        self._saved_stdout = sys.stdout
+        self._stdout_buffer = StringIO()
+        sys.stdout = self._stdout_buffer
+
+        self.config = SimpleConfig({'electrum_path': self.electrum_dir})
+        # the parts of a network needed to download chunks, without
+        # connecting to any server
+        self.network = Network.__new__(Network)
+        self.network.config = self.config
+        self.network.blockchain = Blockchain(self.config, self.network)
+        self.network.blockchain.init_headers_file()
+        self.network.response_queue = Queue.Queue()
+        self.network.default_server = 'a'
+        self.network.interfaces = {}
+        self.network.heights = {}
+        self.network.chunk_requests = {}
+        self.network.chunk_sources = {}
+        self.network.fill_chunks = set()
+        self.network.chunk_rewind = None
+        self.network.bc_requests = deque()
+        self.network.unanswered_requests = {}
+        self.network.spread_requests = {}
+        self.network.spread_count = 0
+
+    def tearDown(self):
+        self.network.blockchain.close()
+        super(TestChunkDownload, self).tearDown()
+        shutil.rmtree(self.electrum_dir)
+        # Restore the "real" stdout
+        sys.stdout = self._saved_stdout
+
+    def add_interface(self, server, height):
+        interface = FakeInterface(server)
+        self.network.interfaces[server] = interface
+        self.network.heights[server] = height
+        return interface
+
+    def test_requests_spread_over_servers(self):
+        a = self.add_interface('a', 100000)
+        b = self.add_interface('b', 100000)
+        self.network.request_chunks()
+        self.assertEqual(CHUNK_REQUESTS_PER_SERVER, len(a.requests))
+        self.assertEqual(CHUNK_REQUESTS_PER_SERVER, len(b.requests))
+        self.assertEqual(range(2 * CHUNK_REQUESTS_PER_SERVER), sorted(a.requests + b.requests))
+        # nothing more until a request is answered
+        self.network.request_chunks()
+        self.assertEqual(2 * CHUNK_REQUESTS_PER_SERVER, len(a.requests + b.requests))
+
+    def test_server_must_have_chunk(self):
+        a = self.add_interface('a', 100000)
+        b = self.add_interface('b', 1000)
+        self.network.request_chunks()
+        self.assertEqual([], b.requests)
+        self.assertEqual(range(CHUNK_REQUESTS_PER_SERVER), a.requests)
+
+    def test_timed_out_request_goes_to_other_server(self):
+        a = self.add_interface('a', 100000)
+        self.network.request_chunks()
+        b = self.add_interface('b', 100000)
+        interface, req_time = self.network.chunk_requests[0]
+        self.network.chunk_requests[0] = interface, req_time - 60
+        self.network.request_chunks()
+        self.assertFalse(a.is_connected())
+        self.assertEqual(b, self.network.chunk_requests[0][0])
+        self.assertEqual(0, b.requests[0])
+
+    def test_no_chunks_close_to_tip(self):
+        a = self.add_interface('a', 40)
+        self.network.request_chunks()
+        self.assertEqual([], a.requests)
+
+    def test_chunks_connect_in_order(self):
+        data = make_chain(2016 * 2 + 100)
+        a = self.add_interface('a', 2016 * 2 + 99)
+        b = self.add_interface('b', 2016 * 2 + 99)
+        self.network.request_chunks()
+        self.assertEqual([0, 1, 2], sorted(a.requests + b.requests))
+        for idx in [2, 1, 0]:
+            interface = self.network.chunk_requests[idx][0]
+            hexdata = data[idx*2016*80:(idx+1)*2016*80].encode('hex')
+            self.network.on_get_chunk(interface, {'params': [idx], 'result': hexdata})
+        self.assertEqual({}, self.network.chunk_requests)
+        deadline = time.time() + 10
+        while self.network.blockchain.queued_chunks and time.time() < deadline:
+            self.network.connect_chunks()
+        self.assertEqual(2016 * 2 + 99, self.network.blockchain.height())
+
+    def test_server_of_bad_chunk_is_dismissed(self):
+        data = make_chain(2016 * 2 + 100)
+        a = self.add_interface('a', 2016 * 2 + 99)
+        b = self.add_interface('b', 2016 * 2 + 99)
+        self.network.request_chunks()
+        bad = make_chain(2016, prev_hash='11'*32)
+        for idx in [0, 1]:
+            interface = self.network.chunk_requests[idx][0]
+            hexdata = (bad if interface == b else data[idx*2016*80:(idx+1)*2016*80]).encode('hex')
+            self.network.on_get_chunk(interface, {'params': [idx], 'result': hexdata})
+        deadline = time.time() + 10
+        while self.network.blockchain.queued_chunks and time.time() < deadline:
+            self.network.connect_chunks()
+        self.assertTrue(a.is_connected())
+        self.assertFalse(b.is_connected())
+        self.assertEqual({}, self.network.chunk_sources)
+
+    def test_unsolicited_chunk_is_ignored(self):
+        a = self.add_interface('a', 100000)
+        b = self.add_interface('b', 100000)
+        self.network.on_get_chunk(a, {'params': [0], 'result': '00' * 80})
+        self.assertEqual({}, self.network.blockchain.queued_chunks)
+
+    def test_chunk_that_is_not_a_string_is_ignored(self):
+        a = self.add_interface('a', 100000)
+        self.network.request_chunks()
+        self.network.on_get_chunk(a, {'params': [0], 'result': [0, 123]})
+        self.assertEqual({}, self.network.blockchain.queued_chunks)
+
+
+class TestForkSearch(TestChunkDownload):
+
+    def answer(self, interface, chain):
+        '''Answer the last request sent to interface from chain'''
+        request = interface.sent[-1]
+        height = request['params'][0]
+        if request['method'] == 'blockchain.block.get_header':
+            header = Header.deserialize(chain, height*80, block_height=height).as_dict()
+            self.network.on_get_header(interface, {'params': [height], 'result': header})
+        else:
+            data = chain[height*2016*80:(height+1)*2016*80].encode('hex')
+            self.network.on_get_chunk(interface, {'params': [height], 'result': data})
+
+    def test_reorg(self):
+        main = make_chain(2100)
+        self.network.blockchain.verify_chunk(0, main[:2016*80].encode('hex'))
+        self.network.blockchain.verify_chunk(1, main[2016*80:].encode('hex'))
+        prev_hash = hash_encode(PoWHash(main[1999*80:2000*80]))
+        server = main[:2000*80] + make_chain(110, prev_hash=prev_hash, timestamp=1500000000)
+        a = self.add_interface('a', 2109)
+        self.network.bc_requests.append((a, {'if_height': 2109}))
+        self.network.handle_bc_requests()
+        while self.network.bc_requests:
+            self.answer(a, server)
+        self.assertTrue(a.is_connected())
+        # far fewer requests than one per header of the branch
+        self.assertTrue(len(a.sent) < 40)
+        self.assertEqual(2109, self.network.blockchain.height())
+        self.assertEqual(server[2000*80:], self.network.blockchain.read_raw(2000, 110))
+        self.assertEqual(2000, self.network.blockchain.active_fork.fork_height)
+
+
+class TestSpreadRequests(TestChunkDownload):
+
+    def setUp(self):
+        super(TestSpreadRequests, self).setUp()
+        self.a = self.add_interface('a', 100)
+        self.b = self.add_interface('b', 100)
+        self.network.interface = self.a
+        self.network.subscribed_addresses = set()
+        self.network.addr_responses = {}
+        self.history = [{'tx_hash': '%064x' % 1, 'height': 10}, {'tx_hash': '%064x' % 2, 'height': 0}]
+
+    def request(self, _id, method, param):
+        self.network.process_request({'id': _id, 'method': method, 'params': [param]})
+
+    def answer(self, interface, _id, method, param, result=None, error=None):
+        self.network.process_response(interface, {'id': _id, 'method': method, 'params': [param],
+                                                  'result': result, 'error': error})
+
+    def test_main_server_only_by_default(self):
+        for _id in range(4):
+            self.request(_id, 'blockchain.address.get_history', 'addr%d' % _id)
+        self.assertEqual(4, len(self.a.requests))
+        self.assertEqual([], self.b.requests)
+
+    def test_requests_are_spread(self):
+        self.config.set_key('spread_requests', True)
+        for _id in range(4):
+            self.request(_id, 'blockchain.address.get_history', 'addr%d' % _id)
+        self.request(4, 'blockchain.address.subscribe', 'addr')
+        self.assertEqual(['addr0', 'addr2'], self.b.requests)
+        self.assertEqual(['addr1', 'addr3', 'addr'], self.a.requests)
+        self.network.addr_responses['addr0'] = history_status(self.history)
+        self.answer(self.b, 0, 'blockchain.address.get_history', 'addr0', self.history)
+        self.assertEqual(self.history, self.network.response_queue.get_nowait()['result'])
+        self.assertNotIn(0, self.network.unanswered_requests)
+        # a request that was not sent to the server is ignored
+        self.answer(self.b, 1, 'blockchain.address.get_history', 'addr1', self.history)
+        self.assertTrue(self.network.response_queue.empty())
+
+    def test_lagging_server_gets_no_requests(self):
+        self.config.set_key('spread_requests', True)
+        self.network.heights['b'] = 99
+        for _id in range(4):
+            self.request(_id, 'blockchain.address.get_history', 'addr%d' % _id)
+        self.assertEqual([], self.b.requests)
+
+    def test_bad_answers_go_to_main(self):
+        self.config.set_key('spread_requests', True)
+        for _id in range(4):
+            self.request(_id, 'blockchain.address.get_history', 'addr%d' % _id)
+        self.request(4, 'blockchain.transaction.get', 'tx')
+        self.request(5, 'blockchain.transaction.get', 'tx')
+        self.assertEqual(['addr0', 'addr2', 'tx'], self.b.requests)
+        # the status announced by the main server does not match
+        self.network.addr_responses['addr0'] = history_status(self.history[:1])
+        self.answer(self.b, 0, 'blockchain.address.get_history', 'addr0', self.history)
+        self.answer(self.b, 2, 'blockchain.address.get_history', 'addr2', error='busy')
+        self.answer(self.b, 4, 'blockchain.transaction.get', 'tx', error='not found')
+        self.assertTrue(self.network.response_queue.empty())
+        self.assertEqual(['addr1', 'addr3', 'tx', 'addr0', 'addr2', 'tx'], self.a.requests)
+        self.assertEqual({}, self.network.spread_requests)
+        self.answer(self.a, 0, 'blockchain.address.get_history', 'addr0', self.history)
+        self.assertEqual(self.history, self.network.response_queue.get_nowait()['result'])
+
+    def test_transactions_are_checked(self):
+        self.config.set_key('spread_requests', True)
+        raw = '01' * 60
+        tx_hash = hash_encode(Hash(raw.decode('hex')))
+        for _id in range(6):
+            self.request(_id, 'blockchain.transaction.get', tx_hash)
+        self.assertEqual([tx_hash] * 3, self.b.requests)
+        self.answer(self.b, 0, 'blockchain.transaction.get', tx_hash, raw)
+        self.assertEqual(raw, self.network.response_queue.get_nowait()['result'])
+        self.answer(self.b, 2, 'blockchain.transaction.get', tx_hash, '02' * 60)
+        self.answer(self.b, 4, 'blockchain.transaction.get', tx_hash, 'not hex')
+        self.assertTrue(self.network.response_queue.empty())
+        self.assertEqual([tx_hash] * 5, self.a.requests)
+        self.assertEqual({}, self.network.spread_requests)
+
+    def test_requests_of_lost_server_go_to_main(self):
+        self.config.set_key('spread_requests', True)
+        for _id in range(4):
+            self.request(_id, 'blockchain.address.get_history', 'addr%d' % _id)
+        self.network.notify = lambda key: None
+        self.network.disconnected_servers = set()
+        self.b.stop()
+        self.network.process_if_notification(self.b)
+        self.assertEqual(['addr1', 'addr3', 'addr0', 'addr2'], self.a.requests)
+        self.assertEqual({}, self.network.spread_requests)
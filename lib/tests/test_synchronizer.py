@@ -0,0 +1,181 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from StringIO import StringIO
+from lib.synchronizer import WalletSynchronizer
+
+# the coinbase transaction of the bitcoin genesis block
+GENESIS_TX = ('01000000010000000000000000000000000000000000000000000000000000000000000000ffffffff4d04ffff001d0104455468652054696d65732030332f4a616e2f32303039204368616e63656c6c6f72206f6e206272696e6b206f66207365636f6e64206261696c6f757420666f722062616e6b73ffffffff0100f2052a01000000434104678afdb0fe5548271967f1a67130b7105cd6a828e03909a67962e0ea1f61deb649f6bc3f4cef38c4f35504e51ec112de5c384df7ba0b8d578a4c702b6bf11d5fac00000000')
+GENESIS_TX_HASH = '4a5e1e4baab89f3a32518a88c31bc87f618f76673e2cc77ab2127b7afdeda33b'
+
+
+class FakeNetwork(object):
+
+    def __init__(self, config):
+        self.config = config
+        self.unanswered_requests = {}
+        self.message_id = 0
+        self.sent = []
+
+    def send(self, messages, callback):
+        ids = []
+        for method, params in messages:
+            self.unanswered_requests[self.message_id] = method, params, callback
+            self.sent.append((method, params))
+            ids.append(self.message_id)
+            self.message_id += 1
+        return ids
+
+    def trigger_callback(self, event):
+        pass
+
+    def answer(self, result, params=None):
+        '''Answer the oldest unanswered request, with params if given'''
+        _id = min(i for i, (m, p, c) in self.unanswered_requests.items()
+                  if params is None or p == params)
+        method, params, callback = self.unanswered_requests.pop(_id)
+        callback({'id': _id, 'method': method, 'params': params,
+                  'result': result, 'error': None})
+
+
+class FakeStorage(object):
+
+    def __init__(self, path=None):
+        self.path = path
+
+
+class FakeWallet(object):
+
+    def __init__(self, addresses, history, path=None):
+        self._addresses = addresses
+        self.history = history
+        self.transactions = {}
+        self.tx_addr_hist = {}
+        for addr, h in history.items():
+            for tx_hash, tx_height in h:
+                self.tx_addr_hist.setdefault(tx_hash, set()).add(addr)
+        self.storage = FakeStorage(path)
+        self.batches = []
+
+    def receive_txs_callback(self, txs):
+        self.batches.append([tx_hash for tx_hash, tx, tx_height in txs])
+        for tx_hash, tx, tx_height in txs:
+            self.transactions[tx_hash] = tx
+
+    def addresses(self, include_change):
+        return self._addresses
+
+    def address_reported(self, addr):
+        pass
+
+    def get_address_status(self, addr):
+        return self.get_status(self.history.get(addr, []))
+
+    def get_status(self, h):
+        return None if not h else 'status'
+
+
+class TestWalletSynchronizer(unittest.TestCase):
+
+    def setUp(self):
+        super(TestWalletSynchronizer, self).setUp()
+        self._saved_stdout = sys.stdout
+        sys.stdout = StringIO()
+        self.config = {'sync_requests': 10}
+        self.network = FakeNetwork(self.config)
+
+    def tearDown(self):
+        super(TestWalletSynchronizer, self).tearDown()
+        sys.stdout = self._saved_stdout
+
+    def test_requests_are_limited(self):
+        addresses = ['addr%d' % i for i in range(25)]
+        synchronizer = WalletSynchronizer(FakeWallet(addresses, {}), self.network)
+        synchronizer.send_requests()
+        self.assertEqual(10, len(self.network.sent))
+        self.assertEqual({'subscriptions': 15, 'histories': 0, 'transactions': 0, 'sent': 10},
+                         synchronizer.get_queue_depths())
+        for i in range(5):
+            self.network.answer(None)
+        self.assertEqual(15, len(self.network.sent))
+        self.assertFalse(synchronizer.is_up_to_date())
+        while self.network.unanswered_requests:
+            self.network.answer(None)
+        self.assertEqual(25, len(self.network.sent))
+        self.assertTrue(synchronizer.is_up_to_date())
+
+    def test_busy_network(self):
+        synchronizer = WalletSynchronizer(FakeWallet(['addr'], {}), self.network)
+        for i in range(1000):
+            self.network.unanswered_requests[-1 - i] = None
+        synchronizer.send_requests()
+        self.assertEqual([], self.network.sent)
+
+    def test_priorities(self):
+        history = {'a': [('%064x' % h, h) for h in [5, 20, 0, 10]]}
+        synchronizer = WalletSynchronizer(FakeWallet(['a', 'b'], history), self.network)
+        synchronizer.send_requests()
+        self.assertEqual(['blockchain.address.subscribe'] * 2 + ['blockchain.transaction.get'] * 4,
+                         [method for method, params in self.network.sent])
+        # unconfirmed, then the most recent
+        self.assertEqual([0, 20, 10, 5], [params[1] for method, params in self.network.sent[2:]])
+
+
+class TestTxJournal(unittest.TestCase):
+
+    def setUp(self):
+        super(TestTxJournal, self).setUp()
+        self._saved_stdout = sys.stdout
+        sys.stdout = StringIO()
+        self.wallet_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.wallet_dir, 'wallet')
+        self.network = FakeNetwork({})
+        self.history = {'a': [(GENESIS_TX_HASH, 1), ('%064x' % 1, 2)]}
+
+    def tearDown(self):
+        super(TestTxJournal, self).tearDown()
+        shutil.rmtree(self.wallet_dir)
+        sys.stdout = self._saved_stdout
+
+    def test_txs_are_given_in_batches(self):
+        wallet = FakeWallet(['a'], self.history, self.path)
+        synchronizer = WalletSynchronizer(wallet, self.network)
+        synchronizer.send_requests()
+        self.network.answer(GENESIS_TX, [GENESIS_TX_HASH, 1])
+        self.assertEqual([], wallet.batches)
+        synchronizer.receive_txs()
+        self.assertEqual([[GENESIS_TX_HASH]], wallet.batches)
+        self.assertEqual(set([('%064x' % 1, 2)]), synchronizer.requested_tx)
+        # a transaction that does not match its hash is not added, and
+        # it is requested again
+        self.network.answer(GENESIS_TX, ['%064x' % 1, 2])
+        synchronizer.receive_txs()
+        self.assertEqual([[GENESIS_TX_HASH], []], wallet.batches)
+        self.assertEqual(set([('%064x' % 1, 2)]), synchronizer.requested_tx)
+        synchronizer.send_requests()
+        self.assertEqual(2, self.network.sent.count(('blockchain.transaction.get', ['%064x' % 1, 2])))
+        self.network.answer('not hex', ['%064x' % 1, 2])
+        synchronizer.receive_txs()
+        synchronizer.send_requests()
+        self.assertEqual(3, self.network.sent.count(('blockchain.transaction.get', ['%064x' % 1, 2])))
+
+    def test_journal_is_replayed(self):
+        wallet = FakeWallet(['a'], self.history, self.path)
+        synchronizer = WalletSynchronizer(wallet, self.network)
+        synchronizer.send_requests()
+        self.network.answer(GENESIS_TX, [GENESIS_TX_HASH, 1])
+        synchronizer.receive_txs()
+        self.assertTrue(os.path.exists(self.path + '.txs'))
+        # restart before the wallet file was saved
+        wallet = FakeWallet(['a'], self.history, self.path)
+        network = FakeNetwork({})
+        synchronizer = WalletSynchronizer(wallet, network)
+        self.assertEqual([[GENESIS_TX_HASH]], wallet.batches)
+        synchronizer.send_requests()
+        self.assertEqual([['%064x' % 1, 2]], [params for method, params in network.sent
+                                             if method == 'blockchain.transaction.get'])
+        synchronizer.journal.clear()
+        self.assertEqual([], synchronizer.journal.read())
@@ -0,0 +1,278 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from StringIO import StringIO
+from lib.bitcoin import Hash, hash_encode
+from lib.blockchain import Header
+from lib.simple_config import SimpleConfig
+from lib import verifier
+from lib.verifier import SPV, MerkleCache, MAX_MERKLE_REQUESTS, MERKLE_BATCH_SIZE
+
+
+class FakeNetwork(object):
+
+    def __init__(self, config, local_height):
+        self.config = config
+        self.local_height = local_height
+        self.sent = []
+        self.headers = {}
+        self.header_requests = []
+        self.callbacks = {}
+        self.reorg_height = None
+
+    def get_local_height(self):
+        return self.local_height
+
+    def send(self, messages, callback):
+        self.sent.append(messages)
+        return range(len(messages))
+
+    def get_header(self, height):
+        self.header_requests.append(height)
+        return self.headers.get(height)
+
+    def register_callback(self, event, callback):
+        self.callbacks[event] = callback
+
+
+class FakeWallet(object):
+
+    def __init__(self):
+        self.verified_tx = {}
+        self.unverified_tx = {}
+
+    def add_verified_tx(self, tx_hash, info):
+        self.verified_tx[tx_hash] = info
+
+    def undo_verifications(self, height):
+        txs = [tx_hash for tx_hash, info in self.verified_tx.items() if info[0] >= height]
+        for tx_hash in txs:
+            self.verified_tx.pop(tx_hash)
+        return txs
+
+
+def tx_hashes(count):
+    return [hash_encode(Hash('tx%d' % i)) for i in range(count)]
+
+
+def proof(height, pos=0, count=0):
+    return {'block_height': height, 'pos': pos, 'merkle': tx_hashes(count)}
+
+
+class VerifierTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(VerifierTestCase, self).setUp()
+        self.electrum_dir = tempfile.mkdtemp()
+        self._saved_stdout = sys.stdout
+        sys.stdout = StringIO()
+        self.config = SimpleConfig({'electrum_path': self.electrum_dir})
+
+    def tearDown(self):
+        super(VerifierTestCase, self).tearDown()
+        shutil.rmtree(self.electrum_dir)
+        sys.stdout = self._saved_stdout
+
+
+class TestMerkleCache(VerifierTestCase):
+
+    def setUp(self):
+        super(TestMerkleCache, self).setUp()
+        self.path = os.path.join(self.electrum_dir, 'merkle_proofs')
+        self.cache = MerkleCache(self.path)
+
+    def tearDown(self):
+        self.cache.close()
+        super(TestMerkleCache, self).tearDown()
+
+    def reopen(self):
+        self.cache.close()
+        self.cache = MerkleCache(self.path)
+
+    def test_put_get(self):
+        a, b = tx_hashes(2)
+        self.cache.put(a, proof(10, 3, 5))
+        self.cache.put(b, proof(11, 0, 0))
+        self.assertEqual(proof(10, 3, 5), self.cache.get(a))
+        self.assertEqual(proof(11, 0, 0), self.cache.get(b))
+        self.assertIsNone(self.cache.get('00' * 32))
+        self.reopen()
+        self.assertEqual(proof(10, 3, 5), self.cache.get(a))
+
+    def test_file_is_not_opened_by_lookups(self):
+        a = tx_hashes(1)[0]
+        self.cache.put(a, proof(10, 3, 5))
+        opened = []
+        verifier.open = lambda *args: opened.append(args)
+        try:
+            self.assertEqual(proof(10, 3, 5), self.cache.get(a))
+            self.assertEqual(proof(10, 3, 5), self.cache.get(a))
+        finally:
+            del verifier.open
+        self.assertEqual([], opened)
+
+    def test_new_proof_hides_old_one(self):
+        a = tx_hashes(1)[0]
+        self.cache.put(a, proof(10, 3, 5))
+        self.cache.put(a, proof(12, 1, 4))
+        self.assertEqual(proof(12, 1, 4), self.cache.get(a))
+        self.reopen()
+        self.assertEqual(proof(12, 1, 4), self.cache.get(a))
+
+    def test_invalidate(self):
+        a, b, c = tx_hashes(3)
+        self.cache.put(a, proof(10, 1, 2))
+        self.cache.put(b, proof(20, 1, 2))
+        self.cache.put(c, proof(30, 1, 2))
+        self.assertEqual(sorted([b, c]), sorted(self.cache.invalidate(20)))
+        self.assertIsNone(self.cache.get(b))
+        self.reopen()
+        self.assertEqual(proof(10, 1, 2), self.cache.get(a))
+        self.assertIsNone(self.cache.get(b))
+        self.assertIsNone(self.cache.get(c))
+
+    def test_partial_record_is_dropped(self):
+        a, b = tx_hashes(2)
+        self.cache.put(a, proof(10, 1, 2))
+        self.cache.put(b, proof(20, 1, 2))
+        self.cache.close()
+        with open(self.path, 'rb+') as f:
+            f.truncate(os.path.getsize(self.path) - 10)
+        self.reopen()
+        self.assertEqual(proof(10, 1, 2), self.cache.get(a))
+        self.assertIsNone(self.cache.get(b))
+        self.cache.put(b, proof(20, 1, 2))
+        self.reopen()
+        self.assertEqual(proof(20, 1, 2), self.cache.get(b))
+
+    def test_compaction(self):
+        a, b = tx_hashes(2)
+        for height in range(100):
+            self.cache.put(a, proof(height, 1, 10))
+        self.cache.put(b, proof(5, 1, 10))
+        size = os.path.getsize(self.path)
+        self.reopen()
+        self.assertTrue(os.path.getsize(self.path) < size / 10)
+        self.assertEqual(proof(99, 1, 10), self.cache.get(a))
+        self.assertEqual(proof(5, 1, 10), self.cache.get(b))
+
+
+class TestSPV(VerifierTestCase):
+
+    def setUp(self):
+        super(TestSPV, self).setUp()
+        self.network = FakeNetwork(self.config, 1000)
+        self.wallet = FakeWallet()
+        self.spv = SPV(self.network, self.wallet)
+
+    def tearDown(self):
+        self.spv.proofs.close()
+        super(TestSPV, self).tearDown()
+
+    def requested(self):
+        return [params for messages in self.network.sent for method, params in messages]
+
+    def test_requests_are_batched_and_bounded(self):
+        for i, tx_hash in enumerate(tx_hashes(MAX_MERKLE_REQUESTS + 10)):
+            self.spv.add(tx_hash, 500 + i % 3)
+        self.spv.request_merkles()
+        self.assertEqual(MAX_MERKLE_REQUESTS / MERKLE_BATCH_SIZE, len(self.network.sent))
+        self.assertEqual(MAX_MERKLE_REQUESTS, len(self.requested()))
+        # lowest heights first
+        self.assertEqual([500, 501], sorted(set(h for tx_hash, h in self.requested()[:140])))
+        # nothing more until branches are received
+        self.spv.request_merkles()
+        self.assertEqual(MAX_MERKLE_REQUESTS, len(self.requested()))
+        tx_hash, tx_height = self.requested()[0]
+        self.spv.process_response({'method': 'blockchain.transaction.get_merkle',
+                                   'params': [tx_hash, tx_height], 'error': 'no'})
+        self.spv.request_merkles()
+        self.assertEqual(MAX_MERKLE_REQUESTS + 1, len(self.requested()))
+
+    def test_no_request_beyond_local_height(self):
+        self.spv.add(tx_hashes(1)[0], 1001)
+        self.spv.request_merkles()
+        self.assertEqual([], self.requested())
+        self.network.local_height = 1001
+        self.spv.request_merkles()
+        self.assertEqual([[tx_hashes(1)[0], 1001]], self.requested())
+
+    def test_duplicates_are_not_requested(self):
+        tx_hash = tx_hashes(1)[0]
+        self.spv.add(tx_hash, 10)
+        self.spv.add(tx_hash, 10)
+        self.spv.request_merkles()
+        self.spv.add(tx_hash, 10)
+        self.spv.request_merkles()
+        self.assertEqual([[tx_hash, 10]], self.requested())
+        self.wallet.verified_tx['a' * 64] = (10, 0, 0)
+        self.spv.add('a' * 64, 10)
+        self.assertEqual({}, self.spv.unrequested)
+
+    def test_headers_are_read_once_per_height(self):
+        results = []
+        for tx_hash in tx_hashes(6):
+            # a block of a single transaction
+            results.append((tx_hash, {'block_height': 7, 'pos': 0, 'merkle': []}))
+        self.network.headers[7] = Header(2, '\0' * 32, Hash('tx0'), 1400000000, 0, 0)
+        self.spv.verify_merkles(results)
+        self.assertEqual([7], self.network.header_requests)
+        self.assertEqual({tx_hashes(1)[0]: (7, 1400000000, 0)}, self.wallet.verified_tx)
+
+    def test_missing_header_is_retried(self):
+        tx_hash = tx_hashes(1)[0]
+        self.spv.verify_merkles([(tx_hash, {'block_height': 7, 'pos': 0, 'merkle': []})])
+        self.assertEqual([tx_hash], self.spv.pending_headers.keys())
+        self.network.headers[7] = Header(2, '\0' * 32, Hash('tx0'), 1400000000, 0, 0)
+        self.spv.verify_merkles(self.spv.pending_headers.items())
+        self.assertEqual({}, self.spv.pending_headers)
+        self.assertEqual([tx_hash], self.wallet.verified_tx.keys())
+
+    def test_cached_proofs_are_not_requested(self):
+        a, b = tx_hashes(2)
+        self.network.headers[7] = Header(2, '\0' * 32, Hash('tx0'), 1400000000, 0, 0)
+        self.spv.verify_merkles([(a, proof(7))])
+        self.assertEqual(proof(7), self.spv.proofs.get(a))
+        # the wallet file was reset
+        self.wallet.verified_tx = {}
+        self.spv.proofs.close()
+        self.spv = SPV(self.network, self.wallet)
+        size = os.path.getsize(self.spv.proofs.path)
+        self.spv.add(a, 7)
+        self.spv.add(b, 7)
+        self.spv.request_merkles()
+        self.assertEqual([[b, 7]], self.requested())
+        self.assertEqual([a], self.wallet.verified_tx.keys())
+        # the cached proof is not written again
+        self.assertEqual(size, os.path.getsize(self.spv.proofs.path))
+
+    def test_stale_proof_is_requested_again(self):
+        a = tx_hashes(1)[0]
+        self.spv.proofs.put(a, proof(7))
+        # the header of block 7 does not commit to a
+        self.network.headers[7] = Header(2, '\0' * 32, Hash('other'), 1400000000, 0, 0)
+        self.spv.add(a, 7)
+        self.spv.request_merkles()
+        self.assertEqual([], self.requested())
+        self.assertIsNone(self.spv.proofs.get(a))
+        self.spv.request_merkles()
+        self.assertEqual([[a, 7]], self.requested())
+
+    def test_reorg_undoes_verifications(self):
+        a, b = tx_hashes(2)
+        self.network.headers[5] = Header(2, '\0' * 32, Hash('tx0'), 1400000000, 0, 0)
+        self.network.headers[7] = Header(2, '\0' * 32, Hash('tx1'), 1400000000, 0, 0)
+        self.spv.verify_merkles([(a, proof(5)), (b, proof(7))])
+        self.assertEqual(set([a, b]), set(self.wallet.verified_tx))
+        self.wallet.unverified_tx = {a: 5, b: 7}
+        self.network.reorg_height = 6
+        self.network.callbacks['reorg']()
+        self.spv.handle_reorg()
+        self.assertEqual([a], self.wallet.verified_tx.keys())
+        self.assertIsNone(self.spv.proofs.get(b))
+        # b is verified again
+        self.spv.request_merkles()
+        self.assertEqual([[b, 7]], self.requested())
@@ -4,9 +4,13 @@ import sys
 import unittest
 import os
 import json
+import threading
+import time
 
 from StringIO import StringIO
-from lib.wallet import WalletStorage, NewWallet
+from lib.transaction import Transaction
+from lib.wallet import WalletStorage, SqliteWalletStorage, NewWallet, is_sqlite_file, open_storage
+from lib.wallet import TransactionTable, TrackedDict, TX_CACHE_SIZE
 
 
 class FakeSynchronizer(object):
@@ -64,6 +68,364 @@ class TestWalletStorage(WalletTestCase):
             contents = f.read()
         self.assertEqual(some_dict, json.loads(contents))
 
+    def read_file(self):
+        with open(self.wallet_path, "r") as f:
+            return json.loads(f.read())
+
+    def test_lazy_keys_are_coalesced(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.write_delay = 60
+        verified = {}
+        for i in range(100):
+            verified['%064x' % i] = (i, 0, 0)
+            storage.put('verified_tx3', verified, True)
+        self.assertFalse(os.path.exists(self.wallet_path))
+        self.assertEqual(verified, storage.get('verified_tx3'))
+        storage.sync()
+        self.assertEqual(100, len(self.read_file()['verified_tx3']))
+        self.assertIsNone(storage.timer)
+
+    def test_lazy_keys_are_written_after_delay(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.write_delay = 0.01
+        storage.put('stored_height', 10, True)
+        storage.timer.join()
+        self.assertEqual(10, self.read_file()['stored_height'])
+
+    def test_other_keys_are_written_at_once(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.write_delay = 60
+        storage.put('stored_height', 10, True)
+        storage.put('labels', {'a': 'b'}, True)
+        self.assertEqual({'stored_height': 10, 'labels': {'a': 'b'}}, self.read_file())
+        self.assertIsNone(storage.timer)
+
+    def test_lazy_keys_are_written_under_their_lock(self):
+        storage = WalletStorage(self.wallet_path)
+        lock = threading.RLock()
+        storage.locks = [lock]
+        storage.write_delay = 60
+        storage.put('verified_tx3', {'a': (1, 0, 0)}, True)
+        with lock:
+            writer = threading.Thread(target=storage.sync)
+            writer.start()
+            writer.join(0.1)
+            self.assertTrue(writer.is_alive())
+            self.assertFalse(os.path.exists(self.wallet_path))
+        writer.join()
+        self.assertEqual({'a': [1, 0, 0]}, self.read_file()['verified_tx3'])
+
+    def test_put_under_its_lock_while_the_timer_fires(self):
+        storage = WalletStorage(self.wallet_path)
+        lock = threading.RLock()
+        storage.locks = [lock]
+        storage.write_delay = 0.05
+        def put():
+            with lock:
+                storage.put('verified_tx3', {'a': (1, 0, 0)}, True)
+                # the timer fires while the lock is held
+                time.sleep(0.2)
+                storage.put('addr_history', {'b': []}, True)
+        writer = threading.Thread(target=put)
+        writer.start()
+        writer.join(5)
+        self.assertFalse(writer.is_alive())
+        storage.sync()
+        self.assertEqual({'b': []}, self.read_file()['addr_history'])
+
+    def test_transactions_are_encoded_when_written(self):
+        raw = '01' * 60
+        storage = WalletStorage(self.wallet_path)
+        table = TransactionTable({'%064x' % 1: raw})
+        storage.put('transactions', table, True)
+        storage.sync()
+        # no hex copy is kept
+        self.assertIs(table, storage.data['transactions'])
+        self.assertEqual({'%064x' % 1: raw}, self.read_file()['transactions'])
+        self.assertEqual({'%064x' % 1: raw}, storage.get('transactions'))
+        storage = WalletStorage(self.wallet_path)
+        table = storage.take_transactions()
+        self.assertIs(table, storage.data['transactions'])
+        self.assertEqual(raw.decode('hex'), table.raw['%064x' % 1])
+
+    def test_take_does_not_copy(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put('txi', {'a': {}}, True)
+        storage.sync()
+        storage = WalletStorage(self.wallet_path)
+        txi = storage.take('txi', {})
+        self.assertIs(txi, storage.take('txi'))
+        self.assertIsNot(txi, storage.get('txi'))
+        txi['b'] = {}
+        storage.put('txi', txi, True)
+        storage.sync()
+        self.assertEqual({'a': {}, 'b': {}}, self.read_file()['txi'])
+
+    def test_take_copies_in_journal_mode(self):
+        storage = WalletStorage(self.wallet_path, journal=True)
+        storage.put('txi', {'a': {}}, True)
+        storage.sync()
+        self.assertIsNot(storage.take('txi'), storage.take('txi'))
+
+
+class TestJournal(WalletTestCase):
+
+    def setUp(self):
+        super(TestJournal, self).setUp()
+        self.storage = WalletStorage(self.wallet_path, journal=True)
+        self.storage.put('labels', {'a': 'b'}, True)
+        self.labels = dict(('%064x' % i, 'label') for i in range(100))
+        self.storage.put('labels', self.labels, True)
+
+    def tearDown(self):
+        self.storage.sync()
+        super(TestJournal, self).tearDown()
+
+    def journal_lines(self):
+        with open(self.wallet_path + '.journal', 'rb') as f:
+            return f.readlines()
+
+    def test_changes_are_appended(self):
+        self.assertEqual({'labels': {'a': 'b'}}, json.loads(open(self.wallet_path).read()))
+        self.labels['%064x' % 1] = 'changed'
+        del self.labels['%064x' % 2]
+        self.storage.put('labels', self.labels, True)
+        self.storage.put('use_change', False, True)
+        lines = self.journal_lines()
+        self.assertEqual(3, len(lines))
+        # only the changed items of a dictionary are recorded
+        self.assertEqual([['update', 'labels', {'%064x' % 1: 'changed'}, ['%064x' % 2]]],
+                         json.loads(lines[1]))
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual(self.labels, storage.get('labels'))
+        self.assertFalse(storage.get('use_change'))
+        # the journal was written to the wallet file when it was replayed
+        self.assertEqual(self.labels, json.loads(open(self.wallet_path).read())['labels'])
+        self.assertEqual([], self.journal_lines())
+
+    def test_interrupted_write_is_ignored(self):
+        with open(self.wallet_path + '.journal', 'ab') as f:
+            f.write('[["put", "use_change", fal')
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual(self.labels, storage.get('labels'))
+        self.assertIsNone(storage.get('use_change'))
+
+    def test_key_that_changes_type(self):
+        labels = dict(self.labels)
+        labels['5'] = 'x'
+        self.storage.put('labels', labels, True)
+        labels = dict(self.labels)
+        labels[5] = 'y'
+        self.storage.put('labels', labels, True)
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual('y', storage.get('labels')['5'])
+
+    def test_values_changed_by_other_threads(self):
+        lock = threading.RLock()
+        self.storage.locks = [lock]
+        verified = {}
+        def change():
+            for i in range(20000):
+                with lock:
+                    verified['%064x' % i] = (i, 0, 0)
+        self.storage.put('verified_tx3', verified, False)
+        thread = threading.Thread(target=change)
+        thread.start()
+        while thread.is_alive():
+            self.storage.put('verified_tx3', verified, False)
+            self.storage.sync()
+        thread.join()
+        self.storage.put('verified_tx3', verified, False)
+        self.storage.sync()
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual(20000, len(storage.get('verified_tx3')))
+
+    def test_compaction(self):
+        self.storage.compact_min_size = 0
+        self.storage.put('use_change', False, True)
+        self.storage.sync()
+        self.assertFalse(os.path.exists(self.wallet_path + '.journal.old'))
+        self.assertEqual({'labels': self.labels, 'use_change': False},
+                         json.loads(open(self.wallet_path).read()))
+        self.assertEqual([], self.journal_lines())
+        self.storage.put('use_change', True, True)
+        storage = WalletStorage(self.wallet_path)
+        self.assertTrue(storage.get('use_change'))
+
+
+class TestSqliteStorage(WalletTestCase):
+
+    data = {
+        'seed_version': 11,
+        'labels': {'a': 'b'},
+        'transactions': {'%064x' % 1: '00', '%064x' % 2: '01'},
+        'txi': {'%064x' % 1: {}, '%064x' % 2: {'addr': [['%064x:0' % 1, 10]]}},
+        'txo': {'%064x' % 1: {'addr': [[0, 10, False]]}, '%064x' % 2: {}},
+        'verified_tx3': {'%064x' % 1: [100, 1400000000, 1]},
+        'addr_history': {'addr': [['%064x' % 1, 100], ['%064x' % 2, 0]], 'other': []},
+    }
+
+    def test_values_are_kept(self):
+        storage = SqliteWalletStorage(self.wallet_path)
+        self.assertFalse(storage.file_exists)
+        for key, value in self.data.items():
+            storage.put(key, value, True)
+        storage.close()
+        self.assertTrue(is_sqlite_file(self.wallet_path))
+        storage = SqliteWalletStorage(self.wallet_path)
+        self.assertTrue(storage.file_exists)
+        for key, value in self.data.items():
+            self.assertEqual(value, storage.get(key))
+        storage.close()
+
+    def test_only_changes_are_written(self):
+        storage = SqliteWalletStorage(self.wallet_path)
+        for key, value in self.data.items():
+            storage.put(key, value, True)
+        storage.sync()
+        changes = storage.db.total_changes
+        txo = storage.get('txo')
+        txo['%064x' % 2] = {'addr': [(1, 5, False)]}
+        storage.put('txo', txo, True)
+        storage.sync()
+        # the rows of the transaction are deleted, then written
+        self.assertEqual(2, storage.db.total_changes - changes)
+        # tuples are saved as lists
+        changes = storage.db.total_changes
+        storage.put('txo', txo, True)
+        storage.sync()
+        self.assertEqual(0, storage.db.total_changes - changes)
+        storage.close()
+        self.assertEqual(txo['%064x' % 2], {'addr': [(1, 5, False)]})
+        storage = SqliteWalletStorage(self.wallet_path)
+        self.assertEqual({'addr': [[1, 5, False]]}, storage.get('txo')['%064x' % 2])
+        storage.close()
+
+    def test_taken_values_write_their_changes(self):
+        storage = SqliteWalletStorage(self.wallet_path)
+        for key, value in self.data.items():
+            storage.put(key, value, True)
+        storage.close()
+        storage = SqliteWalletStorage(self.wallet_path)
+        txo = storage.take('txo')
+        self.assertTrue(isinstance(txo, TrackedDict))
+        self.assertEqual(self.data['txo'], txo)
+        # not kept by the storage
+        self.assertNotIn('txo', storage.data)
+        changes = storage.db.total_changes
+        txo['%064x' % 2] = {'addr': [(1, 5, False)]}
+        del txo['%064x' % 1]
+        storage.put('txo', txo, True)
+        storage.sync()
+        # a row deleted for each transaction, and one written
+        self.assertEqual(3, storage.db.total_changes - changes)
+        self.assertNotIn('txo', storage.data)
+        changes = storage.db.total_changes
+        storage.put('txo', txo, True)
+        storage.sync()
+        self.assertEqual(0, storage.db.total_changes - changes)
+        storage.close()
+        storage = SqliteWalletStorage(self.wallet_path)
+        self.assertEqual({'%064x' % 2: {'addr': [[1, 5, False]]}}, storage.get('txo'))
+        storage.close()
+
+    def test_transactions_are_read_when_looked_up(self):
+        raw = '01' * 60
+        storage = SqliteWalletStorage(self.wallet_path)
+        storage.put('transactions', {'%064x' % 1: raw, '%064x' % 2: raw}, True)
+        storage.close()
+        storage = SqliteWalletStorage(self.wallet_path)
+        table = storage.take_transactions()
+        self.assertEqual(sorted(['%064x' % 1, '%064x' % 2]), sorted(table))
+        self.assertEqual({'%064x' % 1: None, '%064x' % 2: None}, table.raw)
+        self.assertEqual(raw, str(table['%064x' % 1]))
+        self.assertEqual(raw.decode('hex'), table.raw['%064x' % 1])
+        self.assertIsNone(table.raw['%064x' % 2])
+        del table['%064x' % 2]
+        storage.put('transactions', table, True)
+        storage.close()
+        storage = SqliteWalletStorage(self.wallet_path)
+        self.assertEqual({'%064x' % 1: raw}, storage.get('transactions'))
+        storage.close()
+
+    def test_value_read_before_it_is_taken(self):
+        storage = SqliteWalletStorage(self.wallet_path)
+        for key, value in self.data.items():
+            storage.put(key, value, True)
+        storage.sync()
+        storage.put('txi', {'%064x' % 3: {}}, False)
+        txi = storage.take('txi')
+        self.assertEqual({'%064x' % 3: {}}, txi)
+        txi['%064x' % 4] = {}
+        storage.put('txi', txi, True)
+        storage.close()
+        storage = SqliteWalletStorage(self.wallet_path)
+        self.assertEqual({'%064x' % 3: {}, '%064x' % 4: {}}, storage.get('txi'))
+        storage.close()
+
+    def test_migration(self):
+        storage = WalletStorage(self.wallet_path)
+        for key, value in self.data.items():
+            storage.put(key, value, True)
+        storage.sync()
+        storage = open_storage(self.wallet_path, {})
+        self.assertFalse(isinstance(storage, SqliteWalletStorage))
+        storage = open_storage(self.wallet_path, {'wallet_sqlite': True})
+        self.assertTrue(isinstance(storage, SqliteWalletStorage))
+        for key, value in self.data.items():
+            self.assertEqual(value, storage.get(key))
+        storage.close()
+        with open(self.wallet_path + '.json') as f:
+            self.assertEqual(self.data, json.loads(f.read()))
+        # the option is not needed any more
+        storage = open_storage(self.wallet_path, {})
+        self.assertTrue(isinstance(storage, SqliteWalletStorage))
+        storage.close()
+
+
+class TestTransactionTable(unittest.TestCase):
+
+    raw_txs = dict(('%064x' % i, '01%062x' % i) for i in range(TX_CACHE_SIZE + 10))
+
+    def test_raw_bytes_are_kept(self):
+        table = TransactionTable(self.raw_txs)
+        self.assertEqual(len(self.raw_txs), len(table))
+        self.assertEqual(self.raw_txs['%064x' % 1].decode('hex'), table.raw['%064x' % 1])
+        self.assertEqual([], table.cache.keys())
+        self.assertEqual(self.raw_txs, table.to_hex())
+        self.assertIsNone(table.get('%064x' % 1000))
+        self.assertNotIn('%064x' % 1000, table)
+
+    def test_changes_are_taken(self):
+        table = TransactionTable(self.raw_txs)
+        self.assertEqual(({}, []), table.take_changes())
+        tx = table['%064x' % 1]
+        table['%064x' % 1000] = tx
+        del table['%064x' % 2]
+        self.assertEqual(({'%064x' % 1000: self.raw_txs['%064x' % 1]}, ['%064x' % 2]),
+                         table.take_changes())
+        self.assertEqual(({}, []), table.take_changes())
+
+    def test_lookups_are_cached(self):
+        table = TransactionTable(self.raw_txs)
+        tx = table['%064x' % 0]
+        self.assertEqual(self.raw_txs['%064x' % 0], str(tx))
+        self.assertIs(tx, table.get('%064x' % 0))
+        for tx_hash in sorted(self.raw_txs)[1:]:
+            table[tx_hash]
+        self.assertEqual(TX_CACHE_SIZE, len(table.cache))
+        self.assertIsNot(tx, table['%064x' % 0])
+
+    def test_set_and_pop(self):
+        table = TransactionTable()
+        tx = Transaction('02' * 10)
+        table['a'] = tx
+        self.assertIs(tx, table['a'])
+        self.assertEqual({'a': '02' * 10}, table.to_hex())
+        self.assertIs(tx, table.pop('a'))
+        self.assertEqual(0, len(table))
+        self.assertEqual({}, table.cache)
+
 
 class TestNewWallet(WalletTestCase):
 
@@ -85,6 +447,10 @@ class TestNewWallet(WalletTestCase):
         self.wallet.create_master_keys(self.password)
         self.wallet.create_main_account(self.password)
 
+    def tearDown(self):
+        self.storage.sync()
+        super(TestNewWallet, self).tearDown()
+
     def test_wallet_with_seed_is_not_watching_only(self):
         self.assertFalse(self.wallet.is_watching_only())
 
@@ -95,6 +461,7 @@ class TestNewWallet(WalletTestCase):
         storage = WalletStorage(os.path.join(new_dir, "somewallet"))
         wallet = NewWallet(storage)
         self.assertTrue(wallet.is_watching_only())
+        storage.sync()
         shutil.rmtree(new_dir)  # Don't leave useless stuff in /tmp
 
     def test_new_wallet_is_deterministic(self):
@@ -107,3 +474,193 @@ class TestNewWallet(WalletTestCase):
         new_password = "secret2"
         self.wallet.update_password(self.password, new_password)
         self.wallet.get_seed(new_password)
+
+
+class FakeNetwork(object):
+
+    def __init__(self, local_height):
+        self.local_height = local_height
+
+    def get_local_height(self):
+        return self.local_height
+
+    def trigger_callback(self, event):
+        pass
+
+
+class TestVerifiedIndex(WalletTestCase):
+
+    def setUp(self):
+        super(TestVerifiedIndex, self).setUp()
+        self.storage = WalletStorage(self.wallet_path)
+        self.wallet = NewWallet(self.storage)
+        self.wallet.network = FakeNetwork(100)
+        for height in range(1, 201):
+            self.wallet.add_unverified_tx('%064x' % height, height)
+
+    def tearDown(self):
+        self.storage.sync()
+        super(TestVerifiedIndex, self).tearDown()
+
+    def test_undo_verifications(self):
+        for height in range(1, 101):
+            self.wallet.add_verified_tx('%064x' % height, (height, 1400000000, 0))
+        undone = self.wallet.undo_verifications(90)
+        self.assertEqual(['%064x' % h for h in range(90, 101)], undone)
+        self.assertEqual(89, len(self.wallet.verified_tx))
+        self.assertEqual(89, len(self.storage.get('verified_tx3')))
+
+    def test_index_is_loaded(self):
+        for height in range(1, 11):
+            self.wallet.add_verified_tx('%064x' % height, (height, 1400000000, 0))
+        self.storage.write()
+        storage = WalletStorage(self.wallet_path)
+        wallet = NewWallet(storage)
+        wallet.network = self.wallet.network
+        self.assertEqual(['%064x' % h for h in range(5, 11)], wallet.undo_verifications(5))
+        storage.sync()
+
+
+class TestAddressStatus(WalletTestCase):
+
+    def setUp(self):
+        super(TestAddressStatus, self).setUp()
+        self.storage = WalletStorage(self.wallet_path)
+        self.wallet = NewWallet(self.storage)
+        self.wallet.network = FakeNetwork(100)
+
+    def tearDown(self):
+        self.storage.sync()
+        super(TestAddressStatus, self).tearDown()
+
+    def test_status_follows_history(self):
+        addr = '15mKKb2eos1hWa6tisdPwwDC1a5J1y9nma'
+        self.assertIsNone(self.wallet.get_address_status(addr))
+        hist = [('%064x' % h, h) for h in range(1, 10)]
+        self.wallet.receive_history_callback(addr, hist)
+        self.assertEqual(self.wallet.get_status(hist), self.wallet.get_address_status(addr))
+        hist = hist + [('%064x' % 10, 0)]
+        self.wallet.receive_history_callback(addr, hist)
+        self.assertEqual(self.wallet.get_status(hist), self.wallet.get_address_status(addr))
+
+
+class FakeTransaction(object):
+
+    def __init__(self, inputs):
+        self.inputs = inputs
+
+    def inputs_without_script(self):
+        return range(len(self.inputs))
+
+
+class TestUtxoIndex(WalletTestCase):
+
+    addr = '15mKKb2eos1hWa6tisdPwwDC1a5J1y9nma'
+
+    def setUp(self):
+        super(TestUtxoIndex, self).setUp()
+        self.storage = WalletStorage(self.wallet_path)
+        self.wallet = NewWallet(self.storage)
+        self.wallet.network = FakeNetwork(100)
+        self.wallet.is_mine = lambda addr: True
+        h1, h2 = '%064x' % 1, '%064x' % 2
+        self.wallet.history = {self.addr: [(h1, 10), (h2, 20)]}
+        self.wallet.txo = {h1: {self.addr: [(0, 1000, False), (1, 500, False)]},
+                           h2: {self.addr: [(0, 300, False)]}}
+        self.wallet.txi = {h1: {}, h2: {self.addr: [(h1 + ':0', 1000)]}}
+        self.wallet.build_reverse_history()
+        self.wallet.build_utxo_index()
+
+    def tearDown(self):
+        self.storage.sync()
+        super(TestUtxoIndex, self).tearDown()
+
+    def coins(self):
+        return sorted((c['prevout_hash'][-1], c['prevout_n'], c['value'], c['height'])
+                      for c in self.wallet.get_spendable_coins([self.addr]))
+
+    def test_index_matches_history(self):
+        self.assertEqual([('1', 1, 500, 10), ('2', 0, 300, 20)], self.coins())
+        received, sent = self.wallet.get_addr_io(self.addr)
+        self.assertEqual(sorted(set(received) - set(sent)),
+                         sorted(self.wallet.get_addr_utxo(self.addr)))
+
+    def test_removed_transaction(self):
+        self.wallet.remove_transaction('%064x' % 2, 20)
+        self.assertEqual([('1', 0, 1000, 10), ('1', 1, 500, 10)], self.coins())
+        self.assertEqual({}, self.wallet.spent_outpoints)
+
+    def test_outpoint_lookup(self):
+        tx = FakeTransaction([{'prevout_hash': '%064x' % 1, 'prevout_n': 1},
+                              {'prevout_hash': '%064x' % 1, 'prevout_n': 0}])
+        self.assertEqual(set([(0, self.addr)]), self.wallet.utxo_can_sign(tx))
+        self.wallet.frozen_addresses.add(self.addr)
+        self.assertEqual(set(), self.wallet.utxo_can_sign(tx))
+        self.assertEqual([], self.wallet.get_spendable_coins())
+
+
+class TestRestoreLookahead(WalletTestCase):
+
+    seed_text = "travel nowhere air position hill peace suffer parent beautiful rise blood power home crumble teach"
+
+    def setUp(self):
+        super(TestRestoreLookahead, self).setUp()
+        self.storage = WalletStorage(self.wallet_path)
+        self.wallet = NewWallet(self.storage)
+        self.wallet.add_seed(self.seed_text, None)
+        self.wallet.create_master_keys(None)
+        self.wallet.create_main_account(None)
+        self.wallet.network = FakeNetwork(1000)
+        self.account = self.wallet.accounts.values()[0]
+
+    def tearDown(self):
+        self.storage.sync()
+        super(TestRestoreLookahead, self).tearDown()
+
+    def test_gap_limit(self):
+        self.wallet.synchronize()
+        self.assertEqual(self.wallet.gap_limit, len(self.account.get_addresses(False)))
+        self.assertEqual(self.wallet.gap_limit_for_change, len(self.account.get_addresses(True)))
+        addr = self.account.get_addresses(False)[5]
+        self.wallet.receive_history_callback(addr, [('%064x' % 1, 10)])
+        self.wallet.synchronize()
+        self.assertEqual(6 + self.wallet.gap_limit, len(self.account.get_addresses(False)))
+
+    def test_restore(self):
+        self.wallet.restoring = True
+        self.wallet.synchronize()
+        self.assertEqual(100, len(self.account.get_addresses(False)))
+        # reported in use before its history is received
+        addr = self.account.get_addresses(False)[50]
+        self.wallet.address_reported(addr)
+        self.wallet.synchronize()
+        self.assertEqual(151, len(self.account.get_addresses(False)))
+        self.wallet.receive_history_callback(addr, [('%064x' % 1, 10)])
+        self.wallet.restoring = False
+        self.wallet.trim_lookahead()
+        self.assertEqual(51 + self.wallet.gap_limit, len(self.account.get_addresses(False)))
+        self.assertEqual(51 + self.wallet.gap_limit, len(self.account.receiving_pubkeys))
+        self.assertEqual(self.wallet.gap_limit_for_change, len(self.account.get_addresses(True)))
+        self.assertEqual(set(self.wallet.addresses(True)), set(self.wallet.history.keys()))
+        # nothing more to create
+        self.wallet.synchronize()
+        self.assertEqual(51 + self.wallet.gap_limit, len(self.account.get_addresses(False)))
+
+    def test_synchronize_only_changed_accounts(self):
+        self.wallet.synchronize()
+        calls = []
+        synchronize = self.account.synchronize
+        self.account.synchronize = lambda wallet: calls.append(1) or synchronize(wallet)
+        self.wallet.synchronize()
+        self.assertEqual([], calls)
+        # an address before the gap window
+        self.wallet.gap_limit = 5
+        self.wallet.receive_history_callback(self.account.get_addresses(False)[0], [('%064x' % 1, 10)])
+        self.wallet.synchronize()
+        self.assertEqual([], calls)
+        self.wallet.receive_history_callback(self.account.get_addresses(False)[-1], [('%064x' % 2, 10)])
+        self.wallet.synchronize()
+        self.assertEqual([1], calls)
+        self.wallet.history_changed()
+        self.wallet.synchronize()
+        self.assertEqual([1, 1], calls)
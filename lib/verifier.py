@@ -17,13 +17,155 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 
+import os
+import struct
 import threading
+import time
 import Queue
 
 
 import util
 from bitcoin import *
 
+# merkle branches requested from the server and not answered yet
+MAX_MERKLE_REQUESTS = 200
+# merkle branch requests sent to the server in a single write
+MERKLE_BATCH_SIZE = 50
+# transaction hash, block height, position and number of branch hashes
+PROOF_FORMAT = struct.Struct('<32sIIB')
+# a record without a branch that removes the proof of a transaction
+TOMBSTONE = 0xff
+
+
+class MerkleCache(object):
+    """Merkle branches of verified transactions, by transaction hash.
+
+    The file is only appended to: a new proof of a transaction hides the
+    previous one, and a tombstone record removes it.  Each record is
+    appended with a single write, so several processes can share the
+    file.  The offset of the live record of each transaction is kept in
+    memory, and the file is compacted on load when most of it is dead.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # raw tx hash -> (offset, height)
+        self.index = {}
+        self.file = None
+        # read handle, used under self.lock
+        self.reader = None
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            open(self.path, 'wb').close()
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        offset = 0
+        while offset + PROOF_FORMAT.size <= len(data):
+            raw_hash, height, pos, n = PROOF_FORMAT.unpack_from(data, offset)
+            size = PROOF_FORMAT.size + (32 * n if n != TOMBSTONE else 0)
+            if offset + size > len(data):
+                break
+            if n == TOMBSTONE:
+                self.index.pop(raw_hash, None)
+            else:
+                self.index[raw_hash] = offset, height
+            offset += size
+        if offset < len(data):
+            # the end of a record that was being written
+            print_error("merkle cache: dropping %d bytes" % (len(data) - offset))
+            with open(self.path, 'rb+') as f:
+                f.truncate(offset)
+        live = sum(PROOF_FORMAT.size + 32 * PROOF_FORMAT.unpack_from(data, o)[3]
+                   for o, h in self.index.values())
+        if offset > 2 * live + 4096:
+            self.compact(data)
+        self.file = open(self.path, 'ab')
+        self.reader = open(self.path, 'rb')
+
+    def compact(self, data):
+        out = []
+        index = {}
+        size = 0
+        for raw_hash, (offset, height) in self.index.items():
+            n = PROOF_FORMAT.unpack_from(data, offset)[3]
+            record = data[offset:offset + PROOF_FORMAT.size + 32 * n]
+            index[raw_hash] = size, height
+            out.append(record)
+            size += len(record)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(''.join(out))
+        try:
+            os.rename(tmp, self.path)
+        except:
+            # the target exists on Windows
+            os.remove(self.path)
+            os.rename(tmp, self.path)
+        self.index = index
+
+    def append(self, record):
+        with self.lock:
+            self.file.write(record)
+            self.file.flush()
+            # other processes may append at the same time
+            return self.file.tell() - len(record)
+
+    def get(self, tx_hash):
+        '''The merkle branch of a transaction, as returned by the server'''
+        raw_hash = hash_decode(tx_hash)
+        with self.lock:
+            item = self.index.get(raw_hash)
+            if item is None or self.reader is None:
+                return None
+            offset, height = item
+            self.reader.seek(offset)
+            data = self.reader.read(PROOF_FORMAT.size)
+            raw_hash2, height, pos, n = PROOF_FORMAT.unpack(data)
+            branch = self.reader.read(32 * n)
+        if raw_hash2 != raw_hash or len(branch) != 32 * n:
+            return None
+        merkle = [hash_encode(branch[i:i+32]) for i in range(0, len(branch), 32)]
+        return {'block_height': height, 'pos': pos, 'merkle': merkle}
+
+    def put(self, tx_hash, result):
+        raw_hash = hash_decode(tx_hash)
+        height = result['block_height']
+        branch = ''.join(hash_decode(item) for item in result['merkle'])
+        record = PROOF_FORMAT.pack(raw_hash, height, result['pos'], len(result['merkle'])) + branch
+        offset = self.append(record)
+        with self.lock:
+            self.index[raw_hash] = offset, height
+
+    def remove(self, tx_hash):
+        raw_hash = hash_decode(tx_hash)
+        with self.lock:
+            if raw_hash not in self.index:
+                return
+        self.append(PROOF_FORMAT.pack(raw_hash, 0, 0, TOMBSTONE))
+        with self.lock:
+            self.index.pop(raw_hash, None)
+
+    def invalidate(self, height):
+        '''Remove the proofs of blocks from height'''
+        with self.lock:
+            tx_hashes = [hash_encode(raw_hash) for raw_hash, (offset, h)
+                         in self.index.items() if h >= height]
+        for tx_hash in tx_hashes:
+            self.remove(tx_hash)
+        return tx_hashes
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            if self.reader is not None:
+                self.reader.close()
+                self.reader = None
+
 
 class SPV(util.DaemonThread):
     """ Simple Payment Verification """
@@ -33,54 +175,151 @@ class SPV(util.DaemonThread):
         self.wallet = wallet
         self.network = network
         self.merkle_roots    = {}                                  # hashed by me
+        # merkle branches waiting for their block header to be downloaded
+        self.pending_headers = {}
+        # transactions to verify, as sets by height.  Access with self.lock.
+        self.lock = threading.Lock()
+        self.unrequested = {}
+        self.unrequested_height = {}
+        # transactions whose merkle branch has not been received yet
+        self.requested_merkle = set()
+        # server responses.  None is put to wake the thread up when
+        # there are new transactions to verify.
         self.queue = Queue.Queue()
+        # merkle branches that were verified before
+        self.proofs = MerkleCache(os.path.join(network.config.path, 'merkle_proofs'))
+        # lowest height of the reorgs not handled yet.  Access with self.lock.
+        self.reorg_height = None
+        network.register_callback('reorg', self.on_reorg)
+
+    def add(self, tx_hash, tx_height):
+        '''Schedule the verification of a transaction'''
+        with self.lock:
+            if tx_hash in self.merkle_roots or tx_hash in self.requested_merkle:
+                return
+            if tx_hash in self.pending_headers:
+                return
+            if tx_hash in self.wallet.verified_tx:
+                return
+            old_height = self.unrequested_height.get(tx_hash)
+            if old_height == tx_height:
+                return
+            if old_height is not None:
+                self.unrequested[old_height].discard(tx_hash)
+                if not self.unrequested[old_height]:
+                    self.unrequested.pop(old_height)
+            self.unrequested.setdefault(tx_height, set()).add(tx_hash)
+            self.unrequested_height[tx_hash] = tx_height
+        self.queue.put(None)
 
     def run(self):
-        requested_merkle = set()
+        retry_time = time.time()
         while self.is_running():
-            unverified = self.wallet.get_unverified_txs()
-            for (tx_hash, tx_height) in unverified:
-                if self.merkle_roots.get(tx_hash) is None and tx_hash not in requested_merkle:
-                    if self.network.send([ ('blockchain.transaction.get_merkle',[tx_hash, tx_height]) ], self.queue.put):
-                        self.print_error('requesting merkle', tx_hash)
-                        requested_merkle.add(tx_hash)
+            self.handle_reorg()
+            if self.pending_headers and time.time() - retry_time > 1:
+                retry_time = time.time()
+                self.verify_merkles(self.pending_headers.items())
+            self.request_merkles()
             try:
-                r = self.queue.get(timeout=0.1)
+                r = self.queue.get(timeout=1)
             except Queue.Empty:
                 continue
-            if not r:
-                continue
+            # handle all the responses that have arrived
+            results = []
+            while True:
+                if r:
+                    result = self.process_response(r)
+                    if result:
+                        results.append(result)
+                try:
+                    r = self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+            self.verify_merkles(results)
 
-            if r.get('error'):
-                self.print_error('Verifier received an error:', r)
-                continue
-
-            # 3. handle response
-            method = r['method']
-            params = r['params']
-            result = r['result']
+        self.proofs.close()
+        self.print_error("stopped")
 
-            if method == 'blockchain.transaction.get_merkle':
-                tx_hash = params[0]
-                self.verify_merkle(tx_hash, result)
+    def request_merkles(self):
+        '''Request the merkle branches of the transactions we have the
+        block header of, lowest heights first, with no more than
+        MAX_MERKLE_REQUESTS unanswered'''
+        local_height = self.network.get_local_height()
+        requests = []
+        cached = []
+        with self.lock:
+            room = MAX_MERKLE_REQUESTS - len(self.requested_merkle)
+            for tx_height in sorted(self.unrequested):
+                if tx_height > local_height or len(requests) >= room:
+                    break
+                tx_hashes = self.unrequested[tx_height]
+                while tx_hashes and len(requests) < room:
+                    tx_hash = tx_hashes.pop()
+                    self.unrequested_height.pop(tx_hash)
+                    result = self.proofs.get(tx_hash)
+                    if result and result['block_height'] == tx_height:
+                        result['cached'] = True
+                        cached.append((tx_hash, result))
+                        continue
+                    self.requested_merkle.add(tx_hash)
+                    requests.append(('blockchain.transaction.get_merkle', [tx_hash, tx_height]))
+                if not tx_hashes:
+                    self.unrequested.pop(tx_height)
+        for i in range(0, len(requests), MERKLE_BATCH_SIZE):
+            self.network.send(requests[i:i+MERKLE_BATCH_SIZE], self.queue.put)
+        if requests:
+            self.print_error('requested %d merkle branches' % len(requests))
+        self.verify_merkles(cached)
 
-        self.print_error("stopped")
+    def process_response(self, r):
+        '''Returns (tx_hash, result) for a merkle branch'''
+        method = r['method']
+        params = r['params']
+        if method != 'blockchain.transaction.get_merkle':
+            return
+        tx_hash = params[0]
+        with self.lock:
+            self.requested_merkle.discard(tx_hash)
+        if r.get('error'):
+            self.print_error('Verifier received an error:', r)
+            return
+        return tx_hash, r['result']
 
+    def verify_merkles(self, results):
+        '''Verify merkle branches, reading each block header once'''
+        by_height = {}
+        for tx_hash, result in results:
+            by_height.setdefault(result.get('block_height'), []).append((tx_hash, result))
+        for tx_height in sorted(by_height):
+            header = self.network.get_header(tx_height)
+            for tx_hash, result in by_height[tx_height]:
+                self.verify_merkle(tx_hash, result, header)
 
-    def verify_merkle(self, tx_hash, result):
+    def verify_merkle(self, tx_hash, result, header):
         tx_height = result.get('block_height')
         pos = result.get('pos')
         merkle_root = self.hash_merkle_root(result['merkle'], tx_hash, pos)
-        header = self.network.get_header(tx_height)
-        if not header: return
-        if header.get('merkle_root') != merkle_root:
+        proof = {'block_height': tx_height, 'pos': pos, 'merkle': result['merkle']}
+        if not header:
+            self.pending_headers[tx_hash] = result
+            return
+        self.pending_headers.pop(tx_hash, None)
+        # read from the cache by request_merkles
+        cached = result.get('cached', False)
+        if header.raw_merkle_root != hash_decode(merkle_root):
             self.print_error("merkle verification failed for", tx_hash)
+            if cached:
+                # the block is not in our chain anymore: ask the server
+                self.proofs.remove(tx_hash)
+                self.add(tx_hash, tx_height)
             return
 
         # we passed all the tests
+        if not cached:
+            self.proofs.put(tx_hash, proof)
         self.merkle_roots[tx_hash] = merkle_root
         self.print_error("verified %s" % tx_hash)
-        self.wallet.add_verified_tx(tx_hash, (tx_height, header.get('timestamp'), pos))
+        self.wallet.add_verified_tx(tx_hash, (tx_height, header.timestamp, pos))
 
 
     def hash_merkle_root(self, merkle_s, target_hash, pos):
@@ -91,8 +330,25 @@ class SPV(util.DaemonThread):
         return hash_encode(h)
 
 
+    def on_reorg(self):
+        height = self.network.reorg_height
+        with self.lock:
+            if self.reorg_height is None or height < self.reorg_height:
+                self.reorg_height = height
+        self.queue.put(None)
+
+    def handle_reorg(self):
+        with self.lock:
+            height, self.reorg_height = self.reorg_height, None
+        if height is not None:
+            self.undo_verifications(height)
+
     def undo_verifications(self, height):
+        self.proofs.invalidate(height)
         tx_hashes = self.wallet.undo_verifications(height)
         for tx_hash in tx_hashes:
             self.print_error("redoing", tx_hash)
             self.merkle_roots.pop(tx_hash, None)
+            tx_height = self.wallet.unverified_tx.get(tx_hash)
+            if tx_height:
+                self.add(tx_hash, tx_height)
@@ -18,6 +18,7 @@
 
 import sys
 import os
+import bisect
 import hashlib
 import ast
 import threading
@@ -26,6 +27,8 @@ import time
 import math
 import json
 import copy
+import sqlite3
+from collections import MutableMapping, OrderedDict
 from operator import itemgetter
 
 from util import print_msg, print_error, NotEnoughFunds
@@ -48,17 +51,216 @@ import paymentrequest
 # internal ID for imported account
 IMPORTED_ACCOUNT = '/x'
 
+# addresses created ahead of the last used one while restoring
+RESTORE_LOOKAHEAD = 100
+
+# deserialized transactions kept by a TransactionTable
+TX_CACHE_SIZE = 200
+
+
+def index_add(index, height, tx_hash):
+    '''Add a transaction to a sorted list of (height, tx_hash)'''
+    bisect.insort(index, (height, tx_hash))
+
+def index_remove(index, height, tx_hash):
+    i = bisect.bisect_left(index, (height, tx_hash))
+    if i < len(index) and index[i] == (height, tx_hash):
+        del index[i]
+
+def changed_items(old, new):
+    '''Items of the dictionary new that differ in old, and keys of old
+    that are not in new.  As in JSON, tuples and lists are equal.'''
+    changed = {}
+    for k, v in new.items():
+        if k in old:
+            o = old[k]
+            if o == v or json.dumps(o) == json.dumps(v):
+                continue
+        changed[k] = v
+    removed = [k for k in old if k not in new]
+    return changed, removed
+
+
+class TransactionTable(MutableMapping):
+    """The transactions of a wallet, by hash.  Only their raw bytes are
+    kept; a Transaction is made when one is looked up, and the last
+    TX_CACHE_SIZE of them are kept, so that a transaction that is being
+    used is deserialized once.  The raw bytes of the transactions in
+    unread are read with read(tx_hash) when they are first needed."""
+
+    def __init__(self, raw_txs=None, unread=(), read=None):
+        self.lock = threading.Lock()
+        # tx_hash -> raw transaction, not hex encoded, or None if not read
+        self.raw = dict.fromkeys(unread)
+        self.read = read
+        self.cache = OrderedDict()
+        # hashes of the transactions set or removed since the changes
+        # were last taken
+        self.changed = set()
+        if raw_txs:
+            for tx_hash, raw in raw_txs.items():
+                self.raw[tx_hash] = raw.decode('hex')
+
+    def __getitem__(self, tx_hash):
+        with self.lock:
+            tx = self.cache.pop(tx_hash, None)
+            if tx is not None:
+                self.cache[tx_hash] = tx
+                return tx
+            raw = self.raw[tx_hash]
+        # read and deserialized without the lock, which is taken while
+        # the storage writes
+        if raw is None:
+            raw = self.read(tx_hash)
+        tx = Transaction(raw.encode('hex'))
+        with self.lock:
+            if tx_hash in self.raw and self.raw[tx_hash] is None:
+                self.raw[tx_hash] = raw
+            # unless it was replaced meanwhile
+            if self.raw.get(tx_hash) == raw:
+                self.cache[tx_hash] = tx
+                if len(self.cache) > TX_CACHE_SIZE:
+                    self.cache.popitem(last=False)
+        return tx
+
+    def get_raw(self, tx_hash):
+        raw = self.raw[tx_hash]
+        return self.read(tx_hash) if raw is None else raw
+
+    def __setitem__(self, tx_hash, tx):
+        with self.lock:
+            self.raw[tx_hash] = str(tx).decode('hex')
+            self.changed.add(tx_hash)
+            self.cache.pop(tx_hash, None)
+            self.cache[tx_hash] = tx
+            if len(self.cache) > TX_CACHE_SIZE:
+                self.cache.popitem(last=False)
+
+    def __delitem__(self, tx_hash):
+        with self.lock:
+            del self.raw[tx_hash]
+            self.changed.add(tx_hash)
+            self.cache.pop(tx_hash, None)
+
+    def __contains__(self, tx_hash):
+        return tx_hash in self.raw
+
+    def __iter__(self):
+        return iter(self.raw.keys())
+
+    def __len__(self):
+        return len(self.raw)
+
+    def to_hex(self):
+        '''All the transactions, hex encoded.  The changes are taken.'''
+        with self.lock:
+            self.changed = set()
+            return dict((tx_hash, self.get_raw(tx_hash).encode('hex')) for tx_hash in self.raw)
+
+    def take_changes(self):
+        '''The transactions set since the last call, hex encoded, and
+        the hashes of those removed'''
+        with self.lock:
+            changed, self.changed = self.changed, set()
+            return (dict((h, self.raw[h].encode('hex')) for h in changed if h in self.raw),
+                    [h for h in changed if h not in self.raw])
+
+
+class TrackedDict(dict):
+    """Dictionary that records the keys set or removed since the last
+    call to take_changes, so that a storage writes only their items.
+    A value changed in place must be set again to be recorded."""
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.changed = set()
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self.changed.add(key)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.changed.add(key)
+
+    def pop(self, key, *default):
+        if key in self:
+            self.changed.add(key)
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        self.changed.add(key)
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        self.changed.update(self.keys())
+        dict.clear(self)
+
+    def take_changes(self):
+        '''The items set since the last call, and the keys removed'''
+        changed, self.changed = self.changed, set()
+        return (dict((k, self[k]) for k in changed if k in self),
+                [k for k in changed if k not in self])
+
+
+def json_default(value):
+    '''JSON encoding of the values that json cannot encode'''
+    if isinstance(value, TransactionTable):
+        return value.to_hex()
+    raise TypeError(repr(value) + " is not JSON serializable")
+
 
 class WalletStorage(object):
 
-    def __init__(self, path):
+    # Keys whose values can be downloaded again from the network.  Their
+    # values are not copied when saved, and saving them writes the file
+    # at most once every write_delay seconds, while holding self.locks.
+    # The other keys are written as soon as they are saved.
+    lazy_keys = set(['addr_history', 'transactions', 'txi', 'txo', 'pruned_txo',
+                     'verified_tx3', 'stored_height'])
+    write_delay = 1.0
+    # In journal mode, writes append the changed keys to a log next to
+    # the wallet file instead of rewriting it.  The file is rewritten in
+    # the background once the log is compact_ratio times its size.
+    compact_ratio = 2
+    compact_min_size = 1 << 16
+
+    def __init__(self, path, journal=False):
         self.lock = threading.RLock()
         self.data = {}
+        # values of lazy keys put since the last write
+        self.pending = {}
+        self.timer = None
         self.path = path
         self.file_exists = False
+        # journal records of the keys put since the last write
+        self.records = []
+        self.journal = None
+        self.journal_size = 0
+        self.file_size = 0
+        self.compactor = None
+        # held while the wallet file is rewritten
+        self.write_lock = threading.Lock()
+        # Locks held by the threads that change the values of lazy keys.
+        # A write takes them in this order, before self.lock, so that
+        # it reads those values as they were at one moment.
+        self.locks = []
         print_error( "wallet path", self.path )
         if self.path:
             self.read(self.path)
+            # a wallet that has a journal stays in journal mode
+            if journal or os.path.exists(self.journal_path()):
+                self.open_journal()
 
     def read(self, path):
         """Read the contents of the wallet file."""
@@ -91,17 +293,132 @@ class WalletStorage(object):
                     continue
                 self.data[key] = value
         self.file_exists = True
+        self.file_size = os.path.getsize(self.path)
+
+    def journal_path(self, old=False):
+        return self.path + ('.journal.old' if old else '.journal')
+
+    def open_journal(self):
+        '''Replay the journal over the contents of the wallet file, and
+        open it for appending.  A journal left by an interrupted
+        compaction is replayed first.  The replayed records are written
+        to the wallet file.'''
+        old_path = self.journal_path(True)
+        replayed = os.path.exists(old_path)
+        if replayed:
+            self.replay(old_path)
+        if self.replay(self.journal_path()):
+            replayed = True
+        if replayed:
+            self._write(self.data)
+            self.file_exists = True
+            if os.path.exists(old_path):
+                os.remove(old_path)
+        self.journal = open(self.journal_path(), 'wb' if replayed else 'ab')
+        self.journal_size = 0
+
+    def replay(self, path):
+        '''Apply the records of a journal file to self.data.  Each line
+        holds the records of one write, so that a write interrupted by a
+        crash is ignored as a whole.  Returns the size of the valid
+        part of the file, to which the file is truncated.'''
+        size = 0
+        if not os.path.exists(path):
+            return size
+        with open(path, 'rb') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    break
+                try:
+                    records = json.loads(line)
+                except ValueError:
+                    break
+                for record in records:
+                    self.apply(record)
+                size += len(line)
+        if size < os.path.getsize(path):
+            print_error("truncating journal", path, size)
+            with open(path, 'r+b') as f:
+                f.truncate(size)
+        return size
+
+    def apply(self, record):
+        op, key = record[0], record[1]
+        if op == 'put':
+            self.data[key] = record[2]
+        elif op == 'delete':
+            self.data.pop(key, None)
+        elif op == 'update':
+            # copied, so that a compaction never sees a dict change
+            d = dict(self.data.get(key, {}))
+            # removed first: in JSON a changed key can have the same
+            # form as a removed one, e.g. 1 and '1'
+            for k in record[3]:
+                d.pop(k, None)
+            d.update(record[2])
+            self.data[key] = d
+
+    def make_record(self, key, old, new):
+        '''Journal record that changes the value of key from old to new.
+        Dictionaries are recorded by their changed items if fewer than
+        half of them changed.'''
+        if new is None:
+            return ['delete', key]
+        if isinstance(old, dict) and isinstance(new, dict) and old:
+            changed, removed = changed_items(old, new)
+            if len(changed) + len(removed) < len(new) / 2:
+                return ['update', key, changed, removed]
+        return ['put', key, new]
 
     def get(self, key, default=None):
         with self.lock:
-            v = self.data.get(key)
+            v = self.pending[key] if key in self.pending else self.data.get(key)
             if v is None:
                 v = default
             else:
-                v = copy.deepcopy(v)
+                v = copy.deepcopy(self.json_value(v))
             return v
 
+    def json_value(self, value):
+        '''The value put for a lazy key, as it is written'''
+        if isinstance(value, TransactionTable):
+            return value.to_hex()
+        return value
+
+    def keeps_copies(self):
+        '''Whether the written values are kept apart from those of the
+        wallet, to compare them with the next ones'''
+        return self.journal is not None
+
+    def take(self, key, default=None):
+        '''Value of a lazy key, without a copy.  The caller owns it from
+        then on: the value is written as the caller changes it, and it
+        must be saved with put, not changed through get.'''
+        assert key in self.lazy_keys
+        with self.lock:
+            if self.keeps_copies():
+                return self.get(key, default)
+            v = self.pending[key] if key in self.pending else self.data.get(key)
+            return default if v is None else self.json_value(v)
+
+    def take_transactions(self):
+        '''The transactions of the wallet, in a TransactionTable taken
+        as the value of the transactions key'''
+        with self.lock:
+            table = TransactionTable(self.take('transactions', {}))
+            if not self.keeps_copies() and 'transactions' not in self.pending:
+                # the hex read from the file is not kept
+                self.data['transactions'] = table
+            return table
+
     def put(self, key, value, save = True):
+        if key in self.lazy_keys and value is not None:
+            with self.lock:
+                self.pending[key] = value
+                if save and self.timer is None:
+                    self.timer = threading.Timer(self.write_delay, self.flush)
+                    self.timer.start()
+            return
         try:
             json.dumps(key)
             json.dumps(value)
@@ -109,17 +426,118 @@ class WalletStorage(object):
             print_error("json error: cannot save", key)
             return
         with self.lock:
+            self.pending.pop(key, None)
+            value = copy.deepcopy(value)
+            if self.journal:
+                self.records.append(self.make_record(key, self.data.get(key), value))
             if value is not None:
-                self.data[key] = copy.deepcopy(value)
+                self.data[key] = value
             elif key in self.data:
                 self.data.pop(key)
-            if save:
-                self.write()
+        if save:
+            self.write()
+
+    def sync(self):
+        '''Write the file if lazy keys were saved since the last write,
+        and wait for a running compaction.  The write is done without
+        self.lock held, since it takes self.locks first.'''
+        with self.lock:
+            dirty = bool(self.pending or self.records)
+        if dirty:
+            self.write()
+        with self.lock:
+            compactor = self.compactor
+        if compactor:
+            compactor.join()
+
+    def flush(self):
+        try:
+            self.sync()
+        except RuntimeError:
+            # a value was changed by another thread while it was copied
+            with self.lock:
+                self.timer = threading.Timer(self.write_delay, self.flush)
+                self.timer.start()
 
     def write(self):
         assert not threading.currentThread().isDaemon()
+        for lock in self.locks:
+            lock.acquire()
+        try:
+            with self.lock:
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+                self.write_data()
+        finally:
+            for lock in reversed(self.locks):
+                lock.release()
+
+    def write_data(self):
+        '''Write the values saved since the last write.  Called with
+        self.locks and self.lock held.'''
+        if self.keeps_copies():
+            for key, value in self.pending.items():
+                value = copy.deepcopy(self.json_value(value))
+                self.records.append(self.make_record(key, self.data.get(key), value))
+                self.data[key] = value
+        else:
+            # a TransactionTable is kept as is, and encoded by _write
+            self.data.update(self.pending)
+        if self.journal and self.file_exists:
+            self.append_records()
+        else:
+            self.records = []
+            with self.write_lock:
+                self._write(self.data)
+            self.file_exists = True
+        # cleared once written: a write that failed because a value
+        # was changed while it was serialized is done again
+        self.pending = {}
+
+    def append_records(self):
+        if not self.records:
+            return
+        line = json.dumps(self.records) + '\n'
+        self.records = []
+        self.journal.write(line)
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.journal_size += len(line)
+        if self.journal_size > max(self.compact_ratio * self.file_size, self.compact_min_size):
+            self.start_compaction()
+
+    def start_compaction(self):
+        '''Move the journal aside and rewrite the wallet file from a
+        copy of the data in a thread.  The values are never changed in
+        place, so a shallow copy is a snapshot.'''
+        with self.lock:
+            if self.compactor is not None or os.path.exists(self.journal_path(True)):
+                return
+            self.journal.close()
+            os.rename(self.journal_path(), self.journal_path(True))
+            self.journal = open(self.journal_path(), 'ab')
+            self.journal_size = 0
+            data = dict(self.data)
+            self.compactor = threading.Thread(target=self.compact, args=(data,))
+            self.compactor.start()
+
+    def compact(self, data):
+        try:
+            with self.write_lock:
+                self._write(data)
+            # if this is not reached, the old journal is replayed when
+            # the wallet is opened again
+            os.remove(self.journal_path(True))
+            print_error("compacted wallet journal")
+        finally:
+            with self.lock:
+                self.compactor = None
+
+    def _write(self, data):
         temp_path = "%s.tmp.%s" % (self.path, os.getpid())
-        s = json.dumps(self.data, indent=4, sort_keys=True)
+        s = json.dumps(data, indent=4, sort_keys=True, default=json_default)
+        self.file_size = len(s)
         with open(temp_path, "w") as f:
             f.write(s)
             f.flush()
@@ -136,6 +554,244 @@ class WalletStorage(object):
 
 
 
+# Wallet keys stored in their own table by SqliteWalletStorage: the
+# table, the columns of the keys of the value, and the columns of each
+# item.  txi and txo are dictionaries of dictionaries.
+SQLITE_TABLES = {
+    'transactions': ('transactions', ['tx_hash'], ['raw']),
+    'addr_history': ('history', ['address'], ['history']),
+    'txi': ('txi', ['tx_hash', 'address'], ['inputs']),
+    'txo': ('txo', ['tx_hash', 'address'], ['outputs']),
+    'pruned_txo': ('pruned_txo', ['prevout'], ['tx_hash']),
+    'verified_tx3': ('verified', ['tx_hash'], ['height', 'timestamp', 'pos']),
+    'labels': ('labels', ['name'], ['label']),
+    'payment_requests': ('payment_requests', ['key'], ['request']),
+}
+# columns holding JSON
+SQLITE_JSON_COLUMNS = set(['history', 'inputs', 'outputs', 'request'])
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS transactions (tx_hash TEXT PRIMARY KEY, raw TEXT);
+CREATE TABLE IF NOT EXISTS history (address TEXT PRIMARY KEY, history TEXT);
+CREATE TABLE IF NOT EXISTS txi (tx_hash TEXT, address TEXT, inputs TEXT, PRIMARY KEY (tx_hash, address));
+CREATE INDEX IF NOT EXISTS txi_address ON txi (address);
+CREATE TABLE IF NOT EXISTS txo (tx_hash TEXT, address TEXT, outputs TEXT, PRIMARY KEY (tx_hash, address));
+CREATE INDEX IF NOT EXISTS txo_address ON txo (address);
+CREATE TABLE IF NOT EXISTS pruned_txo (prevout TEXT PRIMARY KEY, tx_hash TEXT);
+CREATE INDEX IF NOT EXISTS pruned_txo_tx_hash ON pruned_txo (tx_hash);
+CREATE TABLE IF NOT EXISTS verified (tx_hash TEXT PRIMARY KEY, height INTEGER, timestamp INTEGER, pos INTEGER);
+CREATE INDEX IF NOT EXISTS verified_height ON verified (height);
+CREATE TABLE IF NOT EXISTS labels (name TEXT PRIMARY KEY, label TEXT);
+CREATE TABLE IF NOT EXISTS payment_requests (key TEXT PRIMARY KEY, request TEXT);
+"""
+
+
+class SqliteWalletStorage(WalletStorage):
+    """Wallet storage in an SQLite database.  The keys of SQLITE_TABLES
+    are stored one row per item, and read from the database when they
+    are first needed; the other keys are stored as JSON in the meta
+    table.  The wallet takes the values of table keys as TrackedDicts,
+    and a write only changes the rows of the items they recorded as
+    changed, in a single transaction.
+
+    Opening the wallet reads the hashes of the transactions, but not
+    their raw bytes.  The other tables are still read in full, since
+    the wallet builds its indexes of the history and of the coins from
+    them when it is opened."""
+
+    def keeps_copies(self):
+        return True
+
+    def read(self, path):
+        new = not os.path.exists(path)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        if new and 'ANDROID_DATA' not in os.environ:
+            import stat
+            os.chmod(path, stat.S_IREAD | stat.S_IWRITE)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SQLITE_SCHEMA)
+        for key, value in self.db.execute('SELECT key, value FROM meta'):
+            self.data[key] = json.loads(value)
+        self.file_exists = bool(self.data)
+        # the values in the database, by key
+        self.saved = dict(self.data)
+
+    def close(self):
+        self.sync()
+        self.db.close()
+
+    def read_table(self, key, value):
+        '''Read the rows of the table of key into the dictionary value'''
+        table, keys, columns = SQLITE_TABLES[key]
+        for row in self.db.execute('SELECT %s FROM %s' % (', '.join(keys + columns), table)):
+            item = row[len(keys):]
+            if columns[0] in SQLITE_JSON_COLUMNS:
+                item = [json.loads(x) if x is not None else None for x in item]
+            item = item[0] if len(columns) == 1 else list(item)
+            if len(keys) == 1:
+                value[row[0]] = item
+            else:
+                d = value.setdefault(row[0], {})
+                # an empty dictionary is a row with an empty address
+                if row[1]:
+                    d[row[1]] = item
+
+    def load(self, key):
+        '''Read the value of a table key from the database, to compare
+        it with the next value put'''
+        with self.lock:
+            if key in self.saved or key not in SQLITE_TABLES:
+                return
+            value = {}
+            self.read_table(key, value)
+            self.data[key] = value
+            self.saved[key] = value
+
+    def get(self, key, default=None):
+        self.load(key)
+        return WalletStorage.get(self, key, default)
+
+    def take(self, key, default=None):
+        '''The value of a table key is read from the database into a
+        TrackedDict, which is neither copied nor kept here'''
+        assert key in self.lazy_keys
+        if key not in SQLITE_TABLES:
+            return WalletStorage.take(self, key, default)
+        with self.lock:
+            if key in self.pending or key in self.saved:
+                # compared with the saved value when it is written
+                return TrackedDict(self.get(key, default))
+            value = TrackedDict()
+            self.read_table(key, value)
+            value.changed = set()
+            return value
+
+    def take_transactions(self):
+        '''Only the hashes are read: the raw bytes of a transaction are
+        read when it is first looked up'''
+        with self.lock:
+            if 'transactions' in self.pending or 'transactions' in self.saved:
+                return WalletStorage.take_transactions(self)
+            hashes = [row[0] for row in self.db.execute('SELECT tx_hash FROM transactions')]
+            return TransactionTable(unread=hashes, read=self.read_transaction)
+
+    def read_transaction(self, tx_hash):
+        with self.lock:
+            row = self.db.execute('SELECT raw FROM transactions WHERE tx_hash=?', (tx_hash,)).fetchone()
+        return row[0].decode('hex')
+
+    def put(self, key, value, save=True):
+        if not self.is_tracked(key, value):
+            self.load(key)
+        WalletStorage.put(self, key, value, save)
+
+    def is_tracked(self, key, value):
+        return key in SQLITE_TABLES and isinstance(value, (TrackedDict, TransactionTable))
+
+    def write_data(self):
+        tracked = {}
+        for key, value in self.pending.items():
+            if self.is_tracked(key, value):
+                items, removed = value.take_changes()
+                if key in self.saved:
+                    # the changes are those since the value was read
+                    items, removed = changed_items(self.saved[key], self.json_value(value))
+                tracked[key] = items, removed
+                # the database holds the value from now on
+                self.data.pop(key, None)
+                self.saved.pop(key, None)
+            else:
+                self.load(key)
+                self.data[key] = copy.deepcopy(self.json_value(value))
+        self.pending = {}
+        # values are replaced, never changed in place
+        changed = [key for key, value in self.data.items() if self.saved.get(key) is not value]
+        changed += [key for key in self.saved if key not in self.data]
+        if not changed and not tracked:
+            return
+        with self.db:
+            for key, (items, removed) in tracked.items():
+                self.write_items(key, items, removed)
+            for key in changed:
+                self.write_key(key, self.saved.get(key), self.data.get(key))
+        self.saved = dict(self.data)
+        self.file_exists = True
+
+    def write_key(self, key, old, new):
+        if key not in SQLITE_TABLES:
+            if new is None:
+                self.db.execute('DELETE FROM meta WHERE key=?', (key,))
+            else:
+                self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, json.dumps(new)))
+            return
+        changed, removed = changed_items(old or {}, new or {})
+        self.write_items(key, changed, removed)
+
+    def write_items(self, key, changed, removed):
+        '''Replace the rows of the changed items of a table key, and
+        delete those of the removed keys'''
+        table, keys, columns = SQLITE_TABLES[key]
+        self.db.executemany('DELETE FROM %s WHERE %s=?' % (table, keys[0]),
+                            [(k,) for k in list(removed) + changed.keys()])
+        rows = []
+        for k, item in changed.items():
+            if len(keys) == 1:
+                rows.append((k,) + self.encode(columns, item))
+            elif not item:
+                rows.append((k, '', None))
+            else:
+                for k2, v in item.items():
+                    rows.append((k, k2) + self.encode(columns, v))
+        self.db.executemany('INSERT INTO %s VALUES (%s)' % (table, ', '.join(['?'] * (len(keys) + len(columns)))), rows)
+
+    def encode(self, columns, item):
+        if len(columns) == 1:
+            item = [item]
+        if columns[0] in SQLITE_JSON_COLUMNS:
+            item = [json.dumps(x) for x in item]
+        return tuple(item)
+
+
+def is_sqlite_file(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read(16) == 'SQLite format 3\0'
+    except IOError:
+        return False
+
+def migrate_to_sqlite(path):
+    """Convert the JSON wallet file at path to an SQLite database.  The
+    JSON file is kept as path.json."""
+    storage = WalletStorage(path)
+    temp_path = path + '.sqlite.tmp'
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    db = SqliteWalletStorage(temp_path)
+    for key, value in storage.data.items():
+        db.data[key] = value
+    db.write()
+    db.close()
+    with open(path + '.json', 'w') as f:
+        f.write(json.dumps(storage.data, indent=4, sort_keys=True))
+    os.rename(temp_path, path)
+    for p in [storage.journal_path(), storage.journal_path(True)]:
+        if os.path.exists(p):
+            os.remove(p)
+    print_error("wallet converted to sqlite", path)
+
+def open_storage(path, config):
+    """Open the wallet file at path in the format chosen in config.  A
+    JSON wallet is converted when the wallet_sqlite option is set."""
+    if is_sqlite_file(path):
+        return SqliteWalletStorage(path)
+    if config.get('wallet_sqlite', False):
+        if os.path.exists(path):
+            migrate_to_sqlite(path)
+        return SqliteWalletStorage(path)
+    return WalletStorage(path, config.get('wallet_journal', False))
+
+
 class Abstract_Wallet(object):
     """
     Wallet classes are created to handle various address generation methods.
@@ -154,7 +810,12 @@ class Abstract_Wallet(object):
         self.labels                = storage.get('labels', {})
         self.frozen_addresses      = set(storage.get('frozen_addresses',[]))
         self.stored_height         = storage.get('stored_height', 0)       # last known height (for offline mode)
-        self.history               = storage.get('addr_history',{})        # address -> list(txid, height)
+        self.history               = storage.take('addr_history',{})       # address -> list(txid, height)
+        # address -> status of its history, computed when first needed
+        self.address_status = {}
+        # addresses whose history changed since the accounts were last
+        # synchronized, or None if all the accounts must be looked at
+        self.changed_addresses = None
 
         # This attribute is set when wallet.start_threads is called.
         self.synchronizer = None
@@ -165,6 +826,7 @@ class Abstract_Wallet(object):
         self.load_accounts()
         self.load_transactions()
         self.build_reverse_history()
+        self.build_utxo_index()
 
         # load requests
         self.receive_requests = self.storage.get('payment_requests', {})
@@ -174,15 +836,19 @@ class Abstract_Wallet(object):
         # Transactions pending verification.  Each value is the transaction height.  Access with self.lock.
         self.unverified_tx = {}
         # Verified transactions.  Each value is a (height, timestamp, block_pos) tuple.  Access with self.lock.
-        self.verified_tx   = storage.get('verified_tx3',{})
+        self.verified_tx   = storage.take('verified_tx3',{})
+        # (height, tx_hash) of the verified transactions, sorted.  Access with self.lock.
+        self.verified_index = sorted((item[0], tx_hash) for tx_hash, item in self.verified_tx.items())
 
         # there is a difference between wallet.up_to_date and interface.is_up_to_date()
         # interface.is_up_to_date() returns true when all requests have been answered and processed
         # wallet.up_to_date is true when the wallet is synchronized (stronger requirement)
         self.up_to_date = False
-        self.lock = threading.Lock()
-        self.transaction_lock = threading.Lock()
+        self.lock = threading.RLock()
+        self.transaction_lock = threading.RLock()
         self.tx_event = threading.Event()
+        # the lazy values of the storage are changed under these locks
+        self.storage.locks = [self.lock, self.transaction_lock]
 
         self.check_history()
 
@@ -192,61 +858,128 @@ class Abstract_Wallet(object):
 
     @profiler
     def load_transactions(self):
-        self.txi = self.storage.get('txi', {})
-        self.txo = self.storage.get('txo', {})
-        self.pruned_txo = self.storage.get('pruned_txo', {})
-        tx_list = self.storage.get('transactions', {})
-        self.transactions = {}
-        for tx_hash, raw in tx_list.items():
-            tx = Transaction(raw)
-            self.transactions[tx_hash] = tx
-            if self.txi.get(tx_hash) is None and self.txo.get(tx_hash) is None and (tx_hash not in self.pruned_txo.values()):
+        self.txi = self.storage.take('txi', {})
+        self.txo = self.storage.take('txo', {})
+        self.pruned_txo = self.storage.take('pruned_txo', {})
+        self.transactions = self.storage.take_transactions()
+        pruned = set(self.pruned_txo.values())
+        for tx_hash in self.transactions.keys():
+            if self.txi.get(tx_hash) is None and self.txo.get(tx_hash) is None and tx_hash not in pruned:
                 print_error("removing unreferenced tx", tx_hash)
                 self.transactions.pop(tx_hash)
 
     @profiler
     def save_transactions(self):
         with self.transaction_lock:
-            tx = {}
-            for k,v in self.transactions.items():
-                tx[k] = str(v)
             # Flush storage only with the last put
-            self.storage.put('transactions', tx, False)
+            self.storage.put('transactions', self.transactions, False)
             self.storage.put('txi', self.txi, False)
             self.storage.put('txo', self.txo, False)
             self.storage.put('pruned_txo', self.pruned_txo, True)
 
     def clear_history(self):
         with self.transaction_lock:
-            self.txi = {}
-            self.txo = {}
-            self.pruned_txo = {}
+            # cleared in place: the storage may track their changes
+            self.txi.clear()
+            self.txo.clear()
+            self.pruned_txo.clear()
+            self.build_utxo_index()
         self.save_transactions()
         with self.lock:
-            self.history = {}
+            self.history.clear()
+            self.address_status = {}
+            self.changed_addresses = None
             self.tx_addr_hist = {}
+            self.tx_heights = {}
         self.storage.put('addr_history', self.history, True)
 
     @profiler
     def build_reverse_history(self):
         self.tx_addr_hist = {}
+        # height of each transaction in the histories
+        self.tx_heights = {}
         for addr, hist in self.history.items():
             for tx_hash, h in hist:
                 s = self.tx_addr_hist.get(tx_hash, set())
                 s.add(addr)
                 self.tx_addr_hist[tx_hash] = s
+                self.tx_heights[tx_hash] = h
+
+    @profiler
+    def build_utxo_index(self):
+        '''Index the unspent outputs of the wallet.  It is then kept up to
+        date by add_transaction and remove_transaction.  Access with
+        self.transaction_lock.'''
+        # outpoint -> (address, value, is_coinbase)
+        self.utxos = {}
+        # address -> set of outpoints
+        self.addr_utxos = {}
+        # outpoint -> hash of the transaction that spends it
+        self.spent_outpoints = {}
+        for tx_hash, d in self.txi.items():
+            for addr, l in d.items():
+                for ser, v in l:
+                    self.spent_outpoints[ser] = tx_hash
+        for tx_hash in self.txo.keys():
+            self.add_utxos(tx_hash)
+
+    def add_utxos(self, tx_hash):
+        '''Add the outputs of a transaction to the index, and remove
+        those it spends'''
+        for addr, l in self.txi.get(tx_hash, {}).items():
+            for ser, v in l:
+                self.spend_utxo(ser, tx_hash)
+        for addr, l in self.txo.get(tx_hash, {}).items():
+            for n, v, is_cb in l:
+                ser = tx_hash + ':%d'%n
+                if ser not in self.spent_outpoints:
+                    self.utxos[ser] = addr, v, is_cb
+                    self.addr_utxos.setdefault(addr, set()).add(ser)
+
+    def spend_utxo(self, ser, tx_hash):
+        self.spent_outpoints[ser] = tx_hash
+        item = self.utxos.pop(ser, None)
+        if item is not None:
+            s = self.addr_utxos[item[0]]
+            s.discard(ser)
+            if not s:
+                self.addr_utxos.pop(item[0])
+
+    def remove_utxos(self, tx_hash):
+        '''Undo add_utxos: the outputs spent by the transaction are
+        unspent again'''
+        for addr, l in self.txo.get(tx_hash, {}).items():
+            for n, v, is_cb in l:
+                ser = tx_hash + ':%d'%n
+                if self.utxos.pop(ser, None) is not None:
+                    s = self.addr_utxos[addr]
+                    s.discard(ser)
+                    if not s:
+                        self.addr_utxos.pop(addr)
+        for addr, l in self.txi.get(tx_hash, {}).items():
+            for ser, v in l:
+                if self.spent_outpoints.get(ser) != tx_hash:
+                    continue
+                self.spent_outpoints.pop(ser)
+                prevout_hash, prevout_n = ser.split(':')
+                for n, v, is_cb in self.txo.get(prevout_hash, {}).get(addr, []):
+                    if n == int(prevout_n):
+                        self.utxos[ser] = addr, v, is_cb
+                        self.addr_utxos.setdefault(addr, set()).add(ser)
 
     @profiler
     def check_history(self):
         save = False
+        pruned = set(self.pruned_txo.values())
         for addr, hist in self.history.items():
             if not self.is_mine(addr):
                 self.history.pop(addr)
+                self.address_status.pop(addr, None)
                 save = True
                 continue
 
             for tx_hash, tx_height in hist:
-                if tx_hash in self.pruned_txo.values() or self.txi.get(tx_hash) or self.txo.get(tx_hash):
+                if tx_hash in pruned or self.txi.get(tx_hash) or self.txo.get(tx_hash):
                     continue
                 tx = self.transactions.get(tx_hash)
                 if tx is not None:
@@ -295,6 +1028,18 @@ class Abstract_Wallet(object):
     def synchronize(self):
         pass
 
+    def address_reported(self, address):
+        pass
+
+    def history_changed(self, address=None):
+        '''Have synchronize() look at the accounts of address again, or at
+        all of them'''
+        with self.lock:
+            if address is None:
+                self.changed_addresses = None
+            elif self.changed_addresses is not None:
+                self.changed_addresses.add(address)
+
     def can_create_accounts(self):
         return False
 
@@ -337,8 +1082,10 @@ class Abstract_Wallet(object):
         self.save_accounts()
 
         # force resynchronization, because we need to re-run add_transaction
-        if address in self.history:
-            self.history.pop(address)
+        with self.lock:
+            if address in self.history:
+                self.history.pop(address)
+                self.address_status.pop(address, None)
 
         if self.synchronizer:
             self.synchronizer.add(address)
@@ -419,32 +1166,29 @@ class Abstract_Wallet(object):
         if tx_height > 0:
             with self.lock:
                 self.unverified_tx[tx_hash] = tx_height
+            if self.verifier:
+                self.verifier.add(tx_hash, tx_height)
 
     def add_verified_tx(self, tx_hash, info):
         with self.lock:
+            old_info = self.verified_tx.get(tx_hash)
+            if old_info is not None:
+                index_remove(self.verified_index, old_info[0], tx_hash)
             self.verified_tx[tx_hash] = info  # (tx_height, timestamp, pos)
+            index_add(self.verified_index, info[0], tx_hash)
         self.storage.put('verified_tx3', self.verified_tx, True)
         self.network.trigger_callback('updated')
 
-    def get_unverified_txs(self):
-        '''Returns a list of tuples (tx_hash, height) that are unverified and not beyond local height'''
-        txs = []
-        with self.lock:
-            for tx_hash, tx_height in self.unverified_tx.items():
-                # do not request merkle branch before headers are available
-                if tx_hash not in self.verified_tx and tx_height <= self.get_local_height():
-                    txs.append((tx_hash, tx_height))
-        return txs
-
     def undo_verifications(self, height):
         '''Used by the verifier when a reorg has happened'''
-        txs = []
         with self.lock:
-            for tx_hash, item in self.verified_tx:
-                tx_height, timestamp, pos = item
-                if tx_height >= height:
-                    self.verified_tx.pop(tx_hash, None)
-                    txs.append(tx_hash)
+            i = bisect.bisect_left(self.verified_index, (height, ''))
+            txs = [tx_hash for tx_height, tx_hash in self.verified_index[i:]]
+            del self.verified_index[i:]
+            for tx_hash in txs:
+                self.verified_tx.pop(tx_hash)
+        if txs:
+            self.storage.put('verified_tx3', self.verified_tx, True)
         return txs
 
     def get_local_height(self):
@@ -570,9 +1314,16 @@ class Abstract_Wallet(object):
         return received, sent
 
     def get_addr_utxo(self, address):
-        coins, spent = self.get_addr_io(address)
-        for txi in spent:
-            coins.pop(txi)
+        '''Unspent outputs of address, from the index'''
+        coins = {}
+        with self.transaction_lock:
+            for ser in self.addr_utxos.get(address, []):
+                tx_hash = ser.split(':')[0]
+                # outputs count once the address history has them
+                if address not in self.tx_addr_hist.get(tx_hash, []):
+                    continue
+                addr, v, is_cb = self.utxos[ser]
+                coins[ser] = (self.tx_heights.get(tx_hash, 0), v, is_cb)
         return coins
 
     # return the total amount ever received by an address
@@ -603,8 +1354,11 @@ class Abstract_Wallet(object):
         coins = []
         if domain is None:
             domain = self.addresses(True)
+        domain = set(domain)
         if exclude_frozen:
-            domain = set(domain) - self.frozen_addresses
+            domain -= self.frozen_addresses
+        with self.transaction_lock:
+            domain &= set(self.addr_utxos.keys())
         for addr in domain:
             c = self.get_addr_utxo(addr)
             for txo, v in c.items():
@@ -680,11 +1434,16 @@ class Abstract_Wallet(object):
     def get_status(self, h):
         if not h:
             return None
-        status = ''
-        for tx_hash, height in h:
-            status += tx_hash + ':%d:' % height
+        status = ''.join(tx_hash + ':%d:' % height for tx_hash, height in h)
         return hashlib.sha256( status ).digest().encode('hex')
 
+    def get_address_status(self, address):
+        '''Status of the history of address, as announced by servers'''
+        with self.lock:
+            if address not in self.address_status:
+                self.address_status[address] = self.get_status(self.history.get(address, []))
+            return self.address_status[address]
+
     def find_pay_to_pubkey_address(self, prevout_hash, prevout_n):
         dd = self.txo.get(prevout_hash, {})
         for addr, l in dd.items():
@@ -694,65 +1453,77 @@ class Abstract_Wallet(object):
                     return addr
 
     def add_transaction(self, tx_hash, tx, tx_height):
-        is_coinbase = tx.inputs[0].get('is_coinbase') == True
         with self.transaction_lock:
-            # add inputs
-            self.txi[tx_hash] = d = {}
-            for txi in tx.inputs:
-                addr = txi.get('address')
-                if not txi.get('is_coinbase'):
-                    prevout_hash = txi['prevout_hash']
-                    prevout_n = txi['prevout_n']
-                    ser = prevout_hash + ':%d'%prevout_n
-                if addr == "(pubkey)":
-                    addr = self.find_pay_to_pubkey_address(prevout_hash, prevout_n)
-                # find value from prev output
-                if addr and self.is_mine(addr):
-                    dd = self.txo.get(prevout_hash, {})
-                    for n, v, is_cb in dd.get(addr, []):
-                        if n == prevout_n:
-                            if d.get(addr) is None:
-                                d[addr] = []
-                            d[addr].append((ser, v))
-                            break
-                    else:
-                        self.pruned_txo[ser] = tx_hash
+            self._add_transaction(tx_hash, tx, tx_height)
 
-            # add outputs
-            self.txo[tx_hash] = d = {}
-            for n, txo in enumerate(tx.outputs):
-                ser = tx_hash + ':%d'%n
-                _type, x, v = txo
-                if _type == 'address':
-                    addr = x
-                elif _type == 'pubkey':
-                    addr = public_key_to_bc_address(x.decode('hex'))
+    def _add_transaction(self, tx_hash, tx, tx_height):
+        is_coinbase = tx.inputs[0].get('is_coinbase') == True
+        # txi and txo are made again
+        self.remove_utxos(tx_hash)
+        # add inputs
+        self.txi[tx_hash] = d = {}
+        for txi in tx.inputs:
+            addr = txi.get('address')
+            if not txi.get('is_coinbase'):
+                prevout_hash = txi['prevout_hash']
+                prevout_n = txi['prevout_n']
+                ser = prevout_hash + ':%d'%prevout_n
+            if addr == "(pubkey)":
+                addr = self.find_pay_to_pubkey_address(prevout_hash, prevout_n)
+            # find value from prev output
+            if addr and self.is_mine(addr):
+                dd = self.txo.get(prevout_hash, {})
+                for n, v, is_cb in dd.get(addr, []):
+                    if n == prevout_n:
+                        if d.get(addr) is None:
+                            d[addr] = []
+                        d[addr].append((ser, v))
+                        break
                 else:
-                    addr = None
-                if addr and self.is_mine(addr):
-                    if d.get(addr) is None:
-                        d[addr] = []
-                    d[addr].append((n, v, is_coinbase))
-                # give v to txi that spends me
-                next_tx = self.pruned_txo.get(ser)
-                if next_tx is not None:
-                    self.pruned_txo.pop(ser)
-                    dd = self.txi.get(next_tx, {})
-                    if dd.get(addr) is None:
-                        dd[addr] = []
-                    dd[addr].append((ser, v))
-            # save
-            self.transactions[tx_hash] = tx
+                    self.pruned_txo[ser] = tx_hash
+
+        # add outputs
+        self.txo[tx_hash] = d = {}
+        for n, txo in enumerate(tx.outputs):
+            ser = tx_hash + ':%d'%n
+            _type, x, v = txo
+            if _type == 'address':
+                addr = x
+            elif _type == 'pubkey':
+                addr = public_key_to_bc_address(x.decode('hex'))
+            else:
+                addr = None
+            if addr and self.is_mine(addr):
+                if d.get(addr) is None:
+                    d[addr] = []
+                d[addr].append((n, v, is_coinbase))
+            # give v to txi that spends me
+            next_tx = self.pruned_txo.get(ser)
+            if next_tx is not None:
+                self.pruned_txo.pop(ser)
+                dd = self.txi.get(next_tx, {})
+                if dd.get(addr) is None:
+                    dd[addr] = []
+                dd[addr].append((ser, v))
+                if next_tx in self.txi:
+                    # set again, so that the change is recorded
+                    self.txi[next_tx] = dd
+                self.spent_outpoints[ser] = next_tx
+        self.add_utxos(tx_hash)
+        # save
+        self.transactions[tx_hash] = tx
 
     def remove_transaction(self, tx_hash, tx_height):
         with self.transaction_lock:
             print_error("removing tx from history", tx_hash)
             #tx = self.transactions.pop(tx_hash)
+            self.remove_utxos(tx_hash)
             for ser, hh in self.pruned_txo.items():
                 if hh == tx_hash:
                     self.pruned_txo.pop(ser)
             # add tx to pruned_txo, and undo the txi addition
             for next_tx, dd in self.txi.items():
+                changed = False
                 for addr, l in dd.items():
                     ll = l[:]
                     for item in ll:
@@ -760,11 +1531,17 @@ class Abstract_Wallet(object):
                         prev_hash, prev_n = ser.split(':')
                         if prev_hash == tx_hash:
                             l.remove(item)
+                            changed = True
                             self.pruned_txo[ser] = next_tx
+                            self.spent_outpoints.pop(ser, None)
                     if l == []:
                         dd.pop(addr)
+                        changed = True
                     else:
                         dd[addr] = l
+                if changed:
+                    # set again, so that the change is recorded
+                    self.txi[next_tx] = dd
             self.txi.pop(tx_hash)
             self.txo.pop(tx_hash)
 
@@ -774,6 +1551,14 @@ class Abstract_Wallet(object):
         #self.network.pending_transactions_for_notifications.append(tx)
         self.add_unverified_tx(tx_hash, tx_height)
 
+    def receive_txs_callback(self, txs):
+        '''Add downloaded transactions, a list of (tx_hash, tx, tx_height)'''
+        with self.transaction_lock:
+            for tx_hash, tx, tx_height in txs:
+                self._add_transaction(tx_hash, tx, tx_height)
+        for tx_hash, tx, tx_height in txs:
+            self.add_unverified_tx(tx_hash, tx_height)
+
 
     def receive_history_callback(self, addr, hist):
 
@@ -785,8 +1570,12 @@ class Abstract_Wallet(object):
                     self.tx_addr_hist[tx_hash].remove(addr)
                     if not self.tx_addr_hist[tx_hash]:
                         self.remove_transaction(tx_hash, height)
+                        self.tx_heights.pop(tx_hash, None)
 
             self.history[addr] = hist
+            self.address_status.pop(addr, None)
+            if self.changed_addresses is not None:
+                self.changed_addresses.add(addr)
             self.storage.put('addr_history', self.history, True)
 
         for tx_hash, tx_height in hist:
@@ -796,6 +1585,7 @@ class Abstract_Wallet(object):
             s = self.tx_addr_hist.get(tx_hash, set())
             s.add(addr)
             self.tx_addr_hist[tx_hash] = s
+            self.tx_heights[tx_hash] = tx_height
             # if addr is new, we have to recompute txi and txo
             tx = self.transactions.get(tx_hash)
             if tx is not None and self.txi.get(tx_hash, {}).get(addr) is None and self.txo.get(tx_hash, {}).get(addr) is None:
@@ -1108,6 +1898,7 @@ class Abstract_Wallet(object):
             self.network.jobs.remove(self.synchronizer.main_loop)
             self.synchronizer = None
             self.storage.put('stored_height', self.get_local_height(), True)
+            self.storage.sync()
 
     def restore(self, cb):
         pass
@@ -1117,6 +1908,7 @@ class Abstract_Wallet(object):
 
     def add_account(self, account_id, account):
         self.accounts[account_id] = account
+        self.history_changed()
         self.save_accounts()
 
     def save_accounts(self):
@@ -1165,14 +1957,28 @@ class Abstract_Wallet(object):
 
     def utxo_can_sign(self, tx):
         out = set()
-        coins = self.get_spendable_coins()
         for i in tx.inputs_without_script():
             txin = tx.inputs[i]
-            for item in coins:
-                if txin.get('prevout_hash') == item.get('prevout_hash') and txin.get('prevout_n') == item.get('prevout_n'):
-                    out.add((i, item.get('address')))
+            addr = self.get_spendable_address(txin.get('prevout_hash'), txin.get('prevout_n'))
+            if addr is not None:
+                out.add((i, addr))
         return out
 
+    def get_spendable_address(self, prevout_hash, prevout_n):
+        '''Address of an outpoint that get_spendable_coins would return,
+        or None'''
+        ser = '%s:%d' % (prevout_hash, prevout_n)
+        with self.transaction_lock:
+            item = self.utxos.get(ser)
+        if item is None:
+            return
+        addr, v, is_cb = item
+        if addr in self.frozen_addresses or addr not in self.tx_addr_hist.get(prevout_hash, []):
+            return
+        if is_cb and self.tx_heights.get(prevout_hash, 0) + COINBASE_MATURITY > self.get_local_height():
+            return
+        return addr
+
     def xkeys_can_sign(self, tx):
         out = set()
         for x in tx.inputs_to_sign():
@@ -1382,6 +2188,10 @@ class Deterministic_Wallet(Abstract_Wallet):
 
     def __init__(self, storage):
         Abstract_Wallet.__init__(self, storage)
+        # while restoring, addresses are created further ahead, and an
+        # address is in use as soon as a server reports it has a history
+        self.restoring = False
+        self.reported_addresses = set()
 
     def has_seed(self):
         return self.seed != ''
@@ -1418,6 +2228,7 @@ class Deterministic_Wallet(Abstract_Wallet):
         if value >= self.gap_limit:
             self.gap_limit = value
             self.storage.put('gap_limit', self.gap_limit, True)
+            self.history_changed()
             return True
 
         elif value >= self.min_acceptable_gap():
@@ -1434,6 +2245,46 @@ class Deterministic_Wallet(Abstract_Wallet):
         else:
             return False
 
+    def get_lookahead(self, for_change):
+        limit = self.gap_limit_for_change if for_change else self.gap_limit
+        return max(limit, RESTORE_LOOKAHEAD) if self.restoring else limit
+
+    def is_address_in_use(self, address):
+        return self.address_is_old(address) or address in self.reported_addresses
+
+    def address_reported(self, address):
+        '''Called by the synchronizer when a server reports that address
+        has a history, before the history is received'''
+        if self.restoring:
+            self.reported_addresses.add(address)
+            self.history_changed(address)
+
+    def trim_lookahead(self):
+        '''Remove the unused addresses created past the gap limit while
+        restoring'''
+        for key, account in self.accounts.items():
+            if type(account) in [ImportedAccount, PendingAccount]:
+                continue
+            for for_change in [False, True]:
+                limit = self.gap_limit_for_change if for_change else self.gap_limit
+                addresses = account.get_addresses(for_change)
+                k = self.num_unused_trailing_addresses(addresses)
+                if k <= limit:
+                    continue
+                n = len(addresses) - k + limit
+                with self.lock:
+                    for addr in addresses[n:]:
+                        self.history.pop(addr, None)
+                        self.address_status.pop(addr, None)
+                if for_change:
+                    account.change_pubkeys = account.change_pubkeys[0:n]
+                    account.change_addresses = account.change_addresses[0:n]
+                else:
+                    account.receiving_pubkeys = account.receiving_pubkeys[0:n]
+                    account.receiving_addresses = account.receiving_addresses[0:n]
+        self.save_accounts()
+        self.storage.put('addr_history', self.history, True)
+
     def num_unused_trailing_addresses(self, addresses):
         k = 0
         for a in addresses[::-1]:
@@ -1468,16 +2319,22 @@ class Deterministic_Wallet(Abstract_Wallet):
         return address
 
     def add_address(self, address):
-        if address not in self.history:
-            self.history[address] = []
+        with self.lock:
+            if address not in self.history:
+                self.history[address] = []
         if self.synchronizer:
             self.synchronizer.add(address)
         self.save_accounts()
 
     def synchronize(self):
         with self.lock:
+            changed = self.changed_addresses
+            self.changed_addresses = set()
+            if changed is not None and not changed:
+                return
             for account in self.accounts.values():
-                account.synchronize(self)
+                if changed is None or account.window_changed(self, changed):
+                    account.synchronize(self)
 
     def restore(self, callback):
         from i18n import _
@@ -1501,7 +2358,14 @@ class Deterministic_Wallet(Abstract_Wallet):
         # wait until we are connected, because the user might have selected another server
         if self.network:
             wait_for_network()
-            wait_for_wallet()
+            self.restoring = True
+            self.history_changed()
+            try:
+                wait_for_wallet()
+            finally:
+                self.restoring = False
+                self.reported_addresses = set()
+            self.trim_lookahead()
         else:
             self.synchronize()
 
@@ -1846,6 +2710,7 @@ class OldWallet(Deterministic_Wallet):
 
     def create_account(self, mpk):
         self.accounts['0'] = OldAccount({'mpk':mpk, 0:[], 1:[]})
+        self.history_changed()
         self.save_accounts()
 
     def create_watching_only_wallet(self, mpk):
@@ -34,7 +34,7 @@ import qrcode
 
 imp.load_module('electrum', *imp.find_module('lib'))
 
-from electrum_xmc import SimpleConfig, Wallet, WalletStorage, format_satoshis
+from electrum_xmc import SimpleConfig, Wallet, open_storage, format_satoshis
 from electrum_xmc import util
 from electrum_xmc.transaction import Transaction
 from electrum_xmc.bitcoin import base_encode, base_decode
@@ -174,7 +174,7 @@ class Authenticator:
     def __init__(self):
         global wallet
         self.qr_data = None
-        storage = WalletStorage('/sdcard/electrum/authenticator')
+        storage = open_storage('/sdcard/electrum/authenticator', SimpleConfig())
         if not storage.file_exists:
 
             action = self.restore_or_create()
@@ -272,7 +272,7 @@ if __name__ == '__main__':
         sys.exit(1)
 
     # create watching_only wallet
-    storage = electrum_xmc.WalletStorage(c)
+    storage = electrum_xmc.open_storage(c.get_wallet_path(), c)
     if not storage.file_exists:
         print "creating wallet file"
         wallet = electrum_xmc.wallet.Wallet.from_xpub(xpub, storage)
@@ -46,6 +46,7 @@ setup(
     package_data={
         'electrum_xmc': [
             'www/index.html',
+            'checkpoints.json',
             'wordlist/*.txt',
             'locale/*/LC_MESSAGES/electrum.mo',
         ],